@@ -0,0 +1,229 @@
+"""
+The benchmarked hot paths. Each setup function builds its inputs from the
+synthetic data and returns the callable to time, so that only the call itself
+is measured.
+"""
+import random
+
+import numpy as np
+import torch
+
+from benchmarks.synthetic import (LOAD_FEATS, SyntheticSMPLH, random_dataset)
+
+# nfeats of LOAD_FEATS: 3 + 6 + 6 + 21*6 + 22*3
+NFEATS = 207
+# CLIP last hidden state, as in configs/model/text_encoder/clipenc.yaml
+TEXT_TOKENS, TEXT_DIM = 77, 768
+
+
+def seed_everything(seed: int):
+    random.seed(seed)
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+
+
+def _dataset(n_samples: int):
+    from src.data.motionfix import MotionFixDataset
+    # no stats file, the features are returned unnormalized
+    return MotionFixDataset(random_dataset(n_samples), 22, '', 'standardize',
+                            rot_repr='6d', load_feats=LOAD_FEATS)
+
+
+def _denoiser():
+    # configs/model/denoiser/tmed_denoiser.yaml with configs/model/basic_clip.yaml
+    from src.model.tmed_denoiser import TMED_denoiser
+    return TMED_denoiser(nfeats=NFEATS, condition='text',
+                         motion_condition='source', latent_dim=512,
+                         ff_size=1024, num_layers=8, num_heads=4,
+                         text_encoded_dim=TEXT_DIM, use_sep=True).eval()
+
+
+def _denoiser_inputs(batch_size: int, length: int, replicas: int = 1):
+    """
+    inputs of the denoiser for a batch of source/target pairs of `length`
+    frames, with the [uncond, motion, text+motion] blocks of classifier-free
+    guidance when replicas is 3
+    """
+    bs = batch_size * replicas
+    text_mask = torch.zeros(bs, TEXT_TOKENS, dtype=torch.bool)
+    text_mask[:, :12] = True
+    motion_mask = torch.ones(batch_size, length, dtype=torch.bool)
+    source = torch.randn(length, batch_size, NFEATS)
+    if replicas == 3:
+        source = torch.cat([torch.zeros_like(source), source, source], 1)
+        motion_mask = torch.cat([torch.zeros_like(motion_mask),
+                                 motion_mask, motion_mask], 0)
+    return dict(noised_motion=torch.randn(bs, length, NFEATS),
+                timestep=torch.tensor([150]),
+                in_motion_mask=torch.ones(bs, length, dtype=torch.bool),
+                text_embeds=torch.randn(bs, TEXT_TOKENS, TEXT_DIM),
+                condition_mask=torch.cat([text_mask, motion_mask], 1),
+                motion_embeds=source)
+
+
+def setup_dataset_getitem(args):
+    dataset = _dataset(args.n_samples)
+
+    def run():
+        for i in range(len(dataset)):
+            dataset[i]
+    return run
+
+
+def setup_collate(args):
+    from src.data.tools.collate import collate_batch_last_padding
+    dataset = _dataset(args.batch_size)
+    batch = [dataset[i] for i in range(len(dataset))]
+    return lambda: collate_batch_last_padding(batch, LOAD_FEATS)
+
+
+def setup_denoiser_forward(args, length):
+    denoiser = _denoiser()
+    inputs = _denoiser_inputs(args.batch_size, length)
+
+    @torch.no_grad()
+    def run():
+        denoiser(**inputs)
+    return run
+
+
+def setup_denoiser_guidance(args, length):
+    denoiser = _denoiser()
+    inputs = _denoiser_inputs(args.batch_size, length, replicas=3)
+    inputs['prepared_conds'] = denoiser.prepare_conditions(
+        inputs['in_motion_mask'], inputs['text_embeds'],
+        inputs['condition_mask'], inputs['motion_embeds'])
+
+    @torch.no_grad()
+    def run():
+        denoiser.forward_with_guidance(**inputs, guidance_motion=2.0,
+                                       guidance_text_n_motion=2.0)
+    return run
+
+
+def setup_p_sample_step(args, length):
+    from src.diffusion import create_diffusion
+    # the training process of MD, see MD.__init__
+    diffusion = create_diffusion(timestep_respacing=None, learn_sigma=False,
+                                 sigma_small=True, diffusion_steps=300,
+                                 noise_schedule='squaredcos_cap_v2',
+                                 predict_xstart=True)
+    denoiser = _denoiser()
+    inputs = _denoiser_inputs(args.batch_size, length, replicas=3)
+    x = inputs.pop('noised_motion')
+    inputs.pop('timestep')
+    inputs['prepared_conds'] = denoiser.prepare_conditions(
+        inputs['in_motion_mask'], inputs['text_embeds'],
+        inputs['condition_mask'], inputs['motion_embeds'])
+    inputs.update(guidance_motion=2.0, guidance_text_n_motion=2.0)
+    t = torch.full((len(x),), 150, dtype=torch.long)
+
+    @torch.no_grad()
+    def run():
+        diffusion.p_sample(denoiser.forward_with_guidance, x, t,
+                           clip_denoised=False, model_kwargs=inputs)
+    return run
+
+
+def _motion_decoder(stats):
+    """
+    the decoding path of MD (features -> SMPL params) without its networks,
+    which need the pretrained text encoder
+    """
+    from src.model.base import BaseModel
+    from src.model.base_diffusion import MD
+    from src.utils.genutils import cast_dict_to_tensors
+
+    class MotionDecoder:
+        diffout2motion = MD.diffout2motion
+        cat_inputs = BaseModel.cat_inputs
+        uncat_inputs = BaseModel.uncat_inputs
+        unnorm_inputs = BaseModel.unnorm_inputs
+        unnorm = BaseModel.unnorm
+        _stats_on_device = BaseModel._stats_on_device
+
+    decoder = MotionDecoder()
+    decoder.stats = cast_dict_to_tensors(stats)
+    decoder.device = torch.device('cpu')
+    decoder.norm_type = 'standardize'
+    decoder.input_feats = list(LOAD_FEATS)
+    decoder.input_feats_dims = [3, 6, 6, 126, 66]
+    return decoder
+
+
+def setup_diffout2motion(args, length):
+    from src.data.tools.running_stats import compute_feature_stats
+    stats = compute_feature_stats(_dataset(16), progress=False)
+    stats['body_transl'] = {k: np.zeros(3, dtype=np.float32) for k in
+                            ('max', 'min', 'mean')}
+    stats['body_transl']['std'] = np.ones(3, dtype=np.float32)
+    decoder = _motion_decoder(stats)
+    diffout = torch.randn(args.batch_size, length, NFEATS)
+
+    @torch.no_grad()
+    def run():
+        decoder.diffout2motion(diffout)
+    return run
+
+
+def setup_smpl_forward_fast(args, length):
+    from src.model.utils.smpl_fast import smpl_forward_fast
+    from src.tools.transforms3d import transform_body_pose
+    body_model = SyntheticSMPLH().eval()
+    nframes = args.batch_size * length
+    body_pose = transform_body_pose(0.3 * torch.randn(nframes, 21 * 3),
+                                    'aa->rot')
+    global_orient = transform_body_pose(0.3 * torch.randn(nframes, 3),
+                                        'aa->rot')
+    transl = torch.randn(nframes, 3)
+
+    @torch.no_grad()
+    def run():
+        smpl_forward_fast(body_model, transl=transl, body_pose=body_pose,
+                          global_orient=global_orient)
+    return run
+
+
+def setup_contrastive_metrics(args, n):
+    from src.tmr.metrics import contrastive_metrics
+    sims = np.random.randn(n, n).astype(np.float32)
+    # ties as produced by duplicated targets
+    sims[:, 1::7] = sims[:, ::7][:, :sims[:, 1::7].shape[1]]
+    return lambda: contrastive_metrics(sims)
+
+
+def get_cases(args):
+    """name -> setup function taking no argument"""
+    cases = {'dataset_getitem': lambda: setup_dataset_getitem(args),
+             'collate_batch_last_padding': lambda: setup_collate(args)}
+    for length in args.lengths:
+        for name, setup in (('denoiser_forward', setup_denoiser_forward),
+                            ('denoiser_forward_with_guidance', setup_denoiser_guidance),
+                            ('p_sample_step', setup_p_sample_step),
+                            ('diffout2motion', setup_diffout2motion),
+                            ('smpl_forward_fast', setup_smpl_forward_fast)):
+            cases[f'{name}/L{length}'] = (lambda s=setup, l=length: s(args, l))
+    for n in args.retrieval_sizes:
+        cases[f'contrastive_metrics/N{n}'] = (
+            lambda n=n: setup_contrastive_metrics(args, n))
+    return cases
+
+
+def check_torchscript_denoiser(seed: int = 0):
+    """
+    the guided step of a TorchScript export of the denoiser against the eager
+    module, at sequence lengths other than the traced one
+    """
+    import os
+    import tempfile
+    from src.model.denoiser_export import (ExportedDenoiser, check_parity,
+                                           export_torchscript)
+    seed_everything(seed)
+    denoiser = _denoiser()
+    with tempfile.TemporaryDirectory() as tmp:
+        path = export_torchscript(denoiser, os.path.join(tmp, 'denoiser.pt'))
+        return check_parity(denoiser, ExportedDenoiser(path), seed=seed)
+
+
+# name -> (check returning an error, tolerance)
+CHECKS = {'torchscript_denoiser_vs_eager': (check_torchscript_denoiser, 1e-4)}
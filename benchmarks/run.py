@@ -0,0 +1,142 @@
+"""
+CPU benchmarks of the hot paths of MotionFix on synthetic SMPL-H data.
+
+Run all the cases and write the timings as JSON:
+    python -m benchmarks.run --out benchmarks/results.json
+
+Store a baseline, then compare later runs against it (exits with 1 when a case
+is slower than the baseline by more than --tolerance or a check fails):
+    python -m benchmarks.run --out benchmarks/baseline.json
+    python -m benchmarks.run --baseline benchmarks/baseline.json
+
+Select cases with --only, e.g. --only denoiser p_sample_step/L300
+"""
+import argparse
+import json
+import logging
+import platform
+import statistics
+import subprocess
+import sys
+import time
+
+import torch
+
+from benchmarks.cases import CHECKS, get_cases, seed_everything
+
+log = logging.getLogger(__name__)
+
+
+def time_case(fn, warmup: int, repeat: int):
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append((time.perf_counter() - start) * 1e3)
+    return {'median_ms': statistics.median(times),
+            'mean_ms': statistics.fmean(times),
+            'min_ms': min(times),
+            'std_ms': statistics.stdev(times) if len(times) > 1 else 0.0,
+            'repeat': repeat}
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                       stderr=subprocess.DEVNULL,
+                                       text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline, tolerance: float):
+    """cases slower than the baseline median by more than tolerance"""
+    regressions = {}
+    for name, res in results.items():
+        if name not in baseline:
+            continue
+        ratio = res['median_ms'] / baseline[name]['median_ms']
+        res['baseline_median_ms'] = baseline[name]['median_ms']
+        res['ratio'] = ratio
+        if ratio > 1 + tolerance:
+            regressions[name] = ratio
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the hot paths of MotionFix on CPU.")
+    parser.add_argument("--only", type=str, nargs='*', default=None,
+                        help="Run the cases whose name starts with one of these")
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--lengths", type=int, nargs='*', default=[60, 150, 300],
+                        help="Sequence lengths of the model cases")
+    parser.add_argument("--n-samples", type=int, default=64,
+                        help="Samples read by the dataset case")
+    parser.add_argument("--retrieval-sizes", type=int, nargs='*',
+                        default=[1024, 4096])
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument("--warmup", type=int, default=2)
+    parser.add_argument("--threads", type=int, default=1,
+                        help="torch intra-op threads, 1 keeps timings stable")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", type=str, default=None,
+                        help="Path of the JSON results")
+    parser.add_argument("--baseline", type=str, default=None,
+                        help="JSON results of an earlier run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.15,
+                        help="Allowed relative slowdown of the median")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    torch.set_num_threads(args.threads)
+
+    checks = {}
+    for name, (check, tol) in CHECKS.items():
+        err = check(args.seed)
+        checks[name] = {'max_abs_err': err, 'tolerance': tol,
+                        'passed': err <= tol}
+        log.info(f'check {name}: max abs err {err:.2e} '
+                 f'({"ok" if err <= tol else "FAILED"})')
+
+    results = {}
+    for name, setup in get_cases(args).items():
+        if args.only and not any(name.startswith(p) for p in args.only):
+            continue
+        seed_everything(args.seed)
+        fn = setup()
+        results[name] = time_case(fn, args.warmup, args.repeat)
+        log.info(f'{name:<45} {results[name]["median_ms"]:10.3f} ms '
+                 f'(± {results[name]["std_ms"]:.3f})')
+
+    regressions = {}
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline['results'], args.tolerance)
+        for name, res in results.items():
+            if 'ratio' in res:
+                log.info(f'{name:<45} {res["ratio"]:6.2f}x baseline'
+                         f'{"  REGRESSION" if name in regressions else ""}')
+
+    report = {'meta': {'commit': git_commit(),
+                       'python': platform.python_version(),
+                       'torch': torch.__version__,
+                       'platform': platform.platform(),
+                       'threads': args.threads,
+                       'args': vars(args)},
+              'checks': checks,
+              'results': results,
+              'regressions': regressions}
+    if args.out is not None:
+        with open(args.out, 'w') as f:
+            json.dump(report, f, indent=2)
+        log.info(f'Wrote results to {args.out}')
+
+    failed = regressions or not all(c['passed'] for c in checks.values())
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+"""
+Synthetic MotionFix data for the benchmarks: random SMPL-H motions with the
+layout of the joblib dataset, and a random SMPL-H body model with the layout of
+`smplx.SMPLHLayer`, so that nothing has to be downloaded.
+"""
+import torch
+from torch import nn
+
+N_SMPLH_JOINTS = 52
+# the features of configs/data/motionfix.yaml
+LOAD_FEATS = ["body_transl_delta_pelv", "body_orient_xy", "z_orient_delta",
+              "body_pose", "body_joints_local_wo_z_rot"]
+
+
+def smplh_parents():
+    """kinematic tree of SMPL-H: the body, then the left and right hand"""
+    parents = [-1, 0, 0, 0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 9, 9, 12, 13, 14,
+               16, 17, 18, 19]
+    for wrist in (20, 21):
+        # index, middle, pinky, ring, thumb with three joints each
+        for _ in range(5):
+            start = len(parents)
+            parents.extend([wrist, start, start + 1])
+    return torch.tensor(parents)
+
+
+def random_motion(nframes: int, generator: torch.Generator):
+    """one motion with the fields of the dataset, smooth random walk poses"""
+    steps = 0.02 * torch.randn(nframes, N_SMPLH_JOINTS * 3,
+                               generator=generator)
+    rots = 0.3 * torch.randn(1, N_SMPLH_JOINTS * 3,
+                             generator=generator) + steps.cumsum(0)
+    trans = (0.01 * torch.randn(nframes, 3, generator=generator)).cumsum(0)
+    trans[:, 2] += 0.9
+    joints = torch.randn(nframes, N_SMPLH_JOINTS, 3,
+                         generator=generator) * 0.3 + trans[:, None]
+    return {'rots': rots, 'trans': trans, 'joint_positions': joints}
+
+
+def random_dataset(n_samples: int, min_len: int = 40, max_len: int = 300,
+                   seed: int = 0):
+    """list of data as the one MotionFixDataset is built from"""
+    g = torch.Generator().manual_seed(seed)
+    data = []
+    for i in range(n_samples):
+        len_src, len_tgt = torch.randint(min_len, max_len + 1, (2,),
+                                         generator=g).tolist()
+        data.append({'motion_source': random_motion(len_src, g),
+                     'motion_target': random_motion(len_tgt, g),
+                     'text': f'edit number {i}',
+                     'id': f'{i:06d}',
+                     'split': 0})
+    return data
+
+
+class SyntheticSMPLH(nn.Module):
+    """
+    The buffers and constants `smpl_forward_fast` reads from an
+    `smplx.SMPLHLayer`, filled with random values of the right shapes.
+    """
+    NUM_BODY_JOINTS = 21
+    NUM_HAND_JOINTS = 15
+
+    def __init__(self, n_verts: int = 6890, num_betas: int = 10,
+                 seed: int = 0):
+        super().__init__()
+        g = torch.Generator().manual_seed(seed)
+        self.num_betas = num_betas
+        self.joint_mapper = None
+        self.register_buffer('v_template', torch.randn(n_verts, 3, generator=g))
+        self.register_buffer('shapedirs',
+                             0.01 * torch.randn(n_verts, 3, num_betas,
+                                                generator=g))
+        regressor = torch.rand(N_SMPLH_JOINTS, n_verts, generator=g)
+        self.register_buffer('J_regressor',
+                             regressor / regressor.sum(-1, keepdim=True))
+        self.register_buffer('parents', smplh_parents())
@@ -14,14 +14,10 @@ def collect_gen_samples(motion_gen_path, normalizer, device):
     # translation | root_orient | rots --> trans | rots | root_orient
     print("Collecting Generated Samples")
     from src.data.features import _get_body_transl_delta_pelv_infer
-    import glob
-
-    sample_files = glob.glob(f'{motion_gen_path}/*.npy')
-    for fname in tqdm(sample_files):
-        keyid = str(Path(fname).name).replace('.npy', '')
-        gen_motion_b = np.load(fname,
-                               allow_pickle=True).item()['pose']
-        gen_motion_b = torch.from_numpy(gen_motion_b)
+    from src.utils.sample_store import iter_samples
+
+    for keyid, gen_motion_b in tqdm(iter_samples(motion_gen_path)):
+        gen_motion_b = torch.from_numpy(np.array(gen_motion_b))
         trans = gen_motion_b[..., :3]
         global_orient_6d = gen_motion_b[..., 3:9]
         body_pose_6d = gen_motion_b[..., 9:]
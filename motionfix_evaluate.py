@@ -102,6 +102,13 @@ def render_vids(newcfg: DictConfig) -> None:
         gd_str = ''
 
 
+    # 'ddpm' rebuilds the schedule with num_infer_steps steps, 'respaced' and
+    # 'ddim' sample with num_infer_steps steps of the trained schedule
+    sampler = cfg.sampler
+    from src.tools.tracing import TRACER
+    if cfg.trace:
+        TRACER.enable()
+    assert sampler in ['ddpm', 'respaced', 'ddim']
     diffusion_process = create_diffusion(timestep_respacing=None,
                                     learn_sigma=False,
                                     sigma_small=True,
@@ -119,6 +126,8 @@ def render_vids(newcfg: DictConfig) -> None:
     # TODO pUT THIS BACK    
     # fd_name = get_folder_name(cfg)
     fd_name = f'steps_{num_infer_steps}'
+    if sampler != 'ddpm':
+        fd_name = f'{sampler}_{fd_name}'
     if cfg.inpaint:
         output_path = exp_folder / f'{cfg.prob_way}_{gd_str}{fd_name}_{cfg.data.dataname}_{cfg.init_from}_{cfg.ckpt_name}_inpaint_bsl'
     else:
@@ -151,6 +160,9 @@ def render_vids(newcfg: DictConfig) -> None:
                                        strict=False)
     model.eval()
     model.freeze()
+    model.inference_precision = cfg.inference_precision
+    # reduced precision is validated against fp32 on the first batch
+    check_precision = cfg.inference_precision != 'fp32'
     logger.info(f"Model '{cfg.model.modelname}' loaded")
     # logger.info('------Generating using Scheduler------\n\n'\
     #             f'{model.infer_scheduler}')
@@ -211,12 +223,30 @@ def render_vids(newcfg: DictConfig) -> None:
         save_data_sample = True
     else:
         save_data_sample = False
+    # 'store': one sample store file per guidance setting, 'npy': one file per sample
+    save_format = cfg.save_format
+    assert save_format in ['store', 'npy']
+    from src.utils.sample_store import SampleStoreWriter, SAMPLE_STORE_FILE
+    # the guidance pairs of a group are sampled as stacked trajectories
+    # in one reverse diffusion pass
+    guidance_batch_size = cfg.guidance_batch_size or len(guidances_mix)
     with torch.no_grad():
-        for guid_text, guid_motion in guidances_mix:
-            cur_guid_comb = f'ld_txt-{guid_text}_ld_mot-{guid_motion}'
-            cur_outpath = output_path / cur_guid_comb
-            cur_outpath.mkdir(exist_ok=True, parents=True)
-            logger.info(f"Sample MotionFix test set\n in:{cur_outpath}")
+        for guid_group in chunker(guidances_mix, guidance_batch_size):
+            savers = []
+            sample_stores = []
+            for guid_text, guid_motion in guid_group:
+                cur_guid_comb = f'ld_txt-{guid_text}_ld_mot-{guid_motion}'
+                cur_outpath = output_path / cur_guid_comb
+                cur_outpath.mkdir(exist_ok=True, parents=True)
+                logger.info(f"Sample MotionFix test set\n in:{cur_outpath}")
+                if save_format == 'store':
+                    sample_store = SampleStoreWriter(cur_outpath / SAMPLE_STORE_FILE)
+                    sample_stores.append(sample_store)
+                    savers.append(sample_store.put)
+                else:
+                    def save_sample(key, pose, outpath=cur_outpath):
+                        np.save(outpath / f"{key}.npy", {'pose': pose})
+                    savers.append(save_sample)
 
             for batch in tqdm(ds_iterator):
                 text_diff = batch['text']
@@ -278,7 +308,32 @@ def render_vids(newcfg: DictConfig) -> None:
                     source_init = source_mot_pad
                 else:
                     source_init = None
-                diffout = model.generate_motion(text_diff,
+                if check_precision:
+                    from src.model.precision import precision_error
+                    check_precision = False
+                    prec_err = precision_error(model, text_diff, source_mot_pad,
+                                               mask_source, mask_target,
+                                               cfg.inference_precision,
+                                               diffusion_process=diffusion_process,
+                                               init_vec=source_init,
+                                               init_vec_method=init_diff_from,
+                                               condition_mode=mode_cond,
+                                               gd_motion=guid_group[0][1],
+                                               gd_text=guid_group[0][0],
+                                               num_diff_steps=num_infer_steps,
+                                               use_linear=use_linear_guid,
+                                               prob_way=cfg.prob_way,
+                                               sampler=None if sampler == 'ddpm' else sampler,
+                                               ddim_eta=cfg.ddim_eta)
+                    logger.info(f'{cfg.inference_precision} vs fp32: mean joint '
+                                f'error {prec_err["mpjpe_mm"]:.2f}mm, max '
+                                f'{prec_err["max_mm"]:.2f}mm')
+                    if prec_err['mpjpe_mm'] > cfg.precision_tolerance_mm:
+                        logger.warning(f'{cfg.inference_precision} is over the '
+                                       f'tolerance of {cfg.precision_tolerance_mm}'
+                                       'mm, sampling in fp32.')
+                        model.inference_precision = 'fp32'
+                diffouts = model.generate_motion(text_diff,
                                                 source_mot_pad,
                                                 mask_source,
                                                 mask_target,
@@ -286,35 +341,38 @@ def render_vids(newcfg: DictConfig) -> None:
                                                 init_vec=source_init,
                                                 init_vec_method=init_diff_from,
                                                 condition_mode=mode_cond,
-                                                gd_motion=guid_motion,
-                                                gd_text=guid_text,
+                                                gd_motion=[gm for _, gm in guid_group],
+                                                gd_text=[gt for gt, _ in guid_group],
                                                 num_diff_steps=num_infer_steps,
                                                 inpaint_dict=inpaint_dict,
                                                 use_linear=use_linear_guid, 
-                                                prob_way=cfg.prob_way 
+                                                prob_way=cfg.prob_way,
+                                                sampler=None if sampler == 'ddpm' else sampler,
+                                                ddim_eta=cfg.ddim_eta
                                                 )
-                gen_mo = model.diffout2motion(diffout)
-                from src.tools.transforms3d import transform_body_pose
-                for i in range(gen_mo.shape[0]):
-                    dict_to_save = {'pose': gen_mo[i, 
-                                                   :target_lens[i]].cpu().numpy() 
-                                    }
-                    np.save(cur_outpath / f"{str(batch['id'][i]).zfill(6)}.npy",
-                            dict_to_save)
-                    if save_data_sample:
-                        dict_to_save = {'pose': src_mot_cond[i,
-                                                   :source_lens[i]].cpu().numpy()
-                                    }
-                        np.save(cur_outpath / f"{str(batch['id'][i]).zfill(6)}_source.npy",
-                            dict_to_save)
-                        dict_to_save = {'pose': tgt_mot[i,
-                                                   :target_lens[i]].cpu().numpy()
-                                    }
-                        np.save(cur_outpath / f"{str(batch['id'][i]).zfill(6)}_target.npy",
-                            dict_to_save)
-                    # np.load(output_path / f"{str(batch['id'][i]).zfill(6)}.npy")
+                if save_data_sample:
+                    src_mot_cond = src_mot_cond.cpu().numpy()
+                    tgt_mot = tgt_mot.cpu().numpy()
+                for save_sample, diffout in zip(savers, diffouts):
+                    gen_mo = model.diffout2motion(diffout).cpu().numpy()
+                    for i in range(gen_mo.shape[0]):
+                        keyid = str(batch['id'][i]).zfill(6)
+                        save_sample(keyid, gen_mo[i, :target_lens[i]])
+                        if save_data_sample:
+                            save_sample(f"{keyid}_source",
+                                        src_mot_cond[i, :source_lens[i]])
+                            save_sample(f"{keyid}_target",
+                                        tgt_mot[i, :target_lens[i]])
                 # output_path = Path('/home/nathanasiou/Desktop/conditional_action_gen/modilex')
+            for sample_store in sample_stores:
+                sample_store.close()
         logger.info(f"Sample script. The outputs are stored in:{cur_outpath}")
+    if TRACER.enabled:
+        TRACER.log_summary(logger)
+        over = TRACER.over_budget(cfg.latency_budgets or {})
+        for stage, mean_ms in over.items():
+            logger.warning(f'{stage} takes {mean_ms:.1f} ms on average, over '
+                           f'its budget of {cfg.latency_budgets[stage]} ms')
 
 if __name__ == '__main__':
 
@@ -78,7 +78,8 @@ class RenderCallback(Callback):
                  num_workers: int = 0,
                  nvids_to_save: int = 5,
                  fps: float = 30.0,
-                 modelname = 'sinc') -> None:
+                 modelname = 'sinc',
+                 render_workers: int = 0) -> None:
 
         if logger_type == "wandb":
             self.log_to_logger = log_to_wandb
@@ -104,6 +105,37 @@ class RenderCallback(Callback):
 
         if bm_path is not None:
             self.body_model_path = Path(bm_path) / 'smpl_models'
+
+        # render on background workers instead of blocking the epoch end
+        self.render_workers = render_workers
+        self._render_pool = None
+
+    @property
+    def render_pool(self):
+        if self.render_workers and self._render_pool is None:
+            from src.render.render_pool import RenderPool
+            self._render_pool = RenderPool(self.body_model_path,
+                                           num_workers=self.render_workers,
+                                           fps=self.fps)
+        return self._render_pool
+
+    def log_rendered(self, trainer: Trainer, wait: bool = False) -> None:
+        if self._render_pool is None:
+            return
+        train_logger = trainer.lightning_module.logger.experiment
+        for (log_name, caption), output in self._render_pool.collect(wait=wait):
+            logid, vid_entry = self.log_to_logger(path=output,
+                                                  log_name=log_name,
+                                                  caption=caption,
+                                                  fps=self.fps,
+                                                  vid_format=self.vid_format)
+            train_logger.log({logid: vid_entry, 'epoch': trainer.current_epoch})
+
+    def on_fit_end(self, trainer: Trainer, pl_module: LightningModule) -> None:
+        if self._render_pool is not None:
+            self.log_rendered(trainer, wait=True)
+            self._render_pool.close()
+            self._render_pool = None
     
     def on_train_epoch_end(self, trainer: Trainer, pl_module: LightningModule,
                            **kwargs) -> None:
@@ -186,6 +218,20 @@ class RenderCallback(Callback):
         train_logger = pl_module.logger.experiment
         list_of_logs = []
         log_dict = {}
+        if self.render_pool is not None:
+            self.log_rendered(trainer)
+            for jts_or_vts, name in zip([ref_joints_or_verts, jts_M, jts_T],
+                                    ['ref', 'from_motion', 'from_text']):
+                for index, description in zip(range(self.nvids), texts):
+                    fig_number = str(index).zfill(2)
+                    motion = jts_or_vts[index]
+                    self.render_pool.submit(
+                        motion, folder / f"{name}_{split}_{fig_number}",
+                        kind='vertices' if motion.shape[1] > 100 else 'joints',
+                        text=description,
+                        tag=(f"visuals_{split}/{name}/{fig_number}", description))
+            return
+
         for jts_or_vts, name in zip([ref_joints_or_verts, jts_M, jts_T],
                                 ['ref', 'from_motion', 'from_text']):
             for index, description in zip(range(self.nvids), texts):
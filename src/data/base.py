@@ -1,17 +1,28 @@
+import logging
+
 import pytorch_lightning as pl
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, SequentialSampler
 
 from src.data.tools.collate import collate_batch_last_padding, collate_datastruct_and_text
+# imported before the dataloader hooks, so that Lightning records its init
+# arguments and can rebuild it with a DistributedSampler under DDP
+from src.data.sampling.custom_batch_sampler import LengthBucketBatchSampler
 import torch
 from typing import List
 
+log = logging.getLogger(__name__)
+
 class BASEDataModule(pl.LightningDataModule):
     def __init__(self,
                  batch_size: int,
                  num_workers: int,
                  load_feats: List[str],
                  batch_sampler: str | None = None,
-                 dataset_percentages: dict[str, float] | None = None):
+                 dataset_percentages: dict[str, float] | None = None,
+                 bucket_noise: float = 0.1,
+                 pin_memory: bool = False,
+                 persistent_workers: bool = False,
+                 prefetch_to_device: int = 0):
         super().__init__()
 
         collate_fn = lambda b: collate_batch_last_padding(b, load_feats)
@@ -24,11 +35,17 @@ class BASEDataModule(pl.LightningDataModule):
             'num_workers': num_workers,
             'collate_fn': collate_fn,
             'drop_last': False,
-            'worker_init_fn': set_worker_sharing_strategy
-            # 'pin_memory': True,
+            'worker_init_fn': set_worker_sharing_strategy,
+            'pin_memory': pin_memory and torch.cuda.is_available(),
+            # keep the workers (and their sharing strategy) across epochs
+            'persistent_workers': persistent_workers and num_workers > 0,
             }
+        # batches copied to the device ahead of the step, 0 to disable
+        self.prefetch_to_device = prefetch_to_device
+        self.prefetchers = {}
         self.batch_sampler = batch_sampler
         self.ds_perc = dataset_percentages
+        self.bucket_noise = bucket_noise
         self.batch_size = batch_size
         # need to be overloaded:
         # - self.Dataset
@@ -43,13 +60,43 @@ class BASEDataModule(pl.LightningDataModule):
         # Optional
         self._subset_dataset = None
         
+    def _prefetch(self, loader, split: str):
+        """
+        wrap the loader in a DevicePrefetcher of the trainer device, whose
+        wait times are logged by the model
+        """
+        if not self.prefetch_to_device or self.trainer is None:
+            return loader
+        if self.trainer.world_size > 1:
+            # Lightning has to see the DataLoader to set its distributed sampler
+            log.warning('Device prefetching is disabled with several devices.')
+            return loader
+        from src.data.tools.prefetch import DevicePrefetcher
+        self.prefetchers[split] = DevicePrefetcher(
+            loader, self.trainer.strategy.root_device,
+            depth=self.prefetch_to_device)
+        return self.prefetchers[split]
+
     def get_sample_set(self, overrides={}):
         sample_params = self.hparams.copy()
         sample_params.update(overrides)
         return self.Dataset(**sample_params)
 
     def train_dataloader(self):
-        if self.batch_sampler is not None:
+        if self.batch_sampler == 'length_bucket':
+            # batch by max(source, target) length to reduce padding
+            lengths = self.dataset['train'].get_lengths().max(1)
+            bucket_batch_sampler = LengthBucketBatchSampler(SequentialSampler(self.dataset['train']),
+                                                            lengths,
+                                                            batch_size=self.batch_size,
+                                                            shuffle=True,
+                                                            noise=self.bucket_noise)
+            dataloader_options = {k: v for k, v in self.dataloader_options.items()
+                                  if k != 'batch_size'}
+            return self._prefetch(DataLoader(self.dataset['train'],
+                                             batch_sampler=bucket_batch_sampler,
+                                             **dataloader_options), 'train')
+        elif self.batch_sampler is not None:
             from src.data.sampling.custom_batch_sampler import PercBatchSampler, CustomBatchSampler, CustomBatchSamplerV2, CustomBatchSamplerV4
             from src.data.sampling.custom_batch_sampler import mix_datasets_anysize
             # ratio_batch_sampler = CustomBatchSamplerV2(concat_dataset=self.dataset['train'],
@@ -62,13 +109,15 @@ class BASEDataModule(pl.LightningDataModule):
             #                                        baxtch_size=self.batch_size)
                                                 #    dataset_percentages=self.ds_perc)
             del self.dataloader_options['batch_size']
-            return DataLoader(self.dataset['train'],
-                              batch_sampler=ratio_batch_sampler,
-                              **self.dataloader_options)
+            return self._prefetch(DataLoader(self.dataset['train'],
+                                             batch_sampler=ratio_batch_sampler,
+                                             **self.dataloader_options),
+                                  'train')
         else:
-            return DataLoader(self.dataset['train'],
-                              shuffle=True,
-                              **self.dataloader_options)
+            return self._prefetch(DataLoader(self.dataset['train'],
+                                             shuffle=True,
+                                             **self.dataloader_options),
+                                  'train')
 
     def val_dataloader(self):
         if self.batch_sampler is not None:
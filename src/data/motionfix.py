@@ -13,6 +13,9 @@ import torch
 from einops import rearrange
 from src import data
 from src.data.tools.collate import collate_tensor_with_padding
+from src.data.tools.feature_store import MotionFixFeatureStore, is_feature_store
+from src.data.tools.feature_cache import FeatureCache
+from src.data.tools.running_stats import compute_feature_stats
 from src.tools.geometry import matrix_to_euler_angles, matrix_to_rotation_6d
 from pytorch_lightning import LightningDataModule
 from smplx.joint_names import JOINT_NAMES
@@ -41,7 +44,8 @@ class MotionFixDataset(Dataset):
                  stats_file: str, norm_type: str,
                  smplh_path: str = None, rot_repr: str = "6d",
                  load_feats: List[str] = None,
-                 text_augment_db: Dict[str, List[str]] = None):
+                 text_augment_db: Dict[str, List[str]] = None,
+                 feature_cache: str = None):
 
         self.data = data
         self.norm_type = norm_type
@@ -97,6 +101,12 @@ class MotionFixDataset(Dataset):
             "framerate": self._get_framerate,
             "dataset_name": lambda _: self.name, 
         }
+        self.feature_cache = None
+        if feature_cache is not None:
+            self.feature_cache = FeatureCache(
+                feature_cache,
+                {feat: self._feat_get_methods[feat] for feat in self.load_feats},
+                extra_key=f'{self.rot_repr}_{self.n_body_joints}')
         self.nfeats = self.get_features_dimentionality()
 
     @classmethod
@@ -401,6 +411,22 @@ class MotionFixDataset(Dataset):
     def __len__(self):
         return len(self.data)
 
+    def get_lengths(self):
+        """
+        Number of frames of the source and target motion of every sample,
+        without computing their features.
+
+        returns:
+            array [N, 2] of the (source, target) lengths
+        """
+        motions = ('motion_source', 'motion_target')
+        if hasattr(self.data, 'length'):
+            # feature store, read from its index
+            return np.array([[self.data.length(idx, m) for m in motions]
+                             for idx in range(len(self.data))])
+        return np.array([[len(datum[m]['rots']) for m in motions]
+                         for datum in self.data])
+
     @staticmethod
     def _canonica_facefront(rotations, translation):
         rots_motion = rotations
@@ -422,11 +448,32 @@ class MotionFixDataset(Dataset):
         return rots_motion_aa_can, translation_can
 
 
+    def _get_feature(self, feat, datum, motion_key):
+        """
+        get a feature, using the precomputed one of the feature store or the
+        feature cache if any
+        """
+        motion = datum[motion_key]
+        precomputed = motion.get('feats')
+        if precomputed is not None and feat in precomputed:
+            return precomputed[feat]
+        if self.feature_cache is not None:
+            return self.feature_cache.get_or_compute(
+                datum['id'], motion_key, feat,
+                lambda: self._feat_get_methods[feat](motion))
+        return self._feat_get_methods[feat](motion)
+
+    def prebuild_feature_cache(self):
+        """fill the feature cache for all the samples of the dataset"""
+        assert self.feature_cache is not None, 'No feature cache to build.'
+        for idx in tqdm(range(len(self))):
+            self.get_all_features(idx)
+
     def __getitem__(self, idx):
         datum = self.data[idx]
-        data_dict_source = {f'{feat}_source': self._feat_get_methods[feat](datum['motion_source'])
+        data_dict_source = {f'{feat}_source': self._get_feature(feat, datum, 'motion_source')
                             for feat in self.load_feats}
-        data_dict_target = {f'{feat}_target': self._feat_get_methods[feat](datum['motion_target'])
+        data_dict_target = {f'{feat}_target': self._get_feature(feat, datum, 'motion_target')
                             for feat in self.load_feats}
         meta_data_dict = {feat: method(datum)
                           for feat, method in self._meta_data_get_methods.items()}
@@ -469,9 +516,9 @@ class MotionFixDataset(Dataset):
     def get_all_features(self, idx):
         datum = self.data[idx]
 
-        data_dict_source = {f'{feat}_source': self._feat_get_methods[feat](datum['motion_source'])
+        data_dict_source = {f'{feat}_source': self._get_feature(feat, datum, 'motion_source')
                             for feat in self.load_feats}
-        data_dict_target = {f'{feat}_target': self._feat_get_methods[feat](datum['motion_target'])
+        data_dict_target = {f'{feat}_target': self._get_feature(feat, datum, 'motion_target')
                             for feat in self.load_feats}
         meta_data_dict = {feat: method(datum)
                           for feat, method in self._meta_data_get_methods.items()}
@@ -495,10 +542,22 @@ class MotionFixDataModule(BASEDataModule):
                  rot_repr: str = "6d",
                  proportion: float = 1.0,
                  text_augment: bool = False,
+                 store_path: str = None,
+                 feature_cache: str = None,
+                 batch_sampler: str = None,
+                 bucket_noise: float = 0.1,
+                 pin_memory: bool = False,
+                 persistent_workers: bool = False,
+                 prefetch_to_device: int = 0,
                  **kwargs):
         super().__init__(batch_size=batch_size,
                          num_workers=num_workers,
-                         load_feats=load_feats)
+                         load_feats=load_feats,
+                         batch_sampler=batch_sampler,
+                         bucket_noise=bucket_noise,
+                         pin_memory=pin_memory,
+                         persistent_workers=persistent_workers,
+                         prefetch_to_device=prefetch_to_device)
         self.dataname = dataname
         self.batch_size = batch_size
 
@@ -511,6 +570,7 @@ class MotionFixDataModule(BASEDataModule):
         self.preproc = preproc
         self.smpl_p = smplh_path if not debug else kwargs['smplh_path_dbg']
         self.rot_repr = rot_repr
+        self.feature_cache = feature_cache
         self.Dataset = MotionFixDataset
         # calculate splits
         self.body_model = smplx.SMPLHLayer(f'{smplh_path}/smplh',
@@ -534,6 +594,12 @@ class MotionFixDataModule(BASEDataModule):
         else:
             text_aug_db = None
 
+        splits = read_json(f'{os.path.dirname(datapath)}/splits.json')
+        if not self.debug and is_feature_store(store_path):
+            # takes a few seconds, the shards are memory-mapped
+            self._setup_from_store(store_path, splits, proportion, text_aug_db)
+            return
+
         log.info(f'...Loading data from {ds_db_path}...')
         dataset_dict_raw = joblib.load(ds_db_path)
         log.info(f'Loaded data from {ds_db_path}.')
@@ -542,7 +608,6 @@ class MotionFixDataModule(BASEDataModule):
         # add id fiels in order to turn the dict into a list without loosing it
         # random.seed(self.preproc.split_seed)
 
-        splits = read_json(f'{os.path.dirname(datapath)}/splits.json')
         id_split_dict = {}
         data_ids = list(data_dict.keys())
         for id_sample in data_ids:
@@ -587,7 +652,8 @@ class MotionFixDataModule(BASEDataModule):
                         self.smpl_p,
                         self.rot_repr,
                         self.load_feats,
-                        text_aug_db), 
+                        text_aug_db,
+                        feature_cache=self.feature_cache), 
            MotionFixDataset([v for k, v in data_dict.items() 
                            if id_split_dict[k] == 1][:slice_val],
                         self.preproc.n_body_joints,
@@ -596,7 +662,7 @@ class MotionFixDataModule(BASEDataModule):
                         self.smpl_p,
                         self.rot_repr,
                         self.load_feats,
-                        ), 
+                        feature_cache=self.feature_cache), 
            MotionFixDataset(random.sample([v for k, v in data_dict.items() 
                                if id_split_dict[k] == 2], 
                               k=slice_test),
@@ -605,13 +671,55 @@ class MotionFixDataModule(BASEDataModule):
                         self.preproc.norm_type,
                         self.smpl_p,
                         self.rot_repr,
-                        self.load_feats) 
+                        self.load_feats,
+                        feature_cache=self.feature_cache) 
         )
         for splt in ['train', 'val', 'test']:
             log.info("Set up {} set with {} items."\
                      .format(splt, len(self.dataset[splt])))
         self.nfeats = self.dataset['train'].nfeats
 
+    def _setup_from_store(self, store_path, splits, proportion, text_aug_db):
+        """create the datasets as views over the memory-mapped feature store"""
+        train_ids, val_ids = set(splits['train']), set(splits['val'])
+        store = MotionFixFeatureStore(store_path)
+        store.splits = {k: 0 if k in train_ids else 1 if k in val_ids else 2
+                        for k in store.ids}
+        # precomputed features are only valid for the same preprocessing
+        store.with_feats = (
+            store.meta.get('rot_repr') == self.rot_repr and
+            store.meta.get('n_body_joints') == self.preproc.n_body_joints)
+        if not store.with_feats:
+            log.info(f'Feature store was built with {store.meta}, features '
+                     'will be computed on the fly.')
+        log.info(f'Loaded feature store from {store_path}.')
+        rows_per_split = {splt: [r for r, k in enumerate(store.ids)
+                                 if store.splits[k] == splt]
+                          for splt in [0, 1, 2]}
+
+        ds_args = (self.preproc.n_body_joints, self.preproc.stats_file,
+                   self.preproc.norm_type, self.smpl_p, self.rot_repr,
+                   self.load_feats)
+        self.stats = self.calculate_feature_stats(
+            MotionFixDataset(store.subset(rows_per_split[0] + rows_per_split[1]),
+                             *ds_args))
+        slice_train = int(proportion * len(splits['train']))
+        slice_val = int(proportion * len(splits['val']))
+        slice_test = int(0.5 * len(splits['test']))
+        self.dataset['train'] = MotionFixDataset(
+            store.subset(rows_per_split[0][:slice_train]), *ds_args, text_aug_db,
+            feature_cache=self.feature_cache)
+        self.dataset['val'] = MotionFixDataset(
+            store.subset(rows_per_split[1][:slice_val]), *ds_args,
+            feature_cache=self.feature_cache)
+        self.dataset['test'] = MotionFixDataset(
+            store.subset(random.sample(rows_per_split[2], k=slice_test)),
+            *ds_args, feature_cache=self.feature_cache)
+        for splt in ['train', 'val', 'test']:
+            log.info("Set up {} set with {} items."\
+                     .format(splt, len(self.dataset[splt])))
+        self.nfeats = self.dataset['train'].nfeats
+
     # def setup(self, stage):
     #     pass
 
@@ -643,25 +751,11 @@ class MotionFixDataModule(BASEDataModule):
         if not exists(stat_path):
             log.info(f"No dataset stats found. Calculating and saving to {stat_path}")
             
-            feature_names = dataset.get_all_features(0).keys()
-            feature_dict = {name.replace('_source', ''): [] for name in feature_names
-                            if '_target' not in name}
-            for i in tqdm(range(len(dataset))):
-                x = dataset.get_all_features(i)
-                for name in feature_names:
-                    x_new = x[name]
-                    name = name.replace('_source', '')
-                    name = name.replace('_target', '')
-                    if torch.is_tensor(x_new):
-                        feature_dict[name].append(x_new)
-            feature_dict = {name: torch.cat(feature_dict[name],
-                                            dim=0).float()
-                                             for name in feature_dict.keys()}
-            stats = {name: {'max': x.max(0)[0].numpy(),
-                            'min': x.min(0)[0].numpy(),
-                            'mean': x.mean(0).numpy(),
-                            'std': x.std(0).numpy()}
-                     for name, x in feature_dict.items()}
+            # single pass, O(feature dim) memory, partial moments computed
+            # by the dataloader workers
+            stats = compute_feature_stats(
+                dataset, num_workers=self.dataloader_options['num_workers'])
+            feature_names = list(stats.keys())
             
             # stats_source = {f'{name}_source': v for name, v in stats.items()}
             # stats_target = {f'{name}_target': v for name, v in stats.items()}
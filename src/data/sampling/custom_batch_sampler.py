@@ -1,6 +1,9 @@
+import logging
 import numpy as np
 import random
-from torch.utils.data import Sampler, ConcatDataset
+from torch.utils.data import BatchSampler, Sampler, ConcatDataset
+
+log = logging.getLogger(__name__)
 
 class PercBatchSampler(Sampler):
     def __init__(self, data_source, batch_size):
@@ -287,3 +290,97 @@ def mix_datasets_anysize(data_list):
                                                      num_samples=epoch_size,
                                                      replacement=False)
     return sampler
+
+
+def padding_efficiency(lengths, batches):
+    """fraction of the padded frames of the batches that are real frames"""
+    real = sum(int(lengths[b].sum()) for b in batches)
+    padded = sum(int(lengths[b].max()) * len(b) for b in batches)
+    return real / max(padded, 1)
+
+
+class LengthBucketBatchSampler(BatchSampler):
+    def __init__(self, sampler, lengths, batch_size, shuffle=True, noise=0.1,
+                 drop_last=False, seed=0):
+        """
+        Batches samples of similar length, so that padding each batch to its
+        longest sample wastes few frames. Samples are sorted by their length
+        multiplied by a random factor in [1 - noise, 1 + noise], so that the
+        batches change from epoch to epoch, and the order of the batches is
+        shuffled.
+
+        Under DDP, Lightning rebuilds the batch sampler with its
+        DistributedSampler as `sampler`: the number of replicas and the rank
+        are read from it. Every replica computes the same batches and takes
+        one in `num_replicas`, the batches are padded so that all the
+        replicas get the same number of batches. The order of `sampler`
+        itself is not used.
+
+        Args:
+            sampler (Sampler): The sampler of the dataset, a
+                DistributedSampler under DDP.
+            lengths (array): Length of each sample, i.e. max(source, target)
+                number of frames for motion pairs.
+            batch_size (int): Number of items in each batch.
+            shuffle (bool): Randomize the batches every epoch.
+            noise (float): Relative noise on the lengths when sorting.
+            drop_last (bool): Drop the last, incomplete, batch.
+            seed (int): Seed of the randomization, combined with the epoch.
+        """
+        super().__init__(sampler, batch_size, drop_last)
+        self.lengths = np.asarray(lengths)
+        self.shuffle = shuffle
+        self.noise = noise
+        self.num_replicas = getattr(sampler, 'num_replicas', 1)
+        self.rank = getattr(sampler, 'rank', 0)
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def _num_batches(self):
+        if self.drop_last:
+            return len(self.lengths) // self.batch_size
+        return (len(self.lengths) + self.batch_size - 1) // self.batch_size
+
+    def _all_batches(self):
+        """the batches of all the replicas, the same in every process"""
+        rng = np.random.default_rng(self.seed + self.epoch)
+        keys = self.lengths.astype(float)
+        if self.shuffle:
+            keys = keys * rng.uniform(1 - self.noise, 1 + self.noise,
+                                      size=len(keys))
+        order = np.argsort(keys, kind='stable')
+        batches = [order[i:i + self.batch_size]
+                   for i in range(0, self._num_batches() * self.batch_size,
+                                  self.batch_size)]
+        if self.shuffle:
+            batches = [batches[i] for i in rng.permutation(len(batches))]
+        # every replica gets the same number of batches
+        extra = -len(batches) % self.num_replicas
+        return batches + batches[:extra]
+
+    def __iter__(self):
+        batches = self._all_batches()
+        if self.rank == 0:
+            self.log_padding_efficiency(batches)
+        for batch in batches[self.rank::self.num_replicas]:
+            yield batch.tolist()
+
+    def log_padding_efficiency(self, batches=None):
+        """log the padding efficiency against randomly batching the samples"""
+        if batches is None:
+            batches = self._all_batches()
+        idx = np.random.default_rng(self.seed).permutation(len(self.lengths))
+        random_batches = [idx[i:i + self.batch_size]
+                          for i in range(0, len(idx), self.batch_size)]
+        bucketed = padding_efficiency(self.lengths, batches)
+        unbucketed = padding_efficiency(self.lengths, random_batches)
+        log.info(f'Length bucketing: {100 * bucketed:.1f}% of the padded '
+                 f'frames are real frames ({100 * unbucketed:.1f}% with '
+                 'random batches).')
+        return bucketed, unbucketed
+
+    def __len__(self):
+        return (self._num_batches() + self.num_replicas - 1) // self.num_replicas
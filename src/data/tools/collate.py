@@ -15,12 +15,9 @@ def length_to_mask(length, device: torch.device = None) -> Tensor:
     ) < length.unsqueeze(1)
     return mask
 
-def collate_batch_last_padding(batch, feats):
-    t2m = True
-    for batch_items in batch:
-        for bk in batch_items.keys():
-            if 'source' in bk:
-                t2m = False
+def collate_batch_last_padding(batch, feats, pin_memory=False):
+    t2m = not any('source' in bk for batch_items in batch
+                  for bk in batch_items.keys())
     if not t2m:
         feats_src = [f'{featype}_source' for featype in feats]
         feats_tgt = [f'{featype}_target' for featype in feats]
@@ -28,7 +25,6 @@ def collate_batch_last_padding(batch, feats):
     else:
         feats_tgt = [f'{featype}_target' for featype in feats]
         tot_feats = feats_tgt
-        t2m = True
 
     # this should be used only when we mix hml3d with other datasets
     # check if we need to duplicate the _target features as _source features
@@ -44,14 +40,61 @@ def collate_batch_last_padding(batch, feats):
                         else:
                             b[k.replace('target', 'source')] = torch.zeros_like(b[k])
 
-    batch = pad_batch(batch, tot_feats, t2m=t2m)
-    batch =  {k: torch.stack([b[k] for b in batch])\
-              if k in tot_feats or k.endswith('_norm') else [b[k] for b in batch]
-              for k in batch[0].keys()}
-    
-    return batch
+    # pad to the longest motion by repeating the last frame
+    # we do NOT zero pad to avoid wierd values in normalisation later in the model
+    ref_lengths = {ref: [len(b[ref]) for b in batch]
+                   for ref in ['body_pose_source', 'body_pose_target']
+                   if ref in batch[0]}
+    collated = {}
+    for k in batch[0].keys():
+        values = [b[k] for b in batch]
+        if k in tot_feats or k.endswith('_norm'):
+            ref = 'body_pose_source' if not t2m and '_source' in k \
+                else 'body_pose_target'
+            lengths = ref_lengths[ref]
+            # every sample gets max - len frames of padding
+            max_len = len(values[0]) + max(lengths) - lengths[0]
+            collated[k] = collate_replicate_padding(values, max_len,
+                                                    pin_memory=pin_memory)
+        else:
+            collated[k] = values
+    collated['task'] = ['t2m' if t2m else 'edit'] * len(batch)
+    return collated
+
+def _replicate_pad_index(lengths: List[int], max_len: int) -> Tensor:
+    """
+    indices into the concatenation of sequences of the given lengths, that
+    pad each sequence to max_len frames by repeating its last frame
+    """
+    lengths = torch.tensor(lengths)
+    offsets = torch.cumsum(lengths, 0) - lengths
+    frames = torch.arange(max_len)
+    index = torch.minimum(frames[None], (lengths - 1)[:, None])
+    return (offsets[:, None] + index).flatten()
+
+def collate_replicate_padding(batch: List[Tensor], max_len: int = None,
+                              pin_memory: bool = False) -> Tensor:
+    """
+    stack sequences padded to max_len frames by repeating their last frame,
+    with a single gather into one (optionally pinned) output buffer
+    """
+    lengths = [len(b) for b in batch]
+    if max_len is None:
+        max_len = max(lengths)
+    flat = torch.cat(batch)
+    index = _replicate_pad_index(lengths, max_len)
+    out = torch.empty((len(batch) * max_len, *flat.shape[1:]),
+                      dtype=flat.dtype,
+                      pin_memory=pin_memory and torch.cuda.is_available())
+    torch.index_select(flat, 0, index, out=out)
+    return out.view(len(batch), max_len, *flat.shape[1:])
 
 def collate_tensor_with_padding(batch: List[Tensor]) -> Tensor:
+    if batch[0].dim() > 0 and all(b.shape[1:] == batch[0].shape[1:]
+                                  for b in batch):
+        # only the first dimension differs, zero pad with one copy per tensor
+        from torch.nn.utils.rnn import pad_sequence
+        return pad_sequence(batch, batch_first=True)
     dims = batch[0].dim()
     max_size = [max([b.size(i) for b in batch]) for i in range(dims)]
     size = (len(batch), ) + tuple(max_size)
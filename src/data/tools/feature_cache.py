@@ -0,0 +1,134 @@
+"""
+On-disk cache for the features computed by `MotionFixDataset`.
+
+The feature getters are deterministic functions of the raw SMPL-H params, so
+their outputs are cached per (sample id, motion, feature name). Entries are
+versioned by a hash of the source of the module defining the getter (with the
+dataset helpers they call), of the modules the getters rely on (rotations,
+geometry, SMPL forward) and of the dataset settings that change them, so
+editing a feature simply writes to a new directory instead of serving stale
+values. The cache is opt-in (`feature_cache` in the data config).
+
+Layout of the cache directory:
+    <feature>-<code hash>/<sample id>_<source|target>.npy
+
+The cache is filled lazily by the dataset, or ahead of time with:
+    python -m src.data.tools.feature_cache --datapath data/motionfix-dataset/motionfix.pth.tar \
+        --cache-dir data/motionfix-dataset/feature_cache
+"""
+import hashlib
+import inspect
+import logging
+import os
+from os.path import exists, join
+from typing import Callable, Dict
+
+import numpy as np
+import torch
+
+import src.model.utils.smpl_fast as smpl_fast
+import src.tools.geometry as geometry
+import src.tools.transforms3d as transforms3d
+
+log = logging.getLogger(__name__)
+
+CACHE_VERSION = 2
+# modules the feature getters call into, besides the one defining them
+FEATURE_DEPENDENCIES = (transforms3d, geometry, smpl_fast)
+
+
+def feature_code_hash(method: Callable, extra_key: str = '') -> str:
+    """
+    hash of the code that produces a feature: the whole module of the getter,
+    so that its helpers are covered, and FEATURE_DEPENDENCIES
+    """
+    h = hashlib.sha1()
+    h.update(f'v{CACHE_VERSION}'.encode())
+    h.update(inspect.getsource(inspect.getmodule(method)).encode())
+    for module in FEATURE_DEPENDENCIES:
+        h.update(inspect.getsource(module).encode())
+    h.update(extra_key.encode())
+    return h.hexdigest()[:12]
+
+
+class FeatureCache:
+    """
+    Args:
+        cache_dir: root directory of the cache
+        feat_methods: feature name -> getter, as in `_feat_get_methods`
+        extra_key: settings the features depend on (e.g. rot_repr)
+    """
+    def __init__(self, cache_dir: str, feat_methods: Dict[str, Callable],
+                 extra_key: str = ''):
+        self.cache_dir = cache_dir
+        self.feat_dirs = {feat: join(cache_dir,
+                                     f'{feat}-{feature_code_hash(m, extra_key)}')
+                          for feat, m in feat_methods.items()}
+        for d in self.feat_dirs.values():
+            os.makedirs(d, exist_ok=True)
+
+    def _path(self, sample_id: str, motion: str, feat: str) -> str:
+        side = motion.replace('motion_', '')
+        return join(self.feat_dirs[feat], f'{sample_id}_{side}.npy')
+
+    def get(self, sample_id: str, motion: str, feat: str):
+        path = self._path(sample_id, motion, feat)
+        if not exists(path):
+            return None
+        try:
+            return torch.from_numpy(np.load(path))
+        except (ValueError, OSError, EOFError):
+            # a partially written file from an interrupted run
+            log.warning(f'Corrupted feature cache entry {path}, recomputing.')
+            return None
+
+    def put(self, sample_id: str, motion: str, feat: str, x: torch.Tensor):
+        path = self._path(sample_id, motion, feat)
+        # write then rename, workers may race on the same entry
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.save(f, x.detach().cpu().numpy())
+        os.replace(tmp_path, path)
+
+    def get_or_compute(self, sample_id: str, motion: str, feat: str,
+                       compute: Callable):
+        x = self.get(sample_id, motion, feat)
+        if x is None:
+            x = compute()
+            self.put(sample_id, motion, feat, x)
+        return x
+
+
+if __name__ == '__main__':
+    import argparse
+
+    import joblib
+    from src.utils.genutils import cast_dict_to_tensors
+
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Prebuild the feature cache of MotionFix.")
+    parser.add_argument("--datapath", type=str, required=True,
+                        help="Path to the joblib dataset (motionfix.pth.tar)")
+    parser.add_argument("--cache-dir", type=str, required=True,
+                        help="Root directory of the cache")
+    parser.add_argument("--load-feats", type=str, nargs='*',
+                        default=["body_transl_delta_pelv", "body_orient_xy",
+                                 "z_orient_delta", "body_pose",
+                                 "body_joints_local_wo_z_rot"])
+    parser.add_argument("--n-body-joints", type=int, default=22)
+    parser.add_argument("--rot-repr", type=str, default='6d')
+    args = parser.parse_args()
+
+    from src.data.motionfix import MotionFixDataset
+
+    log.info(f'...Loading data from {args.datapath}...')
+    data_dict = cast_dict_to_tensors(joblib.load(args.datapath))
+    for k, v in data_dict.items():
+        v['id'] = k
+        v['split'] = 0
+    dataset = MotionFixDataset([v for v in data_dict.values()],
+                               args.n_body_joints, '', 'std',
+                               rot_repr=args.rot_repr,
+                               load_feats=args.load_feats,
+                               feature_cache=args.cache_dir)
+    dataset.prebuild_feature_cache()
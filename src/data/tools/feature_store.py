@@ -0,0 +1,264 @@
+"""
+Columnar, memory-mapped store for the MotionFix dataset.
+
+The joblib pickle of the dataset takes minutes to load and every forked
+DataLoader worker ends up touching its own copy of it. The store is built once
+offline and afterwards the dataset only slices frames out of `.npy` shards that
+are opened with `np.load(..., mmap_mode='c')`, so all workers share the same
+pages of the page cache.
+
+Layout of a store directory:
+    index.json                      ids, texts, per-motion frame offsets,
+                                    field shapes and build metadata
+    motion_source.rots.npy          raw SMPL-H params of all source motions
+    motion_source.trans.npy         concatenated along the frame axis
+    motion_source.joint_positions.npy
+    motion_source.feat.<name>.npy   derived features (optional)
+    motion_target.*.npy             same for the target motions
+
+Build it with:
+    python -m src.data.tools.feature_store --datapath data/motionfix-dataset/motionfix.pth.tar \
+        --out data/motionfix-dataset/motionfix_store
+"""
+import logging
+import os
+from copy import copy
+from os.path import exists, join
+from typing import Dict, List
+
+import numpy as np
+import torch
+
+from src.utils.file_io import read_json, write_json
+
+log = logging.getLogger(__name__)
+
+MOTION_KEYS = ('motion_source', 'motion_target')
+INDEX_FILE = 'index.json'
+STORE_VERSION = 1
+
+
+def _shard_path(store_dir: str, motion: str, field: str) -> str:
+    return join(store_dir, f'{motion}.{field}.npy')
+
+
+def _to_numpy(x):
+    if torch.is_tensor(x):
+        return x.detach().cpu().float().numpy()
+    return np.asarray(x, dtype=np.float32)
+
+
+def is_feature_store(path: str) -> bool:
+    return path is not None and exists(join(path, INDEX_FILE))
+
+
+def build_feature_store(data_dict: Dict[str, dict], out_dir: str,
+                        feat_dataset=None, load_feats: List[str] = None):
+    """
+    Write the dataset into a memory-mapped feature store.
+
+    Args:
+        data_dict: the dataset as loaded from the joblib file
+            {id: {'motion_source': {...}, 'motion_target': {...}, 'text': str}}
+        out_dir: directory of the store
+        feat_dataset: a MotionFixDataset whose feature getters are used to
+            precompute `load_feats`. If None only the raw params are stored.
+        load_feats: the derived features to precompute.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    ids = list(data_dict.keys())
+    load_feats = list(load_feats) if feat_dataset is not None and load_feats else []
+
+    # first pass: frame counts and per-frame shapes of every field
+    lengths = {m: np.zeros(len(ids), dtype=np.int64) for m in MOTION_KEYS}
+    fields = {m: {} for m in MOTION_KEYS}
+    for row, k in enumerate(ids):
+        for m in MOTION_KEYS:
+            motion = data_dict[k][m]
+            nframes = motion['rots'].shape[0]
+            lengths[m][row] = nframes
+            for field, val in motion.items():
+                if not hasattr(val, 'shape') or len(val.shape) == 0:
+                    continue
+                if val.shape[0] != nframes:
+                    continue
+                shape = list(val.shape[1:])
+                if field == 'rots' and len(shape) > 1:
+                    # the dataset keeps rots flattened as F x (J*3)
+                    shape = [int(np.prod(shape))]
+                fields[m].setdefault(field, shape)
+
+    offsets = {m: np.concatenate([[0], np.cumsum(lengths[m])]) for m in MOTION_KEYS}
+    shards = {m: {} for m in MOTION_KEYS}
+    feat_shapes = {m: {} for m in MOTION_KEYS}
+    for m in MOTION_KEYS:
+        total = int(offsets[m][-1])
+        for field, shape in fields[m].items():
+            shards[m][field] = np.lib.format.open_memmap(
+                _shard_path(out_dir, m, field), mode='w+',
+                dtype=np.float32, shape=(total, *shape))
+
+    # second pass: fill the shards
+    for row, k in enumerate(ids):
+        for m in MOTION_KEYS:
+            s, e = offsets[m][row], offsets[m][row + 1]
+            motion = data_dict[k][m]
+            for field, shard in shards[m].items():
+                shard[s:e] = _to_numpy(motion[field]).reshape(e - s, *shard.shape[1:])
+            for feat in load_feats:
+                x = _to_numpy(feat_dataset._feat_get_methods[feat](motion))
+                if feat not in feat_shapes[m]:
+                    feat_shapes[m][feat] = list(x.shape[1:])
+                    shards[m][f'feat.{feat}'] = np.lib.format.open_memmap(
+                        _shard_path(out_dir, m, f'feat.{feat}'), mode='w+',
+                        dtype=np.float32,
+                        shape=(int(offsets[m][-1]), *x.shape[1:]))
+                shards[m][f'feat.{feat}'][s:e] = x
+
+    for m in MOTION_KEYS:
+        for shard in shards[m].values():
+            shard.flush()
+
+    meta = {}
+    if feat_dataset is not None:
+        meta = {'rot_repr': feat_dataset.rot_repr,
+                'n_body_joints': feat_dataset.n_body_joints}
+    index = {'version': STORE_VERSION,
+             'ids': ids,
+             'text': [data_dict[k]['text'] for k in ids],
+             'offsets': {m: offsets[m].tolist() for m in MOTION_KEYS},
+             'fields': fields,
+             'feats': feat_shapes,
+             'meta': meta}
+    write_json(index, join(out_dir, INDEX_FILE))
+    log.info(f'Wrote feature store with {len(ids)} samples to {out_dir}.')
+
+
+class MotionFixFeatureStore:
+    """
+    Read-only, list-like view over a feature store. Indexing returns a datum
+    with the same structure as an entry of the joblib dataset, with an extra
+    'feats' dict per motion holding the precomputed features.
+
+    Args:
+        store_dir: directory created by `build_feature_store`
+        rows: rows of the store visible through this view (default all)
+        splits: split id (0 train, 1 val, 2 test) per sample id
+        with_feats: expose the precomputed features. Disable it when they were
+            built with a different rot_repr/n_body_joints than the dataset's.
+    """
+    def __init__(self, store_dir: str, rows: List[int] = None,
+                 splits: Dict[str, int] = None, with_feats: bool = True):
+        self.store_dir = store_dir
+        self.index = read_json(join(store_dir, INDEX_FILE))
+        if self.index.get('version') != STORE_VERSION:
+            raise ValueError(f'Feature store in {store_dir} has version '
+                             f'{self.index.get("version")}, expected '
+                             f'{STORE_VERSION}. Rebuild it.')
+        self.ids = self.index['ids']
+        self.offsets = {m: np.asarray(self.index['offsets'][m], dtype=np.int64)
+                        for m in MOTION_KEYS}
+        self.rows = list(range(len(self.ids))) if rows is None else list(rows)
+        self.splits = splits or {}
+        self.with_feats = with_feats
+        self._shards = None
+
+    @property
+    def meta(self):
+        return self.index['meta']
+
+    def feats(self, motion: str = 'motion_source'):
+        return list(self.index['feats'][motion].keys())
+
+    def _open(self):
+        # opened lazily so that each worker maps the files itself
+        # copy-on-write keeps the pages shared while giving writable arrays
+        self._shards = {m: {} for m in MOTION_KEYS}
+        for m in MOTION_KEYS:
+            for field in self.index['fields'][m]:
+                self._shards[m][field] = np.load(_shard_path(self.store_dir,
+                                                             m, field),
+                                                 mmap_mode='c')
+            if not self.with_feats:
+                continue
+            for feat in self.index['feats'][m]:
+                self._shards[m][f'feat.{feat}'] = np.load(
+                    _shard_path(self.store_dir, m, f'feat.{feat}'),
+                    mmap_mode='c')
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_shards'] = None
+        return state
+
+    def __len__(self):
+        return len(self.rows)
+
+    def subset(self, rows: List[int]):
+        """view over some rows (given as positions in this view)"""
+        view = copy(self)
+        view.rows = [self.rows[r] for r in rows]
+        view._shards = None
+        return view
+
+    def length(self, idx: int, motion: str) -> int:
+        row = self.rows[idx]
+        return int(self.offsets[motion][row + 1] - self.offsets[motion][row])
+
+    def __getitem__(self, idx: int):
+        if self._shards is None:
+            self._open()
+        row = self.rows[idx]
+        datum = {}
+        for m in MOTION_KEYS:
+            s, e = self.offsets[m][row], self.offsets[m][row + 1]
+            motion = {'feats': {}}
+            for name, shard in self._shards[m].items():
+                x = torch.from_numpy(shard[s:e])
+                if name.startswith('feat.'):
+                    motion['feats'][name[len('feat.'):]] = x
+                else:
+                    motion[name] = x
+            datum[m] = motion
+        datum['text'] = self.index['text'][row]
+        datum['id'] = self.ids[row]
+        datum['split'] = self.splits.get(self.ids[row], 2)
+        return datum
+
+
+if __name__ == '__main__':
+    import argparse
+
+    import joblib
+    from src.utils.genutils import cast_dict_to_tensors
+
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Build the memory-mapped feature store of MotionFix.")
+    parser.add_argument("--datapath", type=str, required=True,
+                        help="Path to the joblib dataset (motionfix.pth.tar)")
+    parser.add_argument("--out", type=str, required=True,
+                        help="Output directory of the store")
+    parser.add_argument("--load-feats", type=str, nargs='*',
+                        default=["body_transl_delta_pelv", "body_orient_xy",
+                                 "z_orient_delta", "body_pose",
+                                 "body_joints_local_wo_z_rot"],
+                        help="Derived features to precompute")
+    parser.add_argument("--n-body-joints", type=int, default=22)
+    parser.add_argument("--rot-repr", type=str, default='6d')
+    args = parser.parse_args()
+
+    from src.data.motionfix import MotionFixDataset
+
+    log.info(f'...Loading data from {args.datapath}...')
+    data_dict = cast_dict_to_tensors(joblib.load(args.datapath))
+    for k, v in data_dict.items():
+        # the feature getters do not depend on these, __getitem__ needs them
+        v['id'] = k
+        v['split'] = 0
+    feat_dataset = None
+    if args.load_feats:
+        feat_dataset = MotionFixDataset([v for v in data_dict.values()],
+                                        args.n_body_joints, '', 'std',
+                                        rot_repr=args.rot_repr,
+                                        load_feats=args.load_feats)
+    build_feature_store(data_dict, args.out, feat_dataset, args.load_feats)
@@ -0,0 +1,143 @@
+"""
+Batches copied to the device ahead of the step.
+
+The prefetcher keeps `depth` batches in flight: their host tensors are pinned
+and copied with non-blocking copies on a side CUDA stream, so that the copy of
+the next batches overlaps with the compute of the current one. The step stream
+waits on the copy of its batch only. On CPU the batches are passed through.
+
+The time the loop is blocked on the DataLoader is recorded per batch, it is
+the input stall of the training loop. The wait of each yielded batch is queued
+in order, so that a consumer that fetches ahead (the Lightning loop does)
+still reads the wait of the batch of its current step with `pop_wait_ms`.
+The sampler and batch sampler of the DataLoader are exposed, so that the
+trainer calls their `set_epoch`.
+
+    loader = DevicePrefetcher(DataLoader(dataset, pin_memory=True, ...),
+                              device=torch.device('cuda'), depth=2)
+    for batch in loader:
+        ...
+    loader.pop_wait_ms(), loader.wait_stats()
+"""
+import time
+from collections import deque
+
+import numpy as np
+import torch
+
+
+def move_to_device(data, device: torch.device, non_blocking: bool = False,
+                   pin: bool = False):
+    """tensors of nested dicts/lists/tuples moved to device, the rest as is"""
+    if isinstance(data, torch.Tensor):
+        if pin and data.device.type == 'cpu' and not data.is_pinned():
+            data = data.pin_memory()
+        return data.to(device, non_blocking=non_blocking)
+    if isinstance(data, dict):
+        return {k: move_to_device(v, device, non_blocking, pin)
+                for k, v in data.items()}
+    if isinstance(data, (list, tuple)):
+        return type(data)(move_to_device(v, device, non_blocking, pin)
+                          for v in data)
+    return data
+
+
+def _record_stream(data, stream):
+    # the memory of tensors allocated on the side stream is not reused
+    # before the work of `stream` on them is done
+    if isinstance(data, torch.Tensor):
+        if data.is_cuda:
+            data.record_stream(stream)
+    elif isinstance(data, dict):
+        for v in data.values():
+            _record_stream(v, stream)
+    elif isinstance(data, (list, tuple)):
+        for v in data:
+            _record_stream(v, stream)
+
+
+class DevicePrefetcher:
+    """
+    Args:
+        loader: the DataLoader, any iterable of batches
+        device: the device the batches are moved to
+        depth: batches copied ahead of the one in use
+        history: number of wait times kept for the stats
+    """
+    def __init__(self, loader, device: torch.device, depth: int = 2,
+                 history: int = 1000):
+        self.loader = loader
+        self.device = torch.device(device)
+        self.depth = max(depth, 1)
+        self.wait_ms = deque(maxlen=history)
+        self._yielded_wait_ms = deque()
+
+    def __len__(self):
+        return len(self.loader)
+
+    @property
+    def sampler(self):
+        return getattr(self.loader, 'sampler', None)
+
+    @property
+    def batch_sampler(self):
+        return getattr(self.loader, 'batch_sampler', None)
+
+    def pop_wait_ms(self):
+        """wait of the oldest yielded batch not popped yet, None if none"""
+        if not self._yielded_wait_ms:
+            return None
+        return self._yielded_wait_ms.popleft()
+
+    def __iter__(self):
+        use_cuda = self.device.type == 'cuda' and torch.cuda.is_available()
+        stream = torch.cuda.Stream(self.device) if use_cuda else None
+        batches = iter(self.loader)
+        in_flight = deque()
+        self._yielded_wait_ms.clear()
+
+        def fetch():
+            start = time.perf_counter()
+            try:
+                batch = next(batches)
+            except StopIteration:
+                return False
+            wait_ms = (time.perf_counter() - start) * 1e3
+            event = None
+            if use_cuda:
+                with torch.cuda.stream(stream):
+                    batch = move_to_device(batch, self.device,
+                                           non_blocking=True, pin=True)
+                    event = torch.cuda.Event()
+                    event.record(stream)
+            else:
+                batch = move_to_device(batch, self.device)
+            in_flight.append((batch, event, wait_ms))
+            return True
+
+        for _ in range(self.depth):
+            if not fetch():
+                break
+        while in_flight:
+            batch, event, wait_ms = in_flight.popleft()
+            if event is not None:
+                current = torch.cuda.current_stream(self.device)
+                current.wait_event(event)
+                _record_stream(batch, current)
+            self._yielded_wait_ms.append(wait_ms)
+            self.wait_ms.append(wait_ms)
+            yield batch
+            fetch()
+
+    def wait_stats(self) -> dict:
+        """mean, p50 and max wait on the DataLoader in ms"""
+        if not self.wait_ms:
+            return {}
+        wait_ms = np.array(self.wait_ms)
+        return {'mean_ms': float(wait_ms.mean()),
+                'p50_ms': float(np.percentile(wait_ms, 50)),
+                'max_ms': float(wait_ms.max())}
+
+    def reset(self):
+        self.wait_ms.clear()
+        self._yielded_wait_ms.clear()
@@ -0,0 +1,121 @@
+"""
+Streaming normalization statistics.
+
+The statistics of every feature are accumulated in a single pass over the
+dataset with Welford's algorithm and partial results (e.g. of DataLoader
+workers) are combined with the parallel merge of Chan et al., so memory stays
+O(feature dim) instead of holding every frame of the dataset.
+"""
+import logging
+from typing import Dict
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader, Dataset
+
+log = logging.getLogger(__name__)
+
+
+class RunningMoments:
+    """
+    Count, mean, sum of squared deviations, min and max of a stream of
+    [N, *feat_shape] arrays, accumulated in float64.
+    """
+    def __init__(self):
+        self.count = 0
+        self.mean = None
+        self.m2 = None
+        self.min = None
+        self.max = None
+        self.feat_shape = None
+
+    def update(self, x):
+        if torch.is_tensor(x):
+            x = x.detach().cpu().numpy()
+        x = np.asarray(x, dtype=np.float64)
+        if len(x) == 0:
+            return self
+        batch = RunningMoments()
+        batch.feat_shape = x.shape[1:]
+        x = x.reshape(len(x), -1)
+        batch.count = len(x)
+        batch.mean = x.mean(0)
+        batch.m2 = ((x - batch.mean)**2).sum(0)
+        batch.min = x.min(0)
+        batch.max = x.max(0)
+        return self.merge(batch)
+
+    def merge(self, other: 'RunningMoments'):
+        if other.count == 0:
+            return self
+        if self.count == 0:
+            self.count, self.feat_shape = other.count, other.feat_shape
+            self.mean, self.m2 = other.mean.copy(), other.m2.copy()
+            self.min, self.max = other.min.copy(), other.max.copy()
+            return self
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean = self.mean + delta * (other.count / count)
+        self.m2 = self.m2 + other.m2 + delta**2 * (self.count * other.count / count)
+        self.min = np.minimum(self.min, other.min)
+        self.max = np.maximum(self.max, other.max)
+        self.count = count
+        return self
+
+    def std(self, ddof: int = 1):
+        return np.sqrt(self.m2 / (self.count - ddof))
+
+    def to_stats(self) -> Dict[str, np.ndarray]:
+        """max/min/mean/std (unbiased, as torch.std) in float32"""
+        as_feat = lambda x: x.reshape(self.feat_shape).astype(np.float32)
+        return {'max': as_feat(self.max),
+                'min': as_feat(self.min),
+                'mean': as_feat(self.mean),
+                'std': as_feat(self.std())}
+
+
+def _feature_name(name: str) -> str:
+    # source and target motions share the statistics of a feature
+    return name.replace('_source', '').replace('_target', '')
+
+
+class _StatsChunks(Dataset):
+    """each item is the moments of the features of a chunk of samples"""
+    def __init__(self, dataset, chunk_size: int):
+        self.dataset = dataset
+        self.chunk_size = chunk_size
+
+    def __len__(self):
+        return (len(self.dataset) + self.chunk_size - 1) // self.chunk_size
+
+    def __getitem__(self, chunk):
+        moments = {}
+        start = chunk * self.chunk_size
+        for i in range(start, min(start + self.chunk_size, len(self.dataset))):
+            for name, x in self.dataset.get_all_features(i).items():
+                if torch.is_tensor(x):
+                    moments.setdefault(_feature_name(name),
+                                       RunningMoments()).update(x)
+        return moments
+
+
+def compute_feature_stats(dataset, num_workers: int = 0,
+                          chunk_size: int = 64, progress: bool = True):
+    """
+    Args:
+        dataset: a dataset with `get_all_features(idx)` returning the
+            per-frame features of both motions of a sample
+        num_workers: DataLoader workers computing partial moments
+        chunk_size: samples per partial result
+        progress: show a progress bar
+    returns:
+        {feature: {'max', 'min', 'mean', 'std'}} as in the stats files
+    """
+    from tqdm import tqdm
+    loader = DataLoader(_StatsChunks(dataset, chunk_size), batch_size=None,
+                        num_workers=num_workers, collate_fn=lambda x: x)
+    moments = {}
+    for partial in tqdm(loader, disable=not progress):
+        for name, m in partial.items():
+            moments.setdefault(name, RunningMoments()).merge(m)
+    return {name: m.to_stats() for name, m in moments.items()}
@@ -85,6 +85,8 @@ class SpacedDiffusion(GaussianDiffusion):
                 self.timestep_map.append(i)
         kwargs["betas"] = np.array(new_betas)
         super().__init__(**kwargs)
+        # cached per device like the other schedule arrays
+        self.timestep_map_array = np.array(self.timestep_map, dtype=np.int64)
 
     def p_mean_variance(
         self, model, *args, **kwargs
@@ -106,23 +108,33 @@ class SpacedDiffusion(GaussianDiffusion):
         if isinstance(model, _WrappedModel):
             return model
         return _WrappedModel(
-            model, self.timestep_map, self.original_num_steps
+            model, self.timestep_map, self.original_num_steps,
+            map_tensor_fn=self._timestep_map_tensor
         )
 
+    def _timestep_map_tensor(self, device, dtype):
+        return self._schedule_tensor("timestep_map_array", device, dtype)
+
     def _scale_timesteps(self, t):
         # Scaling is done by the wrapped model.
         return t
 
 
 class _WrappedModel:
-    def __init__(self, model, timestep_map, original_num_steps):
+    def __init__(self, model, timestep_map, original_num_steps,
+                 map_tensor_fn=None):
         self.model = model
         self.timestep_map = timestep_map
         # self.rescale_timesteps = rescale_timesteps
         self.original_num_steps = original_num_steps
+        # (device, dtype) -> timestep_map tensor, cached by the diffusion
+        self.map_tensor_fn = map_tensor_fn
 
     def __call__(self, x, ts, **kwargs):
-        map_tensor = th.tensor(self.timestep_map, device=ts.device, dtype=ts.dtype)
+        if self.map_tensor_fn is not None:
+            map_tensor = self.map_tensor_fn(ts.device, ts.dtype)
+        else:
+            map_tensor = th.tensor(self.timestep_map, device=ts.device, dtype=ts.dtype)
         new_ts = map_tensor[ts]
         # if self.rescale_timesteps:
         #     new_ts = new_ts.float() * (1000.0 / self.original_num_steps)
@@ -28,6 +28,7 @@ log = logging.getLogger(__name__)
 # Monkey patch SMPLH faster
 from src.model.utils.smpl_fast import smpl_forward_fast
 from src.utils.file_io import hack_path
+from src.tools.tracing import TRACER, traced
 
 class BaseModel(LightningModule):
     def __init__(self, statistics_path: str, nfeats: int, 
@@ -35,7 +36,7 @@ class BaseModel(LightningModule):
                  input_feats: List[str], 
                  dim_per_feat: List[int],
                  smpl_path: str, num_vids_to_render: str,
-                 renderer, *args, **kwargs):
+                 renderer, render_workers: int = 0, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.save_hyperparameters(logger=False, 
                                   ignore=['eval_model','renderer']) # ignore TEMOS score
@@ -70,6 +71,10 @@ class BaseModel(LightningModule):
         self.input_feats = list(input_feats)
         self.num_vids_to_render = num_vids_to_render
         smpl_path = hack_path(smpl_path, keyword='data')
+        # videos are rendered on a pool of worker processes when > 0
+        self.render_workers = render_workers
+        self.body_models_path = smpl_path
+        self._render_pool = None
 
         from aitviewer.models.smpl import SMPLLayer
         if renderer is not None:
@@ -82,6 +87,10 @@ class BaseModel(LightningModule):
         self.paths_of_rendered_subset = []
         self.paths_of_rendered_subset_tgt = []
         self.paths_of_rendered_subset_src = []
+        # render pool jobs of the ground truth subset, see render_subset_gt_pooled
+        self._gt_render_jobs = None
+        # built on the first validation, kept for the whole run
+        self._tmr_evaluator = None
         # Need to define:
         # forward
         # allsplit_step()
@@ -98,6 +107,15 @@ class BaseModel(LightningModule):
         self.hparams.n_params_trainable = trainable
         self.hparams.n_params_nontrainable = nontrainable
 
+    def on_train_batch_start(self, batch, batch_idx):
+        # input stall of the step, measured by the device prefetcher
+        datamodule = getattr(self.trainer, 'datamodule', None)
+        prefetcher = getattr(datamodule, 'prefetchers', {}).get('train')
+        wait_ms = prefetcher.pop_wait_ms() if prefetcher is not None else None
+        if wait_ms is not None:
+            self.log('data/wait_ms', wait_ms, on_step=True, on_epoch=True,
+                     batch_size=1)
+
     def on_before_optimizer_step(self, optimizer):
         # Compute the 2-norm for each layer
         # If using mixed precision, the gradients are already unscaled here
@@ -111,6 +129,7 @@ class BaseModel(LightningModule):
         stats = np.load(path, allow_pickle=True)[()]
         return cast_dict_to_tensors(stats, device=device)
 
+    @traced('smpl_forward')
     def run_smpl_fwd(self, body_transl, body_orient, body_pose, fast=True):
         if len(body_transl.shape) > 2:
             body_transl = body_transl.flatten(0, 1)
@@ -253,26 +272,30 @@ class BaseModel(LightningModule):
 
         return batch
 
+    def _stats_on_device(self, stats):
+        """the stats of a feature, moved to the model device once and kept there"""
+        if stats['mean'].device != self.device:
+            for k, v in stats.items():
+                stats[k] = v.to(self.device)
+        return stats
+
     def norm(self, x, stats):
+        stats = self._stats_on_device(stats)
         if self.norm_type == "standardize":
-            mean = stats['mean'].to(self.device)
-            std = stats['std'].to(self.device)
-            return (x - mean) / (2*(std + 1e-5))
+            return (x - stats['mean']) / (2*(stats['std'] + 1e-5))
         elif self.norm_type == "min_max":
-            max = stats['max'].to(self.device)
-            min = stats['min'].to(self.device)
+            max, min = stats['max'], stats['min']
             assert ((x - min) / (max - min + 1e-5)).min() >= 0
             assert ((x - min) / (max - min + 1e-5)).max() <= 1
             return (x - min) / (max - min + 1e-5)
 
+    @traced('unnorm')
     def unnorm(self, x, stats):
+        stats = self._stats_on_device(stats)
         if self.norm_type == "standardize":
-            mean = stats['mean'].to(self.device)
-            std = stats['std'].to(self.device)
-            return x * 2 * (std + 1e-5) + mean
+            return x * 2 * (stats['std'] + 1e-5) + stats['mean']
         elif self.norm_type == "min_max":
-            max = stats['max'].to(self.device)
-            min = stats['min'].to(self.device)
+            max, min = stats['max'], stats['min']
             return x * (max - min + 1e-5) + min
 
     def unnorm_state(self, state_norm: Tensor) -> Tensor:
@@ -334,8 +357,32 @@ class BaseModel(LightningModule):
             x_unnorm.append(self.unnorm(x, self.stats[name]))
         return x_unnorm
 
+    @property
+    def render_pool(self):
+        if self.render_workers and self._render_pool is None:
+            from src.render.render_pool import RenderPool
+            self._render_pool = RenderPool(self.body_models_path,
+                                           num_workers=self.render_workers)
+        return self._render_pool
+
+    def log_rendered_videos(self, wait: bool = False):
+        # videos submitted in earlier epochs that are done by now
+        if self._render_pool is None:
+            return
+        log_render_dic = {tag: wandb.Video(v, fps=30, format='mp4')
+                          for tag, v in self._render_pool.collect(wait=wait)
+                          if tag is not None}
+        if log_render_dic and self.logger is not None:
+            self.logger.experiment.log(log_render_dic)
+
+    def on_fit_end(self):
+        if self._render_pool is not None:
+            self.log_rendered_videos(wait=True)
+            self._render_pool.close()
+            self._render_pool = None
+
     @torch.no_grad()
-    def render_gens_set(self, buffer: list[dict]):
+    def render_gens_set(self, buffer: list[dict], stack_with=None):
         from src.render.video import stack_vids
         from tqdm import tqdm
         novids = self.num_vids_to_render
@@ -361,6 +408,18 @@ class BaseModel(LightningModule):
                     mot_to_rend = {bd_f: bd_v[iid_tor].detach().cpu()
                                     for bd_f, bd_v in gen_motion.items()}
 
+                    if self.render_pool is not None:
+                        # stacked and captioned in the same encode, logged
+                        # by log_rendered_videos once it is done
+                        logname = f'{data_variant}/{cur_key}_{data_variant.split("_")[0]}'
+                        fname = folder/f'{cur_key}_{data_variant}_{epo}_txt.mp4'
+                        self.render_pool.submit(mot_to_rend, fname,
+                                                text=cur_text,
+                                                stack_with=stack_with[iid_tor] if stack_with else None,
+                                                color=color_map['generation'],
+                                                tag=logname)
+                        video_names_cur.append(str(fname))
+                        continue
                     # RENDER THE MOTION
                     fname = render_motion(self.renderer, mot_to_rend,
                                         folder/f'{cur_key}_{data_variant}_{epo}',
@@ -376,6 +435,13 @@ class BaseModel(LightningModule):
 
         return video_names_all
 
+    @property
+    def tmr_evaluator(self):
+        if self._tmr_evaluator is None:
+            from tmr_evaluator.motion2motion_retr import TMRRetrievalEvaluator
+            self._tmr_evaluator = TMRRetrievalEvaluator()
+        return self._tmr_evaluator
+
     def allsplit_epoch_end(self, split: str):
         import os
         from src.render.video import stack_vids, put_text
@@ -384,21 +450,32 @@ class BaseModel(LightningModule):
         curep = str(self.trainer.current_epoch)
         if split == 'val':
             dict_to_log_metrs = {}
-            from tmr_evaluator.motion2motion_retr import retrieval
             eval_res = {}
             for guid_comb, samples_gen in self.validation_step_outputs.items():
-                metr_batch, metr_full = retrieval(samples_gen)
+                metr_batch, metr_full = self.tmr_evaluator(samples_gen)
                 eval_res[guid_comb] = metr_batch
                 dict_to_log_metrs = {
                     f'metrics_{guid_comb}/{k}': float(v) 
                     for k, v in eval_res[guid_comb].items()
                 }
                 self.log_dict(dict_to_log_metrs)
+            if TRACER.enabled:
+                # latency of the generations of this validation
+                self.log_dict(TRACER.as_metrics(prefix=f'latency_{split}/'))
+                TRACER.reset()
 
         # do_render = curep%self.render_vids_every_n_epochs
         if self.renderer is not None:
             if self.global_rank == 0 and self.trainer.current_epoch != 0:
-                if split == 'val': # and do_render == 0:
+                if split == 'val' and self.render_pool is not None:
+                    self.log_rendered_videos()
+                    stack_with = None
+                    if self.motion_condition == 'source':
+                        # generations of pairs whose ground truth is not
+                        # rendered yet are logged without it
+                        stack_with = self.render_subset_gt_pooled()
+                    self.render_gens_set(self.set_buf, stack_with=stack_with)
+                elif split == 'val': # and do_render == 0:
                     folder = "epoch_" + curep.zfill(3)
                     folder =  Path('visuals') / folder 
                     folder.mkdir(exist_ok=True, parents=True)
@@ -589,7 +666,6 @@ class BaseModel(LightningModule):
 
                 src_mot = {k2: v2[idx] for k2,
                             v2 in src_mots.items()}
-
                 # RENDER THE MOTION
                 fname = render_motion(self.renderer, src_mot,
                                         folder / f'{keyid}_source',
@@ -611,6 +687,46 @@ class BaseModel(LightningModule):
                 self.paths_of_rendered_subset_tgt.append(fname)
         return self.paths_of_rendered_subset_src, self.paths_of_rendered_subset_tgt
 
+    def render_subset_gt_pooled(self):
+        """
+        (source, target) videos of the test subset rendered on the render
+        pool, None for the pairs that are not done yet or failed. They are
+        submitted once per run and never waited for.
+        """
+        if self._gt_render_jobs is None:
+            batched = self.process_batch(self.test_subset)
+            folder = Path('visuals') / ("epoch_" + str(self.trainer.current_epoch).zfill(3))
+            folder.mkdir(exist_ok=True, parents=True)
+            src_mots, tgt_mots = self.batch2motion(batched,
+                                                    pack_to_dict=True,
+                                                    slice_til=None)
+            self._gt_render_jobs = []
+            for idx, keyid in enumerate(batched['id']):
+                # untagged jobs are not returned by RenderPool.collect
+                self._gt_render_jobs.append([
+                    self.render_pool.submit({k: v[idx] for k, v in mots.items()},
+                                            folder / f'{keyid}_{name}',
+                                            color=color_map[name])
+                    for name, mots in (('source', src_mots),
+                                       ('target', tgt_mots))])
+        pairs = []
+        for idx, jobs in enumerate(self._gt_render_jobs):
+            paths = []
+            for j, job in enumerate(jobs):
+                if job is None or isinstance(job, str):
+                    paths.append(job)
+                elif not job.ready():
+                    paths.append(None)
+                else:
+                    try:
+                        jobs[j] = job.get()
+                    except Exception as err:
+                        log.warning(f'Rendering of the ground truth failed: {err}')
+                        jobs[j] = None
+                    paths.append(jobs[j])
+            pairs.append(tuple(paths) if all(paths) else None)
+        return pairs
+
     def batch2motion(self, batch, pack_to_dict=True,
                      slice_til=None, single_motion=False):
         # batch_to_cpu = { k: v.detach().cpu() for k, v in batch.items() 
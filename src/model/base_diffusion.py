@@ -20,7 +20,9 @@ import inspect
 from src.model.utils.tools import remove_padding, pack_to_render
 from src.render.mesh_viz import render_motion
 from src.tools.transforms3d import change_for, transform_body_pose, get_z_rot
-from src.tools.transforms3d import apply_rot_delta
+from src.tools.transforms3d import integrate_rot_deltas
+from src.tools.tracing import TRACER, traced
+from src.model.precision import autocast_denoiser
 from einops import rearrange, reduce
 from torch.nn.functional import l1_loss, mse_loss, smooth_l1_loss
 from src.utils.genutils import dict_to_device
@@ -29,10 +31,28 @@ import torch
 import torch.distributions as dist
 import logging
 import wandb
-from src.diffusion import create_diffusion
+from src.diffusion import create_diffusion, space_timesteps
+from src.model.textencoder.registry import (FROZEN_ENCODER_KEY,
+                                            TEXT_ENCODER_PREFIX,
+                                            encoder_config,
+                                            fill_encoder_weights,
+                                            get_text_encoder, is_frozen,
+                                            strip_encoder_weights)
 
 log = logging.getLogger(__name__)
 
+
+def _repeat_blocks(x, block_size, repeats):
+    """
+    repeat each block of block_size rows (e.g. the unconditional and the
+    conditional replicas of a batch) along the first dim
+    [b1, b2] -> [b1, b1, .., b2, b2, ..]
+    """
+    n_blocks = x.shape[0] // block_size
+    x = x.view(n_blocks, 1, block_size, *x.shape[1:])
+    x = x.expand(n_blocks, repeats, block_size, *x.shape[3:])
+    return x.reshape(n_blocks * repeats * block_size, *x.shape[3:])
+
 class MD(BaseModel):
     def __init__(self, 
                  text_encoder: DictConfig,
@@ -55,16 +75,18 @@ class MD(BaseModel):
                  loss_func_pos: str = 'mse', # l1 mse
                  loss_func_feats: str = 'mse', # l1 mse
                  renderer = None,
+                 render_workers: int = 0,
                  pad_inputs = False,
                  source_encoder: str = 'trans_enc',
                  zero_len_source: bool = True,
                  copy_target: bool = False,
                  old_way: bool = False,
+                 inference_precision: str = 'fp32',
                  **kwargs):
 
         super().__init__(statistics_path, nfeats, norm_type, input_feats,
                          dim_per_feat, smpl_path, num_vids_to_render,
-                         renderer=renderer)
+                         renderer=renderer, render_workers=render_workers)
 
         if set(["body_transl_delta_pelv_xy", "body_orient_delta",
                 "body_pose_delta"]).issubset(self.input_feats):
@@ -90,7 +112,9 @@ class MD(BaseModel):
             else:
                 self.motion_cond_encoder = None
         self.pad_inputs = pad_inputs 
-        self.text_encoder = instantiate(text_encoder)
+        # frozen encoders are shared and left out of the checkpoints
+        self.text_encoder_cfg = text_encoder
+        self.text_encoder = get_text_encoder(text_encoder)
 
         # for k, v in self.render_data_buffer.items():
         #     self.store_examples[k] = {'ref': [], 'ref_features': [], 'keyids': []}
@@ -106,6 +130,11 @@ class MD(BaseModel):
         self.diff_params = diff_params
         denoiser.motion_condition = self.motion_condition
         self.denoiser = instantiate(denoiser)
+        # runtime of an exported denoiser, see use_exported_denoiser
+        self.exported_denoiser = None
+        # autocast of the denoiser when sampling: fp32, bf16 or fp16 (GPU),
+        # see src.model.precision
+        self.inference_precision = inference_precision
         from src.diffusion import create_diffusion
 
         from src.diffusion.gaussian_diffusion import ModelMeanType, ModelVarType
@@ -127,6 +156,7 @@ class MD(BaseModel):
                                      diffusion_steps=self.diff_params.num_train_timesteps,
                                      noise_schedule=self.diff_params.noise_schedule,
                                      predict_xstart=False if self.diff_params.predict_type == 'noise' else True) # noise vs sample
+        self._sampling_processes = {}
 
         shape = 2.0
         scale = 1.0
@@ -151,6 +181,23 @@ class MD(BaseModel):
 
         self.__post_init__()
 
+    def on_save_checkpoint(self, checkpoint):
+        # the weights of a frozen encoder are those of its pretrained model,
+        # store a reference to its config instead
+        if not is_frozen(self.text_encoder):
+            return
+        strip_encoder_weights(checkpoint['state_dict'], TEXT_ENCODER_PREFIX)
+        checkpoint[FROZEN_ENCODER_KEY] = {
+            'prefix': TEXT_ENCODER_PREFIX,
+            'config': encoder_config(self.text_encoder_cfg)}
+
+    def on_load_checkpoint(self, checkpoint):
+        # called before load_state_dict, so slim checkpoints load strictly
+        if FROZEN_ENCODER_KEY not in checkpoint:
+            return
+        fill_encoder_weights(checkpoint['state_dict'], self.text_encoder,
+                             checkpoint[FROZEN_ENCODER_KEY]['prefix'])
+
     def sample_from_distribution(
         self,
         dist,
@@ -176,6 +223,50 @@ class MD(BaseModel):
         z = z.unsqueeze(0)
         return z
 
+    def get_sampling_process(self, sampler='ddpm', num_steps=None):
+        """
+        Diffusion process to sample with, built on the trained noise schedule.
+            sampler: 'ddpm' uses all the trained steps, 'respaced' (DDPM) and
+                     'ddim' skip steps by respacing the trained schedule
+            num_steps: number of sampling steps for 'respaced' and 'ddim'
+        """
+        assert sampler in ['ddpm', 'respaced', 'ddim']
+        num_train_steps = self.diff_params.num_train_timesteps
+        if sampler == 'ddpm' or num_steps is None or num_steps >= num_train_steps:
+            respacing = None
+        else:
+            respacing = [num_steps]
+            if sampler == 'ddim':
+                # striding of the DDIM paper when it divides the schedule
+                try:
+                    space_timesteps(num_train_steps, f'ddim{num_steps}')
+                    respacing = f'ddim{num_steps}'
+                except ValueError:
+                    pass
+        key = str(respacing)
+        if key not in self._sampling_processes:
+            self._sampling_processes[key] = create_diffusion(
+                timestep_respacing=respacing,
+                learn_sigma=False,
+                sigma_small=True,
+                diffusion_steps=num_train_steps,
+                noise_schedule=self.diff_params.noise_schedule,
+                predict_xstart=False if self.diff_params.predict_type == 'noise' else True)
+        return self._sampling_processes[key]
+
+    def use_exported_denoiser(self, path: str = None, num_threads: int = None):
+        """
+        sample with a TorchScript (.pt) or ONNX (.onnx) export of the denoiser,
+        see src.model.denoiser_export; None goes back to the eager module
+        """
+        if path is None:
+            self.exported_denoiser = None
+            return
+        from src.model.denoiser_export import ExportedDenoiser
+        self.exported_denoiser = ExportedDenoiser(path, eager=self.denoiser,
+                                                  num_threads=num_threads)
+
+    @traced('diffusion_reverse')
     def _diffusion_reverse(self,
                            text_embeds, text_masks_from_enc, 
                            motion_embeds, cond_motion_masks,
@@ -189,11 +280,38 @@ class MD(BaseModel):
                            inpaint_dict=None,
                            use_linear=False,
                            prob_way='3way',
-                           show_progress=True):
+                           show_progress=True,
+                           sampler='ddpm',
+                           ddim_eta=0.0):
         # guidance_scale_text: 7.5 #
         #  guidance_scale_motion: 1.5
         # init latents
 
+        if isinstance(gd_text, (list, tuple)):
+            # guidance grid: one trajectory per (gd_text, gd_motion) pair and
+            # sample, all of them denoised together
+            n_gd = len(gd_text)
+            assert len(gd_motion) == n_gd
+            n = inp_motion_mask.shape[0]
+            if text_embeds is not None:
+                text_embeds = _repeat_blocks(text_embeds, n, n_gd)
+                text_masks_from_enc = _repeat_blocks(text_masks_from_enc, n, n_gd)
+            if motion_embeds is not None:
+                motion_embeds = motion_embeds.repeat(1, n_gd, 1)
+                cond_motion_masks = cond_motion_masks.repeat(n_gd, 1)
+            inp_motion_mask = inp_motion_mask.repeat(n_gd, 1)
+            if init_vec is not None:
+                init_vec = init_vec.repeat(n_gd, 1, 1)
+            if inpaint_dict is not None:
+                inpaint_dict = {
+                    'mask': inpaint_dict['mask'].repeat(n_gd, 1),
+                    'start_motion': inpaint_dict['start_motion'].repeat(1, n_gd, 1)
+                    }
+            gd_text = torch.tensor(gd_text, dtype=torch.float,
+                                   device=inp_motion_mask.device).repeat_interleave(n)
+            gd_motion = torch.tensor(gd_motion, dtype=torch.float,
+                                     device=inp_motion_mask.device).repeat_interleave(n)
+
         bsz = inp_motion_mask.shape[0]
         assert mode in ['full_cond', 'text_cond', 'mot_cond']
         assert inp_motion_mask is not None
@@ -257,7 +375,8 @@ class MD(BaseModel):
         # y_null = torch.tensor([1000] * n, device=device)
         # y = torch.cat([y, y_null], 0)
         if use_linear:
-            max_steps_diff = diff_process.num_timesteps
+            # the denoiser sees the timesteps of the trained schedule
+            max_steps_diff = diff_process.original_num_steps
         else:
             max_steps_diff = None
         if motion_embeds is not None:
@@ -289,14 +408,37 @@ class MD(BaseModel):
                     inpaint_dict=inpaint_dict,
                     max_steps=max_steps_diff)
 
+        if self.exported_denoiser is not None:
+            # the exported graph projects the conditions itself
+            denoiser_fn = self.exported_denoiser
+        else:
+            # the conditions are the same for every step of the sampling loop
+            with TRACER.span('condition_projection'):
+                model_kwargs['prepared_conds'] = self.denoiser.prepare_conditions(
+                    model_kwargs['in_motion_mask'], model_kwargs['text_embeds'],
+                    model_kwargs['condition_mask'], model_kwargs['motion_embeds'])
+            denoiser_fn = autocast_denoiser(self.denoiser.forward_with_guidance,
+                                            self.inference_precision,
+                                            self.device)
+        if TRACER.enabled:
+            denoiser_fn = TRACER.wrap('denoiser_step', denoiser_fn)
         # model_kwargs = dict(y=y, cfg_scale=args.cfg_scale)
         # Sample images:
-        samples = diff_process.p_sample_loop(self.denoiser.forward_with_guidance,
-                                             z.shape, z, 
-                                             clip_denoised=False, 
-                                             model_kwargs=model_kwargs,
-                                             progress=show_progress,
-                                             device=initial_latents.device,)
+        if sampler == 'ddim':
+            samples = diff_process.ddim_sample_loop(denoiser_fn,
+                                                    z.shape, z,
+                                                    clip_denoised=False,
+                                                    model_kwargs=model_kwargs,
+                                                    progress=show_progress,
+                                                    device=initial_latents.device,
+                                                    eta=ddim_eta)
+        else:
+            samples = diff_process.p_sample_loop(denoiser_fn,
+                                                 z.shape, z, 
+                                                 clip_denoised=False, 
+                                                 model_kwargs=model_kwargs,
+                                                 progress=show_progress,
+                                                 device=initial_latents.device,)
         if motion_embeds is not None:
             _, _, samples = samples.chunk(3, dim=0)  # Remove null class samples
         else:
@@ -525,6 +667,7 @@ class MD(BaseModel):
         all_losses_dict = all_losses_dict | dataset_losses
         return tot_loss, all_losses_dict 
 
+    @traced('generate_motion')
     def generate_motion(self, texts_cond, motions_cond,
                         mask_source, mask_target,
                         diffusion_process, 
@@ -536,8 +679,23 @@ class MD(BaseModel):
                         inpaint_dict=None,
                         use_linear=False,
                         prob_way='3way',
-                        show_progress=True
+                        show_progress=True,
+                        sampler=None,
+                        ddim_eta=0.0
                         ):
+        """
+        If sampler ('ddpm', 'respaced' or 'ddim') is given, the diffusion
+        process is built from the trained schedule with num_diff_steps steps
+        and diffusion_process is ignored.
+        If gd_text and gd_motion are lists of K guidance scales, the K pairs
+        are sampled in one reverse pass and a list of K outputs is returned.
+        They can also be tensors with one scale per sample of the batch.
+        """
+        if sampler is not None:
+            diffusion_process = self.get_sampling_process(sampler,
+                                                          num_diff_steps)
+        else:
+            sampler = 'ddpm'
         # uncond_tokens = [""] * len(texts_cond)
         # if self.condition == 'text':
         #     uncond_tokens.extend(texts_cond)
@@ -550,7 +708,8 @@ class MD(BaseModel):
             texts_cond = ['']*no_of_texts + texts_cond
             if self.motion_condition == 'source':
                 texts_cond = ['']*no_of_texts + texts_cond
-            text_emb, text_mask = self.text_encoder(texts_cond)
+            with TRACER.span('text_encoding'):
+                text_emb, text_mask = self.text_encoder(texts_cond)
 
         cond_emb_motion = None
         cond_motion_mask = None
@@ -560,8 +719,9 @@ class MD(BaseModel):
                 if self.motion_cond_encoder is not None:
                     source_motion_condition = motions_cond
 
-                    cond_emb_motion = self.motion_cond_encoder(source_motion_condition, 
-                                                               mask_source)
+                    with TRACER.span('motion_encoding'):
+                        cond_emb_motion = self.motion_cond_encoder(source_motion_condition, 
+                                                                   mask_source)
                     # assuming encoding of a single token!
                     cond_emb_motion = cond_emb_motion.unsqueeze(0)
                     cond_motion_mask = torch.ones((mask_source.shape[0], 1),
@@ -621,7 +781,13 @@ class MD(BaseModel):
                                                 inpaint_dict=inpaint_dict,
                                                 use_linear=use_linear,
                                                 prob_way=prob_way,
-                                                show_progress=show_progress)
+                                                show_progress=show_progress,
+                                                sampler=sampler,
+                                                ddim_eta=ddim_eta)
+                if isinstance(gd_text, (list, tuple)):
+                    return (list(init_noise.chunk(len(gd_text), dim=0)),
+                            list(diff_out.permute(1, 0, 2).chunk(len(gd_text),
+                                                                 dim=0)))
                 return init_noise, diff_out.permute(1, 0, 2)
 
             else:
@@ -640,8 +806,13 @@ class MD(BaseModel):
                                                 steps_num=num_diff_steps,
                                                 inpaint_dict=inpaint_dict,
                                                 use_linear=use_linear,
-                                                show_progress=show_progress)
+                                                show_progress=show_progress,
+                                                sampler=sampler,
+                                                ddim_eta=ddim_eta)
 
+            if isinstance(gd_text, (list, tuple)):
+                return list(diff_out.permute(1, 0, 2).chunk(len(gd_text),
+                                                            dim=0))
             return diff_out.permute(1, 0, 2)
 
     # def integrate_feats2motion(self, first_pose_norm, delta_motion_norm):
@@ -720,6 +891,7 @@ class MD(BaseModel):
     #     return full_trans_unnorm
 
 
+    @traced('diffout2motion')
     def diffout2motion(self, diffout):
         if diffout.shape[1] == 1:
             rots_unnorm = self.cat_inputs(self.unnorm_inputs(self.uncat_inputs(
@@ -747,22 +919,10 @@ class MD(BaseModel):
             first_trans = torch.zeros(*diffout.shape[:-1], 3,
                                       device=self.device)[:, [0]]
             if 'z_orient_delta' in self.input_feats:
-                first_orient_z = torch.eye(3, device=self.device).unsqueeze(0)  # Now the shape is (1, 1, 3, 3)
-                first_orient_z = first_orient_z.repeat(feats_unnorm.shape[0], 1, 1)  # Now the shape is (B, 1, 3, 3)
-                first_orient_z = transform_body_pose(first_orient_z, 'rot->6d') 
-
-                # --> first_orient_z convert to 6d
                 # integrate z orient delta --> z component tof orientation
+                # starting from the identity for the first frame
                 z_orient_delta = feats_unnorm[..., 9:15]
-
-                from src.tools.transforms3d import apply_rot_delta, remove_z_rot, get_z_rot, change_for
-                prev_z = first_orient_z 
-                full_z_angle = [first_orient_z[:, None]]
-                for i in range(1, z_orient_delta.shape[1]):
-                    curr_z = apply_rot_delta(prev_z, z_orient_delta[:, i])
-                    prev_z = curr_z.clone()
-                    full_z_angle.append(curr_z[:,None])
-                full_z_angle = torch.cat(full_z_angle, dim=1)
+                full_z_angle = integrate_rot_deltas(z_orient_delta)
                 full_z_angle_rotmat = get_z_rot(full_z_angle)
                 # full_orient = torch.cat([full_z_angle, xy_orient], dim=-1)
                 xy_orient = feats_unnorm[..., 3:9]
@@ -933,14 +1093,15 @@ class MD(BaseModel):
             # prepare the motions
             # compute the metrics
 
-            for guid_text, guid_motion in guidances_mix:
-                diffout = self.generate_motion(gt_texts, batch['source_motion'],
-                                               mask_source, mask_target,
-                                               self.diffusion_process,
-                                               gd_motion=guid_motion,
-                                               gd_text=guid_text,
-                                               num_diff_steps=infer_steps,
-                                               show_progress=False)
+            # all the guidance pairs in one reverse pass
+            diffouts = self.generate_motion(gt_texts, batch['source_motion'],
+                                            mask_source, mask_target,
+                                            self.diffusion_process,
+                                            gd_motion=[gm for _, gm in guidances_mix],
+                                            gd_text=[gt for gt, _ in guidances_mix],
+                                            num_diff_steps=infer_steps,
+                                            show_progress=False)
+            for (guid_text, guid_motion), diffout in zip(guidances_mix, diffouts):
                 gen_mo = self.diffout2motion(diffout)
                 # gen_mots[f'{guid_text}txt_{guid_motion}mot'].append(gen_mo)
                 for ii, kval in enumerate(gt_keyids):
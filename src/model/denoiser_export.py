@@ -0,0 +1,297 @@
+"""
+TorchScript and ONNX export of TMED_denoiser.
+
+The exported graph is one guided step of the sampling loop of a model
+conditioned on the source motion: the three classifier-free guidance passes
+([uncond, motion, text+motion]) of the denoiser and their combination, with
+one guidance scale per sample. The batch, frame, text token and source frame
+axes are dynamic.
+
+Export the denoiser of a checkpoint (only the denoiser is loaded, not the
+text encoder) and check the parity of the exported graphs on CPU:
+    python -m src.model.denoiser_export path/to/last.ckpt --out exported/ \\
+        --format torchscript onnx --check
+
+Sample with the exported graph instead of the eager module:
+    model.use_exported_denoiser('exported/denoiser.onnx')
+"""
+import logging
+import os
+from typing import Dict, List
+
+import torch
+from torch import nn
+
+from src.model.tmed_denoiser import _linear_guidance
+
+log = logging.getLogger(__name__)
+
+INPUT_NAMES = ['noised_motion', 'timestep', 'in_motion_mask', 'text_embeds',
+               'condition_mask', 'motion_embeds', 'guidance_motion',
+               'guidance_text_n_motion']
+OUTPUT_NAMES = ['eps']
+DYNAMIC_AXES = {'noised_motion': {0: 'batch', 1: 'frames'},
+                'in_motion_mask': {0: 'batch3', 1: 'frames'},
+                'text_embeds': {0: 'batch3', 1: 'text_tokens'},
+                'condition_mask': {0: 'batch3', 1: 'cond_tokens'},
+                'motion_embeds': {0: 'source_frames', 1: 'batch3'},
+                'guidance_motion': {0: 'batch'},
+                'guidance_text_n_motion': {0: 'batch'},
+                'eps': {0: 'batch', 1: 'frames'}}
+
+
+class GuidedDenoiser(nn.Module):
+    """
+    The guided step of TMED_denoiser.forward_with_guidance ('3way', without
+    inpainting) with tensor inputs only, so that it can be traced.
+
+    Inputs are those of forward_with_guidance, except for the noised motion
+    [B, frames, nfeats] and the guidance scales [B], which are given once per
+    sample; the conditions are the three guidance blocks [3B, ...]. The output
+    is the guided prediction [B, frames, nfeats].
+    """
+    def __init__(self, denoiser: nn.Module):
+        super().__init__()
+        self.denoiser = denoiser
+
+    def forward(self, noised_motion, timestep, in_motion_mask, text_embeds,
+                condition_mask, motion_embeds, guidance_motion,
+                guidance_text_n_motion):
+        combined = torch.cat([noised_motion, noised_motion, noised_motion], 0)
+        model_out = self.denoiser(combined, timestep,
+                                  in_motion_mask=in_motion_mask,
+                                  text_embeds=text_embeds,
+                                  condition_mask=condition_mask,
+                                  motion_embeds=motion_embeds)
+        uncond_eps, cond_eps_motion, cond_eps_text_n_motion = model_out.chunk(3, 0)
+        guidance_motion = guidance_motion.view(-1, 1, 1)
+        guidance_text_n_motion = guidance_text_n_motion.view(-1, 1, 1)
+        return uncond_eps + guidance_motion * (cond_eps_motion - uncond_eps) + \
+            guidance_text_n_motion * (cond_eps_text_n_motion - cond_eps_motion)
+
+
+def example_inputs(denoiser: nn.Module, batch_size: int = 2,
+                   length: int = 40, text_tokens: int = 77,
+                   text_dim: int = None) -> Dict[str, torch.Tensor]:
+    """random inputs of GuidedDenoiser, source and target of `length` frames"""
+    nfeats = denoiser.pose_proj_out.out_features
+    text_dim = text_dim or denoiser.text_encoded_dim
+    bs3 = 3 * batch_size
+    text_mask = torch.zeros(bs3, text_tokens, dtype=torch.bool)
+    text_mask[:, :min(12, text_tokens)] = True
+    source = torch.randn(length, batch_size, nfeats)
+    source_mask = torch.ones(batch_size, length, dtype=torch.bool)
+    source_mask[1:, length // 2:] = False
+    return {'noised_motion': torch.randn(batch_size, length, nfeats),
+            'timestep': torch.tensor([150]),
+            'in_motion_mask': source_mask.repeat(3, 1),
+            'text_embeds': torch.randn(bs3, text_tokens, text_dim),
+            'condition_mask': torch.cat([text_mask,
+                                         torch.cat([torch.zeros_like(source_mask),
+                                                    source_mask, source_mask])],
+                                        1),
+            'motion_embeds': torch.cat([torch.zeros_like(source), source,
+                                        source], 1),
+            'guidance_motion': torch.full((batch_size,), 2.0),
+            'guidance_text_n_motion': torch.full((batch_size,), 2.0)}
+
+
+class _FastPathDisabled:
+    # the fused inference path of nn.TransformerEncoder (nested tensors) can
+    # not be traced, the exported graphs use the regular kernels
+    def __enter__(self):
+        mha = getattr(torch.backends, 'mha', None)
+        self.prev = mha.get_fastpath_enabled() if mha is not None else None
+        if mha is not None:
+            mha.set_fastpath_enabled(False)
+
+    def __exit__(self, *exc):
+        if self.prev is not None:
+            torch.backends.mha.set_fastpath_enabled(self.prev)
+        return False
+
+
+def export_torchscript(denoiser: nn.Module, path: str, **input_kwargs):
+    wrapper = GuidedDenoiser(denoiser).eval()
+    inputs = example_inputs(denoiser, **input_kwargs)
+    with torch.no_grad(), _FastPathDisabled():
+        traced = torch.jit.trace(wrapper, tuple(inputs[n] for n in INPUT_NAMES),
+                                 check_trace=False)
+    traced.save(path)
+    log.info(f'Wrote the TorchScript denoiser to {path}')
+    return path
+
+
+def export_onnx(denoiser: nn.Module, path: str, opset: int = 17,
+                **input_kwargs):
+    wrapper = GuidedDenoiser(denoiser).eval()
+    inputs = example_inputs(denoiser, **input_kwargs)
+    with torch.no_grad(), _FastPathDisabled():
+        torch.onnx.export(wrapper, tuple(inputs[n] for n in INPUT_NAMES), path,
+                          input_names=INPUT_NAMES, output_names=OUTPUT_NAMES,
+                          dynamic_axes=DYNAMIC_AXES, opset_version=opset)
+    log.info(f'Wrote the ONNX denoiser to {path}')
+    return path
+
+
+class _OnnxRunner:
+    def __init__(self, path: str, num_threads: int = None):
+        import onnxruntime as ort
+        options = ort.SessionOptions()
+        if num_threads is not None:
+            options.intra_op_num_threads = num_threads
+        self.session = ort.InferenceSession(path, options,
+                                            providers=['CPUExecutionProvider'])
+
+    def __call__(self, *inputs):
+        feeds = {name: x.detach().cpu().numpy()
+                 for name, x in zip(INPUT_NAMES, inputs)}
+        eps, = self.session.run(OUTPUT_NAMES, feeds)
+        return torch.from_numpy(eps)
+
+
+class ExportedDenoiser:
+    """
+    Runtime of an exported denoiser with the interface of
+    TMED_denoiser.forward_with_guidance, as called by the sampling loops.
+
+    Steps the graph does not cover (inpainting, '2way' guidance, models
+    without a source motion) run on the eager denoiser.
+
+    Args:
+        path: a .pt (TorchScript) or .onnx file of export_torchscript/onnx
+        eager: the eager TMED_denoiser, for the steps the graph does not cover
+        num_threads: intra-op threads of the ONNX runtime session
+    """
+    def __init__(self, path: str, eager: nn.Module = None,
+                 num_threads: int = None):
+        self.path = path
+        self.eager = eager
+        if path.endswith('.onnx'):
+            self.runner = _OnnxRunner(path, num_threads)
+        else:
+            self.runner = torch.jit.load(path, map_location='cpu').eval()
+
+    def _supported(self, motion_embeds, inpaint_dict, prob_way):
+        return motion_embeds is not None and inpaint_dict is None \
+            and prob_way == '3way'
+
+    @torch.no_grad()
+    def __call__(self, noised_motion, timestep, in_motion_mask, text_embeds,
+                 condition_mask, guidance_motion, guidance_text_n_motion,
+                 motion_embeds=None, inpaint_dict=None, max_steps=None,
+                 prob_way='3way', **kwargs):
+        if not self._supported(motion_embeds, inpaint_dict, prob_way):
+            if self.eager is None:
+                raise ValueError('The exported denoiser only covers the 3-way '
+                                 'guidance of source conditioned models.')
+            return self.eager.forward_with_guidance(
+                noised_motion, timestep, in_motion_mask, text_embeds,
+                condition_mask, guidance_motion, guidance_text_n_motion,
+                motion_embeds=motion_embeds, inpaint_dict=inpaint_dict,
+                max_steps=max_steps, prob_way=prob_way, **kwargs)
+        device = noised_motion.device
+        bs = len(noised_motion) // 3
+        if max_steps is not None:
+            curr_ts = timestep[0].item()
+            guidance_motion = _linear_guidance(guidance_motion, curr_ts,
+                                               max_steps)
+            guidance_text_n_motion = _linear_guidance(guidance_text_n_motion,
+                                                      curr_ts, max_steps)
+        scales = [torch.as_tensor(g, dtype=torch.float, device=device).expand(bs)
+                  for g in (guidance_motion, guidance_text_n_motion)]
+        inputs = (noised_motion[:bs], timestep[:1], in_motion_mask,
+                  text_embeds, condition_mask, motion_embeds, *scales)
+        if isinstance(self.runner, _OnnxRunner):
+            eps = self.runner(*inputs).to(device)
+        else:
+            eps = self.runner(*[x.cpu() for x in inputs]).to(device)
+        return torch.cat([eps, eps, eps], 0)
+
+
+def check_parity(denoiser: nn.Module, exported: ExportedDenoiser,
+                 batch_size: int = 3, lengths: List[int] = (25, 90),
+                 seed: int = 0, text_only: bool = False) -> float:
+    """
+    max abs difference between the eager guided step and the exported one,
+    at lengths other than the traced one to cover the dynamic axes; with
+    text_only, the [uncond, text] blocks without source motion, which the
+    exported denoiser runs on its eager module
+    """
+    torch.manual_seed(seed)
+    denoiser = denoiser.eval()
+    max_err = 0.0
+    for length in lengths:
+        inputs = example_inputs(denoiser, batch_size=batch_size, length=length)
+        replicas = 2 if text_only else 3
+        noised = inputs['noised_motion'].repeat(replicas, 1, 1)
+        kwargs = dict(timestep=inputs['timestep'],
+                      in_motion_mask=inputs['in_motion_mask'],
+                      text_embeds=inputs['text_embeds'],
+                      condition_mask=inputs['condition_mask'],
+                      guidance_motion=inputs['guidance_motion'],
+                      guidance_text_n_motion=inputs['guidance_text_n_motion'],
+                      motion_embeds=inputs['motion_embeds'])
+        if text_only:
+            bs2 = 2 * batch_size
+            n_text = inputs['text_embeds'].shape[1]
+            kwargs.update(in_motion_mask=kwargs['in_motion_mask'][:bs2],
+                          text_embeds=kwargs['text_embeds'][:bs2],
+                          condition_mask=kwargs['condition_mask'][:bs2, :n_text],
+                          motion_embeds=None)
+        with torch.no_grad():
+            ref = denoiser.forward_with_guidance(noised, **kwargs)
+        out = exported(noised, **kwargs)
+        max_err = max(max_err, float((ref - out).abs().max()))
+    return max_err
+
+
+def load_denoiser(ckpt_path: str) -> nn.Module:
+    """the TMED_denoiser of an MD checkpoint, without the rest of the model"""
+    from hydra.utils import instantiate
+    checkpoint = torch.load(ckpt_path, map_location='cpu')
+    hparams = checkpoint['hyper_parameters']
+    denoiser_cfg = hparams['denoiser']
+    denoiser_cfg['motion_condition'] = hparams['motion_condition']
+    denoiser = instantiate(denoiser_cfg)
+    prefix = 'denoiser.'
+    denoiser.load_state_dict({k[len(prefix):]: v for k, v in
+                              checkpoint['state_dict'].items()
+                              if k.startswith(prefix)})
+    return denoiser.eval()
+
+
+if __name__ == '__main__':
+    import argparse
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    parser = argparse.ArgumentParser(
+        description="Export the denoiser of a checkpoint to TorchScript/ONNX.")
+    parser.add_argument("ckpt", type=str)
+    parser.add_argument("--out", type=str, default='.')
+    parser.add_argument("--format", type=str, nargs='+',
+                        default=['torchscript', 'onnx'],
+                        choices=['torchscript', 'onnx'])
+    parser.add_argument("--opset", type=int, default=17)
+    parser.add_argument("--check", action='store_true',
+                        help="Compare the exported graphs to the eager denoiser")
+    parser.add_argument("--tolerance", type=float, default=1e-4)
+    args = parser.parse_args()
+
+    denoiser = load_denoiser(args.ckpt)
+    os.makedirs(args.out, exist_ok=True)
+    paths = []
+    if 'torchscript' in args.format:
+        paths.append(export_torchscript(denoiser,
+                                        os.path.join(args.out, 'denoiser.pt')))
+    if 'onnx' in args.format:
+        paths.append(export_onnx(denoiser,
+                                 os.path.join(args.out, 'denoiser.onnx'),
+                                 opset=args.opset))
+    if args.check:
+        failed = False
+        for path in paths:
+            err = check_parity(denoiser, ExportedDenoiser(path))
+            failed |= err > args.tolerance
+            log.info(f'{path}: max abs err {err:.2e} '
+                     f'({"ok" if err <= args.tolerance else "FAILED"})')
+        raise SystemExit(1 if failed else 0)
@@ -0,0 +1,216 @@
+"""
+Batched edit inference.
+
+Requests (source motion, edit text, guidance) are queued and a worker thread
+coalesces them into batches: a batch is closed when it is full or when its
+oldest request has waited `max_wait_ms`. Each batch is padded with the mask
+utilities of the model, denoised in one reverse diffusion with one guidance
+scale per row and scattered back to the futures of the requests.
+
+    engine = EditInferenceEngine(model, max_batch_size=128, max_wait_ms=20)
+    future = engine.submit(source_feats, 'raise the left arm higher')
+    motion = future.result()   # [frames, 3 + 6 + 21*6] SMPL params
+    engine.stats()             # queue depth, batch fill, p50/p99 latency
+    engine.close()
+"""
+import logging
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from typing import List
+
+import numpy as np
+import torch
+
+log = logging.getLogger(__name__)
+
+
+class EditRequest:
+    """
+    Args:
+        source_motion: normalized input features of the source [frames, nfeats]
+        text: the edit text
+        target_length: frames to generate, the length of the source if None
+        gd_text: text and motion guidance scale, the model's if None
+        gd_motion: motion guidance scale, the model's if None
+    """
+    def __init__(self, source_motion: torch.Tensor, text: str,
+                 target_length: int = None, gd_text: float = None,
+                 gd_motion: float = None):
+        self.source_motion = source_motion
+        self.text = text
+        self.target_length = target_length or len(source_motion)
+        self.gd_text = gd_text
+        self.gd_motion = gd_motion
+        self.future = Future()
+        self.arrival = time.perf_counter()
+
+
+class EditInferenceEngine:
+    """
+    Args:
+        model: a trained MD conditioned on the source motion
+        max_batch_size: maximum requests per batch
+        max_wait_ms: maximum time the oldest request of a batch waits for
+            more requests before the batch is run
+        decode: return SMPL params (diffout2motion) instead of features
+        sampler, num_diff_steps, ddim_eta: as in MD.generate_motion, the
+            trained schedule if sampler is None
+        history: number of latencies kept for the percentiles
+    """
+    def __init__(self, model, max_batch_size: int = 128,
+                 max_wait_ms: float = 20.0, decode: bool = True,
+                 sampler: str = None, num_diff_steps: int = None,
+                 ddim_eta: float = 0.0, history: int = 10000):
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1e3
+        self.decode = decode
+        self.sampler = sampler
+        self.num_diff_steps = num_diff_steps
+        self.ddim_eta = ddim_eta
+
+        self._queue = queue.Queue()
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self._latencies = deque(maxlen=history)
+        self._batch_sizes = deque(maxlen=history)
+        self._max_queue_depth = 0
+        self._n_requests = 0
+        self._n_failed = 0
+
+        self._worker = threading.Thread(target=self._run, daemon=True,
+                                        name='edit-inference')
+        self._worker.start()
+
+    def submit(self, source_motion: torch.Tensor, text: str,
+               target_length: int = None, gd_text: float = None,
+               gd_motion: float = None) -> Future:
+        """queue an edit, the future resolves to the generated motion"""
+        if self._stop.is_set():
+            raise RuntimeError('The inference engine is closed.')
+        request = EditRequest(source_motion, text, target_length, gd_text,
+                              gd_motion)
+        self._queue.put(request)
+        with self._lock:
+            self._max_queue_depth = max(self._max_queue_depth,
+                                        self._queue.qsize())
+        return request.future
+
+    def _next_batch(self) -> List[EditRequest]:
+        try:
+            first = self._queue.get(timeout=0.1)
+        except queue.Empty:
+            return []
+        batch = [first]
+        deadline = first.arrival + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            try:
+                if remaining > 0:
+                    batch.append(self._queue.get(timeout=remaining))
+                else:
+                    # past the deadline, only take what is already queued
+                    batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while not self._stop.is_set() or not self._queue.empty():
+            batch = self._next_batch()
+            if not batch:
+                continue
+            try:
+                motions = self._generate(batch)
+            except Exception as err:
+                log.exception('Edit batch failed.')
+                with self._lock:
+                    self._n_failed += len(batch)
+                for request in batch:
+                    request.future.set_exception(err)
+                continue
+            done = time.perf_counter()
+            with self._lock:
+                self._batch_sizes.append(len(batch))
+                self._n_requests += len(batch)
+                self._latencies.extend(done - r.arrival for r in batch)
+            for request, motion in zip(batch, motions):
+                request.future.set_result(motion)
+
+    @torch.no_grad()
+    def _generate(self, batch: List[EditRequest]) -> List[torch.Tensor]:
+        from src.data.tools.collate import collate_tensor_with_padding
+
+        model = self.model
+        device = model.device
+        source_lens = [len(r.source_motion) for r in batch]
+        target_lens = [r.target_length for r in batch]
+        max_len = 300 if model.pad_inputs else None
+        mask_source, mask_target = model.prepare_mot_masks(source_lens,
+                                                           target_lens,
+                                                           max_len=max_len)
+        # [frames, batch, nfeats] as the normalized inputs of a batch
+        source = collate_tensor_with_padding([r.source_motion.to(device)
+                                              for r in batch])
+        source = source[:, :mask_source.shape[1]]
+        if source.shape[1] < mask_source.shape[1]:
+            source = torch.nn.functional.pad(
+                source, (0, 0, 0, mask_source.shape[1] - source.shape[1]))
+        source = source.permute(1, 0, 2)
+
+        # one scale per row, so requests with different guidance share a pass
+        diff_params = model.diff_params
+        gd_text = torch.tensor([diff_params.guidance_scale_text
+                                if r.gd_text is None else r.gd_text
+                                for r in batch], device=device)
+        gd_motion = torch.tensor([diff_params.guidance_scale_motion
+                                  if r.gd_motion is None else r.gd_motion
+                                  for r in batch], device=device)
+        diffout = model.generate_motion([r.text for r in batch], source,
+                                        mask_source, mask_target,
+                                        model.diffusion_process,
+                                        gd_text=gd_text, gd_motion=gd_motion,
+                                        num_diff_steps=self.num_diff_steps,
+                                        show_progress=False,
+                                        sampler=self.sampler,
+                                        ddim_eta=self.ddim_eta)
+        if self.decode:
+            diffout = model.diffout2motion(diffout)
+        return [diffout[i, :length].cpu()
+                for i, length in enumerate(target_lens)]
+
+    def stats(self) -> dict:
+        """
+        queue depth (current and maximum), mean batch fill ratio and
+        p50/p99 latency in ms over the last `history` requests
+        """
+        with self._lock:
+            latencies = np.array(self._latencies) * 1e3
+            batch_sizes = np.array(self._batch_sizes)
+            stats = {'queue_depth': self._queue.qsize(),
+                     'max_queue_depth': self._max_queue_depth,
+                     'requests': self._n_requests,
+                     'failed': self._n_failed,
+                     'batches': len(batch_sizes)}
+        if len(batch_sizes):
+            stats['mean_batch_size'] = float(batch_sizes.mean())
+            stats['batch_fill_ratio'] = float(batch_sizes.mean() /
+                                              self.max_batch_size)
+        if len(latencies):
+            stats['p50_latency_ms'] = float(np.percentile(latencies, 50))
+            stats['p99_latency_ms'] = float(np.percentile(latencies, 99))
+        return stats
+
+    def close(self):
+        """serve the queued requests, then stop the worker"""
+        self._stop.set()
+        self._worker.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,98 @@
+"""
+Reduced precision inference of the denoiser.
+
+Only the denoiser runs under autocast, its output is cast back to fp32 so that
+the arithmetic of GaussianDiffusion (posterior means, variances, noise) stays
+in fp32. 'bf16' works on CPU and GPU, 'fp16' on GPU only.
+
+The cost of a precision is measured as the joint position error of the edited
+motions against fp32, sampled from the same noise:
+
+    err = precision_error(model, texts, source, mask_source, mask_target, 'bf16')
+    err['mpjpe_mm'], err['max_mm']
+"""
+import functools
+import logging
+from typing import List
+
+import torch
+
+log = logging.getLogger(__name__)
+
+PRECISIONS = {'fp32': None, 'bf16': torch.bfloat16, 'fp16': torch.float16}
+
+
+def autocast_dtype(precision: str, device: torch.device):
+    """the autocast dtype of a precision on device, None for fp32"""
+    if precision not in PRECISIONS:
+        raise ValueError(f'Unknown precision {precision}, '
+                         f'one of {list(PRECISIONS)}')
+    if precision == 'fp16' and torch.device(device).type != 'cuda':
+        raise ValueError('fp16 inference needs a GPU, use bf16 on CPU.')
+    return PRECISIONS[precision]
+
+
+def autocast_denoiser(fn, precision: str, device: torch.device):
+    """fn run under autocast, with its output in fp32"""
+    dtype = autocast_dtype(precision, device)
+    if dtype is None:
+        return fn
+    device_type = torch.device(device).type
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        with torch.autocast(device_type, dtype=dtype):
+            out = fn(*args, **kwargs)
+        return out.float()
+    return wrapper
+
+
+def _joints(model, diffout):
+    from src.model.utils.tools import pack_to_render
+    motion = model.diffout2motion(diffout)
+    smpl_params = pack_to_render(rots=motion[..., 3:], trans=motion[..., :3])
+    return model.run_smpl_fwd(smpl_params['body_transl'],
+                              smpl_params['body_orient'],
+                              smpl_params['body_pose']).joints
+
+
+@torch.no_grad()
+def precision_error(model, texts: List[str], source_motion, mask_source,
+                    mask_target, precision: str, seed: int = 0,
+                    diffusion_process=None, **generate_kwargs) -> dict:
+    """
+    Joint position error of the motions edited with `precision` against fp32,
+    both sampled from the same initial noise and step noise.
+
+    Args:
+        model: an MD model
+        texts, source_motion, mask_source, mask_target: the batch, as the
+            inputs of MD.generate_motion
+        precision: the precision to compare against fp32
+        seed: seed of the noise of both samplings
+        diffusion_process: the sampling process, the model's if None
+        generate_kwargs: other arguments of MD.generate_motion
+    returns:
+        mean (mpjpe_mm) and max (max_mm) error of the valid frames in mm
+    """
+    prev = model.inference_precision
+    devices = [model.device] if model.device.type == 'cuda' else []
+    joints = {}
+    try:
+        for prec in ('fp32', precision):
+            model.inference_precision = prec
+            with torch.random.fork_rng(devices=devices):
+                torch.manual_seed(seed)
+                diffout = model.generate_motion(texts, source_motion,
+                                                mask_source, mask_target,
+                                                diffusion_process or
+                                                model.diffusion_process,
+                                                show_progress=False,
+                                                **generate_kwargs)
+            joints[prec] = _joints(model, diffout).view(*mask_target.shape,
+                                                        -1, 3)
+    finally:
+        model.inference_precision = prev
+    err = (joints[precision] - joints['fp32']).norm(dim=-1).mean(-1)
+    err = err[mask_target] * 1e3
+    return {'mpjpe_mm': float(err.mean()), 'max_mm': float(err.max())}
@@ -5,6 +5,7 @@ import torch
 from torch import Tensor, nn
 from torch.distributions.distribution import Distribution
 from src.utils.file_io import hack_path
+from src.model.textencoder.embedding_cache import TextEmbeddingCache
 import pytorch_lightning as pl
 
 class ClipTextEncoder(pl.LightningModule):
@@ -14,6 +15,9 @@ class ClipTextEncoder(pl.LightningModule):
             modelpath: str,
             finetune: bool = False,
             last_hidden_state: bool = True,
+            cache_size: int = 8192,
+            cache_dir: str = None,
+            quantize: bool = False,
             **kwargs
         ) -> None:
 
@@ -33,6 +37,9 @@ class ClipTextEncoder(pl.LightningModule):
             self.text_model.training = False
             for p in self.text_model.parameters():
                 p.requires_grad = False
+            if quantize:
+                from src.model.textencoder.quantize import quantize_dynamic_int8
+                quantize_dynamic_int8(self.text_model)
 
         # Then configure the model
         self.max_length = self.tokenizer.model_max_length
@@ -48,7 +55,28 @@ class ClipTextEncoder(pl.LightningModule):
         else:
             raise ValueError(f"Model {modelpath} not supported")
 
+        # frozen encoder -> embeddings of a text never change
+        self.cache = None
+        if not finetune and cache_size > 0 and self.variant != "bert":
+            # int8 embeddings differ from the fp32 ones, they are cached apart
+            self.cache = TextEmbeddingCache(
+                f'{os.path.basename(os.path.normpath(modelpath))}-{self.variant}'
+                f'{"-int8" if quantize else ""}',
+                max_entries=cache_size, cache_dir=cache_dir)
+
+    def _apply(self, fn, *args, **kwargs):
+        super()._apply(fn, *args, **kwargs)
+        from src.model.textencoder.quantize import check_cpu_only
+        check_cpu_only(getattr(self, 'text_model', None))
+        return self
+
     def forward(self, texts: List[str]):
+        if self.cache is not None:
+            return self.cache.encode(texts, self._encode,
+                                     self.text_model.device)
+        return self._encode(texts)
+
+    def _encode(self, texts: List[str]):
         # get prompt text embeddings
         if self.variant in ["clip", "clip_hidden"]:
             text_inputs = self.tokenizer(
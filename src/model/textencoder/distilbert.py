@@ -11,7 +11,8 @@ from torch.distributions.distribution import Distribution
 
 class DistilbertEncoderBase(pl.LightningModule):
     def __init__(self, modelpath: str,
-                 finetune: bool = False) -> None:
+                 finetune: bool = False,
+                 quantize: bool = False) -> None:
         super().__init__()
 
         from transformers import AutoTokenizer, AutoModel
@@ -28,6 +29,9 @@ class DistilbertEncoderBase(pl.LightningModule):
             self.text_model.training = False
             for p in self.text_model.parameters():
                 p.requires_grad = False
+            if quantize:
+                from src.model.textencoder.quantize import quantize_dynamic_int8
+                quantize_dynamic_int8(self.text_model)
 
         # Then configure the model
         self.text_encoded_dim = self.text_model.config.hidden_size
@@ -41,6 +45,12 @@ class DistilbertEncoderBase(pl.LightningModule):
             module.train(mode)
         return self
 
+    def _apply(self, fn, *args, **kwargs):
+        super()._apply(fn, *args, **kwargs)
+        from src.model.textencoder.quantize import check_cpu_only
+        check_cpu_only(getattr(self, 'text_model', None))
+        return self
+
     def get_last_hidden_state(self, texts: List[str],
                               return_mask: bool = False
                               ) -> Union[Tensor, tuple[Tensor, Tensor]]:
@@ -48,4 +58,8 @@ class DistilbertEncoderBase(pl.LightningModule):
         output = self.text_model(**encoded_inputs.to(self.text_model.device))
         if not return_mask:
             return output.last_hidden_state
-        return output.last_hidden_state, encoded_inputs.attention_mask.to(dtype=bool)
\ No newline at end of file
+        return output.last_hidden_state, encoded_inputs.attention_mask.to(dtype=bool)
+
+    def _encode(self, texts: List[str]) -> tuple[Tensor, Tensor]:
+        # token embeddings and mask, as the other encoders
+        return self.get_last_hidden_state(texts, return_mask=True)
@@ -17,8 +17,10 @@ class DistilbertEncoderTransformer(DistilbertEncoderBase):
                  ff_size: int = 1024,
                  num_layers: int = 4, num_heads: int = 4,
                  dropout: float = 0.1,
-                 activation: str = "gelu", **kwargs) -> None:
-        super().__init__(modelpath=hack_path(modelpath), finetune=finetune)
+                 activation: str = "gelu",
+                 quantize: bool = False, **kwargs) -> None:
+        super().__init__(modelpath=hack_path(modelpath), finetune=finetune,
+                         quantize=quantize)
         self.save_hyperparameters(logger=False)
         encoded_dim = self.text_encoded_dim
         latent_dim = latent_dim
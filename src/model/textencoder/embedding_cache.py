@@ -0,0 +1,127 @@
+import hashlib
+import os
+from collections import OrderedDict
+from os.path import exists, join
+from typing import Callable, List, Tuple
+
+import torch
+from torch import Tensor
+
+
+def normalize_text(text: str) -> str:
+    # the tokenizers collapse whitespace anyway
+    return ' '.join(text.split())
+
+
+class TextEmbeddingCache:
+    """
+    LRU cache of the outputs of a frozen text encoder, with an optional
+    on-disk store shared across runs. Entries are the per-text (embedding, mask)
+    rows of encoders that pad to a fixed length, so a batch is rebuilt by
+    stacking the rows of its texts. The null prompt '' used for classifier-free
+    guidance is pinned and never evicted.
+
+    Entries are kept on CPU, so that a full cache (e.g. 8192 CLIP rows of
+    77x768) does not take device memory. The rows of a batch are stacked into
+    one pinned buffer and copied to the device without blocking.
+
+    Args:
+        name: name of the encoder, part of the key of the on-disk entries
+        max_entries: maximum number of texts kept in memory
+        cache_dir: directory of the on-disk store, None to disable it
+    """
+    def __init__(self, name: str, max_entries: int = 8192,
+                 cache_dir: str = None):
+        self.name = name
+        self.max_entries = max_entries
+        self.cache_dir = None
+        if cache_dir is not None:
+            self.cache_dir = join(cache_dir, name)
+            os.makedirs(self.cache_dir, exist_ok=True)
+        self._entries = OrderedDict()
+        self._pinned = {}
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries) + len(self._pinned)
+
+    def clear(self):
+        self._entries.clear()
+        self._pinned.clear()
+
+    def _disk_path(self, text: str) -> str:
+        key = hashlib.sha1(f'{self.name}:{text}'.encode()).hexdigest()
+        return join(self.cache_dir, f'{key}.pt')
+
+    def _lookup(self, text: str, device):
+        if text in self._pinned:
+            return self._pinned[text]
+        if text in self._entries:
+            self._entries.move_to_end(text)
+            return self._entries[text]
+        if self.cache_dir is not None and exists(self._disk_path(text)):
+            entry = torch.load(self._disk_path(text), map_location='cpu')
+            if entry['text'] == text:
+                entry = (entry['emb'], entry['mask'])
+                self._store(text, entry, to_disk=False)
+                return entry
+        return None
+
+    def _store(self, text: str, entry: Tuple[Tensor, Tensor],
+               to_disk: bool = True):
+        if text == '':
+            self._pinned[text] = entry
+        else:
+            self._entries[text] = entry
+            self._entries.move_to_end(text)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        if to_disk and self.cache_dir is not None:
+            path = self._disk_path(text)
+            tmp_path = f'{path}.{os.getpid()}.tmp'
+            torch.save({'text': text, 'emb': entry[0],
+                        'mask': entry[1]}, tmp_path)
+            os.replace(tmp_path, path)
+
+    def encode(self, texts: List[str], encode_fn: Callable, device):
+        """
+        Args:
+            texts: the batch of texts
+            encode_fn: texts -> (embeddings [B, L, D], mask [B, L]), called
+                once on the unique texts that are not cached
+            device: device of the returned tensors
+        returns:
+            embeddings and mask of the batch as encode_fn would return them
+        """
+        texts = [normalize_text(t) for t in texts]
+        found = {}
+        missing = []
+        for t in dict.fromkeys(texts):
+            entry = self._lookup(t, device)
+            if entry is None:
+                missing.append(t)
+            else:
+                found[t] = entry
+        self.hits += len(texts) - len(missing)
+        self.misses += len(missing)
+        if missing:
+            with torch.no_grad():
+                emb, mask = encode_fn(missing)
+            # one copy to the host for all the new entries
+            emb, mask = emb.detach().cpu(), mask.cpu()
+            for i, t in enumerate(missing):
+                entry = (emb[i].clone(), mask[i].clone())
+                self._store(t, entry)
+                found[t] = entry
+        return (self._stack([found[t][0] for t in texts], device),
+                self._stack([found[t][1] for t in texts], device))
+
+    @staticmethod
+    def _stack(rows: List[Tensor], device) -> Tensor:
+        device = torch.device(device)
+        pin = device.type == 'cuda' and torch.cuda.is_available()
+        out = torch.empty((len(rows), *rows[0].shape), dtype=rows[0].dtype,
+                          pin_memory=pin)
+        torch.stack(rows, out=out)
+        return out.to(device, non_blocking=pin)
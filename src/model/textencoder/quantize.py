@@ -0,0 +1,124 @@
+"""
+Dynamic int8 quantization of frozen text encoders, for CPU inference.
+
+The weights of the linear layers are quantized once when the encoder is built
+(`quantize: true` in its config), their activations are quantized on the fly.
+Quantized layers run on CPU only: moving a quantized encoder to a GPU raises.
+
+Report the drift of the quantized embeddings over the MotionFix edit texts:
+    python -m src.model.textencoder.quantize --encoder clip \\
+        --modelpath deps/clip-vit-large-patch14 \\
+        --datapath data/motionfix-dataset/motionfix.pth.tar
+"""
+import logging
+import time
+from typing import List
+
+import numpy as np
+import torch
+from torch import nn
+
+log = logging.getLogger(__name__)
+
+
+def quantize_dynamic_int8(model: nn.Module) -> nn.Module:
+    """the linear layers of model replaced by dynamic int8 ones, in place"""
+    if any(p.is_cuda for p in model.parameters()):
+        raise ValueError('Dynamic int8 quantization runs on CPU only.')
+    return torch.ao.quantization.quantize_dynamic(model, {nn.Linear},
+                                                  dtype=torch.qint8,
+                                                  inplace=True)
+
+
+def is_quantized(model: nn.Module) -> bool:
+    return any(isinstance(m, torch.ao.nn.quantized.dynamic.Linear)
+               for m in model.modules())
+
+
+def check_cpu_only(model: nn.Module):
+    """
+    raise if a quantized model has parameters off the CPU: the packed int8
+    weights stay on CPU whatever the device the module is moved to
+    """
+    if model is None or not is_quantized(model):
+        return
+    devices = {p.device.type for p in model.parameters()}
+    if devices - {'cpu'}:
+        raise RuntimeError(f'The text encoder is quantized to int8, which runs '
+                           f'on CPU only, but it was moved to {devices}. Keep '
+                           'it on CPU or set quantize: false in its config.')
+
+
+@torch.no_grad()
+def embedding_parity(reference, quantized, texts: List[str],
+                     batch_size: int = 64) -> dict:
+    """
+    Cosine similarity of the token embeddings (valid tokens only) of the
+    quantized encoder against the fp32 one, and the encoding time of both.
+
+    Args:
+        reference: the fp32 encoder
+        quantized: the same encoder with quantize=True
+        texts: the texts to encode
+        batch_size: texts per forward
+    returns:
+        mean, min and 1st percentile of the cosine similarity, ms per text
+    """
+    sims = []
+    elapsed = {'fp32': 0.0, 'int8': 0.0}
+    for i in range(0, len(texts), batch_size):
+        chunk = texts[i:i + batch_size]
+        start = time.perf_counter()
+        ref_emb, mask = reference._encode(chunk)
+        elapsed['fp32'] += time.perf_counter() - start
+        start = time.perf_counter()
+        q_emb, _ = quantized._encode(chunk)
+        elapsed['int8'] += time.perf_counter() - start
+        cos = nn.functional.cosine_similarity(ref_emb.float(), q_emb.float(),
+                                              dim=-1)
+        sims.append(cos[mask].cpu().numpy())
+    sims = np.concatenate(sims)
+    return {'cos_mean': float(sims.mean()),
+            'cos_min': float(sims.min()),
+            'cos_p1': float(np.percentile(sims, 1)),
+            'fp32_ms_per_text': elapsed['fp32'] / len(texts) * 1e3,
+            'int8_ms_per_text': elapsed['int8'] / len(texts) * 1e3}
+
+
+def motionfix_texts(datapath: str) -> List[str]:
+    """the unique edit texts of the MotionFix joblib dataset"""
+    import joblib
+    data = joblib.load(datapath)
+    return sorted({datum['text'] for datum in data.values()})
+
+
+if __name__ == '__main__':
+    import argparse
+    import json
+    from src.model.textencoder import (ClipTextEncoder,
+                                       DistilbertEncoderTransformer,
+                                       T5TextEncoder)
+    encoders = {'clip': ClipTextEncoder, 't5': T5TextEncoder,
+                'distilbert': DistilbertEncoderTransformer}
+
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    parser = argparse.ArgumentParser(
+        description="Compare int8 and fp32 text embeddings on the MotionFix texts.")
+    parser.add_argument("--encoder", type=str, default='clip',
+                        choices=list(encoders))
+    parser.add_argument("--modelpath", type=str, required=True)
+    parser.add_argument("--datapath", type=str, required=True,
+                        help="The MotionFix joblib dataset")
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--threads", type=int, default=None)
+    args = parser.parse_args()
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    texts = motionfix_texts(args.datapath)
+    log.info(f'{len(texts)} texts')
+    encoder_cls = encoders[args.encoder]
+    reference = encoder_cls(args.modelpath, cache_size=0).eval()
+    quantized = encoder_cls(args.modelpath, cache_size=0, quantize=True).eval()
+    log.info(json.dumps(embedding_parity(reference, quantized, texts,
+                                         args.batch_size), indent=2))
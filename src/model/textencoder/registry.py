@@ -0,0 +1,113 @@
+"""
+Shared frozen text encoders.
+
+A frozen text encoder is the pretrained model of its config, so all the models
+of a process built with the same config can use one instance, loaded once. The
+checkpoints of such models do not need its weights either: they store a
+reference to the config instead (see MD.on_save_checkpoint) and the encoder is
+attached from this registry when they are loaded.
+
+    text_encoder = get_text_encoder(cfg.model.text_encoder)
+
+Slim an existing checkpoint that still contains the encoder weights:
+    python -m src.model.textencoder.registry path/to/last.ckpt [--out slim.ckpt]
+"""
+import json
+import logging
+from typing import Dict
+
+from hydra.utils import instantiate
+from omegaconf import DictConfig, OmegaConf
+
+log = logging.getLogger(__name__)
+
+# the checkpoint entry referencing the encoder whose weights were not saved
+FROZEN_ENCODER_KEY = 'frozen_text_encoder'
+TEXT_ENCODER_PREFIX = 'text_encoder.'
+
+_ENCODERS = {}
+
+
+def encoder_config(cfg) -> dict:
+    if isinstance(cfg, DictConfig):
+        return OmegaConf.to_container(cfg, resolve=True)
+    return dict(cfg)
+
+
+def encoder_key(cfg) -> str:
+    return json.dumps(encoder_config(cfg), sort_keys=True)
+
+
+def get_text_encoder(cfg):
+    """
+    the encoder of a frozen config shared by the models of the process,
+    instantiated on first use; encoders that are finetuned are never shared
+    """
+    if cfg.get('finetune', False):
+        return instantiate(cfg)
+    key = encoder_key(cfg)
+    if key not in _ENCODERS:
+        _ENCODERS[key] = instantiate(cfg)
+    else:
+        log.info(f'Reusing the loaded text encoder {cfg.get("_target_")}')
+    return _ENCODERS[key]
+
+
+def is_frozen(encoder) -> bool:
+    params = list(encoder.parameters())
+    return bool(params) and not any(p.requires_grad for p in params)
+
+
+def strip_encoder_weights(state_dict: Dict, prefix: str = TEXT_ENCODER_PREFIX):
+    """remove the encoder entries of a state dict in place, returns their number"""
+    keys = [k for k in state_dict if k.startswith(prefix)]
+    for k in keys:
+        del state_dict[k]
+    return len(keys)
+
+
+def fill_encoder_weights(state_dict: Dict, encoder,
+                         prefix: str = TEXT_ENCODER_PREFIX):
+    """add the missing encoder entries of a slim state dict from `encoder`"""
+    for k, v in encoder.state_dict().items():
+        state_dict.setdefault(f'{prefix}{k}', v)
+
+
+def slim_checkpoint(ckpt_path: str, out_path: str = None):
+    """
+    Rewrite a checkpoint without the weights of its frozen text encoder.
+
+    Args:
+        ckpt_path: checkpoint of an MD model
+        out_path: where to write the slim checkpoint, ckpt_path if None
+    """
+    import torch
+    checkpoint = torch.load(ckpt_path, map_location='cpu')
+    if FROZEN_ENCODER_KEY in checkpoint:
+        log.info(f'{ckpt_path} is already slim.')
+        return
+    cfg = checkpoint['hyper_parameters']['text_encoder']
+    if cfg.get('finetune', False) or not is_frozen(get_text_encoder(cfg)):
+        log.info(f'The text encoder of {ckpt_path} is trained, nothing to strip.')
+        return
+    n = strip_encoder_weights(checkpoint['state_dict'])
+    checkpoint[FROZEN_ENCODER_KEY] = {'prefix': TEXT_ENCODER_PREFIX,
+                                      'config': encoder_config(cfg)}
+    out_path = out_path or ckpt_path
+    torch.save(checkpoint, out_path)
+    log.info(f'Removed {n} text encoder tensors, wrote {out_path}')
+
+
+if __name__ == '__main__':
+    import argparse
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    parser = argparse.ArgumentParser(
+        description="Remove the frozen text encoder weights of checkpoints.")
+    parser.add_argument("ckpts", type=str, nargs='+')
+    parser.add_argument("--out", type=str, default=None,
+                        help="Output path, only with a single checkpoint")
+    args = parser.parse_args()
+    if args.out is not None and len(args.ckpts) > 1:
+        parser.error('--out needs a single checkpoint')
+    for path in args.ckpts:
+        slim_checkpoint(path, args.out)
@@ -5,6 +5,7 @@ import torch
 from torch import Tensor, nn
 from torch.distributions.distribution import Distribution
 from src.utils.file_io import hack_path
+from src.model.textencoder.embedding_cache import TextEmbeddingCache
 import pytorch_lightning as pl
 
 class T5TextEncoder(pl.LightningModule):
@@ -13,6 +14,9 @@ class T5TextEncoder(pl.LightningModule):
             self,
             modelpath: str,
             finetune: bool = False,
+            cache_size: int = 8192,
+            cache_dir: str = None,
+            quantize: bool = False,
             **kwargs
         ) -> None:
 
@@ -37,8 +41,32 @@ class T5TextEncoder(pl.LightningModule):
             self.language_model.training = False
             for p in self.language_model.parameters():
                 p.requires_grad = False
+            if quantize:
+                from src.model.textencoder.quantize import quantize_dynamic_int8
+                quantize_dynamic_int8(self.language_model)
+
+        # frozen encoder -> embeddings of a text never change
+        self.cache = None
+        if not finetune and cache_size > 0:
+            # int8 embeddings differ from the fp32 ones, they are cached apart
+            self.cache = TextEmbeddingCache(
+                os.path.basename(os.path.normpath(modelpath)) +
+                ('-int8' if quantize else ''),
+                max_entries=cache_size, cache_dir=cache_dir)
+
+    def _apply(self, fn, *args, **kwargs):
+        super()._apply(fn, *args, **kwargs)
+        from src.model.textencoder.quantize import check_cpu_only
+        check_cpu_only(getattr(self, 'language_model', None))
+        return self
 
     def forward(self, texts: List[str]):
+        if self.cache is not None:
+            return self.cache.encode(texts, self._encode,
+                                     self.language_model.device)
+        return self._encode(texts)
+
+    def _encode(self, texts: List[str]):
  
         # # Tokenize
         text_inputs = self.tokenizer(texts,
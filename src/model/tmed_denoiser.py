@@ -8,6 +8,13 @@ from src.model.utils.all_positional_encodings import build_position_encoding
 from src.data.tools.tensors import lengths_to_mask
 from src.model.utils.timestep_embed import TimestepEmbedderMDM
 
+
+def _linear_guidance(scale, curr_ts, max_steps):
+    # guidance decaying linearly with the timestep, never below 1
+    if torch.is_tensor(scale):
+        return torch.clamp(scale*2*curr_ts/max_steps, min=1)
+    return max(1, scale*2*curr_ts/max_steps)
+
 class TMED_denoiser(nn.Module):
 
     def __init__(self,
@@ -69,6 +76,59 @@ class TMED_denoiser(nn.Module):
         self.encoder = nn.TransformerEncoder(encoder_layer,
                                                 num_layers=num_layers)
 
+    def prepare_conditions(self,
+                           in_motion_mask,
+                           text_embeds,
+                           condition_mask,
+                           motion_embeds=None):
+        """
+        Project the conditions and build the padding mask of the sequence.
+        None of them depends on the noised motion or the timestep, so a
+        sampling loop computes them once and passes them to every step.
+        """
+        if self.condition not in ["text", "text_uncond"]:
+            raise TypeError(f"condition type {self.condition} not supported")
+        bs = text_embeds.shape[0]
+        # make it seq first
+        text_embeds = text_embeds.permute(1, 0, 2)
+        if self.text_encoded_dim != self.latent_dim:
+            # [1 or 2, bs, latent_dim] <= [1 or 2, bs, text_encoded_dim]
+            text_emb_latent = self.emb_proj(text_embeds)
+        else:
+            text_emb_latent = text_embeds
+        n_text_tokens = text_emb_latent.shape[0]
+        cond_tokens = [text_emb_latent]
+        # time token | text tokens | motion tokens | sep token | target frames
+        time_token_mask = torch.ones((bs, 1), dtype=bool,
+                                     device=text_emb_latent.device)
+        if motion_embeds is None:
+            aug_mask = torch.cat((time_token_mask,
+                                  condition_mask[:, :n_text_tokens],
+                                  in_motion_mask), 1)
+        else:
+            zeroes_mask = (motion_embeds == 0).all(dim=-1)
+            if motion_embeds.shape[-1] != self.latent_dim:
+                motion_embeds_proj = self.pose_proj_in_source(motion_embeds)
+                motion_embeds_proj[zeroes_mask] = 0
+            else:
+                motion_embeds_proj = motion_embeds
+            cond_tokens.append(motion_embeds_proj)
+            mask_parts = [time_token_mask, condition_mask[:, :n_text_tokens],
+                          condition_mask[:, n_text_tokens:]]
+            if self.use_sep:
+                sep_token_batch = torch.tile(self.sep_token, (bs,)).reshape(bs,
+                                                                         -1)
+                cond_tokens.append(sep_token_batch[None])
+                mask_parts.append(torch.ones((bs, self.sep_token.shape[0]),
+                                             dtype=bool,
+                                             device=text_emb_latent.device))
+            aug_mask = torch.cat((*mask_parts, in_motion_mask), 1)
+
+        return {'cond_tokens': torch.cat(cond_tokens, 0),
+                'key_padding_mask': ~aug_mask,
+                'in_motion_mask': in_motion_mask,
+                'motion_embeds': motion_embeds}
+
     def forward(self,
                 noised_motion,
                 timestep,
@@ -77,14 +137,18 @@ class TMED_denoiser(nn.Module):
                 condition_mask, 
                 motion_embeds=None,
                 lengths=None,
+                prepared_conds=None,
                 **kwargs):
         # 0.  dimension matching
         # noised_motion [latent_dim[0], batch_size, latent_dim] <= [batch_size, latent_dim[0], latent_dim[1]]
-        bs = noised_motion.shape[0]
         noised_motion = noised_motion.permute(1, 0, 2)
-        # 0. check lengths for no vae (diffusion only)
-        # if lengths not in [None, []]:
-        motion_in_mask = in_motion_mask
+        if prepared_conds is None:
+            prepared_conds = self.prepare_conditions(in_motion_mask,
+                                                     text_embeds,
+                                                     condition_mask,
+                                                     motion_embeds)
+        motion_in_mask = prepared_conds['in_motion_mask']
+        motion_embeds = prepared_conds['motion_embeds']
 
         # time_embedding | text_embedding | frames_source | frames_target
         # 1 * lat_d | max_text * lat_d | max_frames * lat_d | max_frames * lat_d
@@ -94,101 +158,18 @@ class TMED_denoiser(nn.Module):
         # broadcast to batch dimension in a way that's compatible with ONNX/Core ML
         timesteps = timestep.expand(noised_motion.shape[1]).clone()
         time_emb = self.embed_timestep(timesteps).to(dtype=noised_motion.dtype)
-        # make it S first
-        # time_emb = self.time_embedding(time_emb).unsqueeze(0)
-        if self.condition in ["text", "text_uncond"]:
-            # make it seq first
-            text_embeds = text_embeds.permute(1, 0, 2)
-            if self.text_encoded_dim != self.latent_dim:
-                # [1 or 2, bs, latent_dim] <= [1 or 2, bs, text_encoded_dim]
-                text_emb_latent = self.emb_proj(text_embeds)
-            else:
-                text_emb_latent = text_embeds
-                # source_motion_zeros = torch.zeros(*noised_motion.shape[:2], 
-                #                             self.latent_dim, 
-                #                             device=noised_motion.device)
-                # aux_fake_mask = torch.zeros(condition_mask.shape[0], 
-                #                             noised_motion.shape[0], 
-                #                             device=noised_motion.device)
-                # condition_mask = torch.cat((condition_mask, aux_fake_mask), 
-                #                            1).bool().to(noised_motion.device)
-            emb_latent = torch.cat((time_emb, text_emb_latent), 0)
 
-            if motion_embeds is not None:
-                zeroes_mask = (motion_embeds == 0).all(dim=-1)
-                if motion_embeds.shape[-1] != self.latent_dim:
-                    motion_embeds_proj = self.pose_proj_in_source(motion_embeds)
-                    motion_embeds_proj[zeroes_mask] = 0
-                else:
-                    motion_embeds_proj = motion_embeds
- 
-        else:
-            raise TypeError(f"condition type {self.condition} not supported")
         # 4. transformer
         # if self.diffusion_only:
         proj_noised_motion = self.pose_proj_in_target(noised_motion)
-
-        if motion_embeds is None:
-            xseq = torch.cat((emb_latent, proj_noised_motion), axis=0)
-        else:
-            if self.use_sep:
-
-                sep_token_batch = torch.tile(self.sep_token, (bs,)).reshape(bs,
-                                                                         -1)
-                xseq = torch.cat((emb_latent, motion_embeds_proj,
-                                sep_token_batch[None],
-                                proj_noised_motion), axis=0)
-            else:
-                xseq = torch.cat((emb_latent, motion_embeds_proj,
-                                  proj_noised_motion), axis=0)
-        # if self.ablation_skip_connection:
-        #     xseq = self.query_pos(xseq)
-        #     tokens = self.encoder(xseq)
-        # else:
-        #     # adding the timestep embed
-        #     # [seqlen+1, bs, d]
-        #     # todo change to query_pos_decoder
+        cond_tokens = prepared_conds['cond_tokens']
+        xseq = torch.cat((time_emb, cond_tokens, proj_noised_motion), axis=0)
         xseq = self.query_pos(xseq)
-        # BUILD the mask now
-        if motion_embeds is None:
-            time_token_mask = torch.ones((bs, time_emb.shape[0]),
-                                        dtype=bool, device=xseq.device)
-            aug_mask = torch.cat((time_token_mask,
-                                  condition_mask[:, :text_emb_latent.shape[0]],
-                                  motion_in_mask), 1)
-        else:
-            time_token_mask = torch.ones((bs, time_emb.shape[0]),
-                                        dtype=bool,
-                                        device=xseq.device)
-            if self.use_sep:
-                sep_token_mask = torch.ones((bs, self.sep_token.shape[0]),
-                                        dtype=bool,
-                                        device=xseq.device)
-            if self.use_sep:
-                aug_mask = torch.cat((time_token_mask,
-                                condition_mask[:, :text_emb_latent.shape[0]],
-                                condition_mask[:, text_emb_latent.shape[0]:],
-                                sep_token_mask,
-                                motion_in_mask,
-                                ), 1)
-            else:
-                aug_mask = torch.cat((time_token_mask,
-                                condition_mask[:, :text_emb_latent.shape[0]],
-                                condition_mask[:, text_emb_latent.shape[0]:],
-                                motion_in_mask,
-                                ), 1)
-        tokens = self.encoder(xseq, src_key_padding_mask=~aug_mask)
+        tokens = self.encoder(xseq,
+                              src_key_padding_mask=prepared_conds['key_padding_mask'])
 
-        # if self.diffusion_only:
-        if motion_embeds is not None:
-            denoised_motion_proj = tokens[emb_latent.shape[0]:]
-            if self.use_sep:
-                useful_tokens = motion_embeds_proj.shape[0]+1
-            else:
-                useful_tokens = motion_embeds_proj.shape[0]
-            denoised_motion_proj = denoised_motion_proj[useful_tokens:]
-        else:
-            denoised_motion_proj = tokens[emb_latent.shape[0]:]
+        # drop time and condition tokens
+        denoised_motion_proj = tokens[time_emb.shape[0] + cond_tokens.shape[0]:]
 
         denoised_motion = self.pose_proj_out(denoised_motion_proj)
         if self.pred_delta_motion and motion_embeds is not None:
@@ -202,8 +183,6 @@ class TMED_denoiser(nn.Module):
 
         denoised_motion[~motion_in_mask.T] = 0
         # zero for padded area
-        # else:
-        #     sample = tokens[:sample.shape[0]]
         # 5. [batch_size, latent_dim[0], latent_dim[1]] <= [latent_dim[0], batch_size, latent_dim[1]]
         denoised_motion = denoised_motion.permute(1, 0, 2)
         return denoised_motion
@@ -221,6 +200,7 @@ class TMED_denoiser(nn.Module):
                               inpaint_dict=None,
                               max_steps=None,
                               prob_way='3way',
+                              prepared_conds=None,
                               **kwargs):
         # if motion embeds is None
         # TODO put here that you have tow
@@ -229,10 +209,15 @@ class TMED_denoiser(nn.Module):
         # timestep
         if max_steps is not None:
             curr_ts = timestep[0].item()
-            g_m = max(1, guidance_motion*2*curr_ts/max_steps)
-            guidance_motion = g_m
-            g_t_tm = max(1, guidance_text_n_motion*2*curr_ts/max_steps)
-            guidance_text_n_motion = g_t_tm
+            guidance_motion = _linear_guidance(guidance_motion, curr_ts,
+                                               max_steps)
+            guidance_text_n_motion = _linear_guidance(guidance_text_n_motion,
+                                                      curr_ts, max_steps)
+        # per-sample scales [B] of a guidance grid, broadcast over the frames
+        if torch.is_tensor(guidance_motion):
+            guidance_motion = guidance_motion.view(-1, 1, 1)
+        if torch.is_tensor(guidance_text_n_motion):
+            guidance_text_n_motion = guidance_text_n_motion.view(-1, 1, 1)
 
         if motion_embeds is None:
             half = noised_motion[: len(noised_motion) // 2]
@@ -242,7 +227,8 @@ class TMED_denoiser(nn.Module):
                                     text_embeds=text_embeds,
                                     condition_mask=condition_mask, 
                                     motion_embeds=motion_embeds,
-                                    lengths=lengths)
+                                    lengths=lengths,
+                                    prepared_conds=prepared_conds)
             uncond_eps, cond_eps_text = torch.split(model_out, len(model_out) // 2,
                                                      dim=0)
             # make it BxSxfeatures
@@ -273,7 +259,8 @@ class TMED_denoiser(nn.Module):
                                      text_embeds=text_embeds,
                                      condition_mask=condition_mask, 
                                      motion_embeds=motion_embeds,
-                                     lengths=lengths)
+                                     lengths=lengths,
+                                     prepared_conds=prepared_conds)
             # For exact reproducibility reasons, we apply classifier-free guidance on only
             # three channels by default. The standard approach to cfg applies it to all channels.
             # This can be done by uncommenting the following line and commenting-out the line following that.
@@ -252,6 +252,155 @@ def fast_lbs(
 
     return J_transformed
 
+def kinematic_levels(parents: Tensor) -> List[Tensor]:
+    ''' Groups the joints of a kinematic tree by depth, so that all the joints
+        of a level can be posed at once given the previous level
+    '''
+    parents = parents.tolist()
+    depth = [0] * len(parents)
+    for i in range(1, len(parents)):
+        depth[i] = depth[parents[i]] + 1
+    return [torch.tensor([i for i, d in enumerate(depth) if d == lvl])
+            for lvl in range(1, max(depth) + 1)]
+
+
+def batch_rigid_joints(
+    rot_mats: Tensor,
+    joints: Tensor,
+    parents: Tensor,
+    levels: List[Tensor]
+) -> Tensor:
+    """
+    Same posed joints as batch_rigid_transform, without building the 4x4
+    transformations and the relative transforms needed only for skinning.
+
+    Parameters
+    ----------
+    rot_mats : torch.tensor BxNx3x3
+        Tensor of rotation matrices
+    joints : torch.tensor BxNx3 or Nx3
+        Locations of joints in the rest pose
+    parents : torch.tensor N
+        The kinematic tree
+    levels : list of torch.tensor
+        Joints grouped by depth in the tree, see kinematic_levels
+
+    Returns
+    -------
+    posed_joints : torch.tensor BxNx3
+        The locations of the joints after applying the pose rotations
+    """
+    batch_size = rot_mats.shape[0]
+    joints = joints.expand(batch_size, -1, -1)
+    rel_joints = joints.clone()
+    rel_joints[:, 1:] -= joints[:, parents[1:]]
+
+    glob_rots = rot_mats.clone()
+    posed_joints = rel_joints.clone()
+    for idx in levels:
+        par = parents[idx]
+        glob_rots[:, idx] = torch.matmul(glob_rots[:, par], rot_mats[:, idx])
+        posed_joints[:, idx] = posed_joints[:, par] + torch.matmul(
+            glob_rots[:, par], rel_joints[:, idx].unsqueeze(-1)).squeeze(-1)
+    return posed_joints
+
+
+def rest_joints(self, betas: Optional[Tensor]) -> Tensor:
+    ''' Joints of the rest pose, cached per betas on the body model.
+        Returns a Jx3 tensor when the betas are shared by the batch (always the
+        case for betas=None) and BxJx3 otherwise.
+    '''
+    device, dtype = self.shapedirs.device, self.shapedirs.dtype
+    if betas is not None and not (betas == betas[:1]).all():
+        v_shaped = self.v_template + blend_shapes(betas, self.shapedirs)
+        return vertices2joints(self.J_regressor, v_shaped)
+
+    betas_key = None if betas is None else tuple(betas[0].tolist())
+    key = (betas_key, device, dtype)
+    cache = self.__dict__.setdefault('_rest_joints_cache', {})
+    if key not in cache:
+        if betas is None:
+            v_shaped = self.v_template
+        else:
+            v_shaped = self.v_template + blend_shapes(betas[:1],
+                                                      self.shapedirs)[0]
+        cache[key] = torch.matmul(self.J_regressor, v_shaped)
+    return cache[key]
+
+
+def smpl_joints_fast(
+    self,
+    betas: Optional[Tensor] = None,
+    global_orient: Optional[Tensor] = None,
+    body_pose: Optional[Tensor] = None,
+    left_hand_pose: Optional[Tensor] = None,
+    right_hand_pose: Optional[Tensor] = None,
+    transl: Optional[Tensor] = None,
+    n_joints: Optional[int] = None,
+    **kwargs
+) -> Tensor:
+        ''' Joints-only forward pass for the SMPL+H model. No pose blend
+            shapes and no skinning, the joints of the rest pose are cached per
+            betas. Same arguments as smpl_forward_fast (rotation matrices).
+
+            Parameters
+            ----------
+            n_joints: int, optional
+                Pose only the first n_joints of the kinematic tree, e.g. 22
+                for the body joints without the hands. (default=all)
+
+            Returns
+            -------
+            joints: torch.tensor BxJx3
+        '''
+        model_vars = [betas, global_orient, body_pose, transl, left_hand_pose,
+                      right_hand_pose]
+        batch_size = 1
+        for var in model_vars:
+            if var is None:
+                continue
+            batch_size = max(batch_size, len(var))
+        device, dtype = self.shapedirs.device, self.shapedirs.dtype
+        ident = torch.eye(3, device=device, dtype=dtype).view(1, 1, 3, 3)
+        if global_orient is None:
+            global_orient = ident.expand(batch_size, -1, -1, -1)
+        if body_pose is None:
+            body_pose = ident.expand(batch_size, self.NUM_BODY_JOINTS, -1, -1)
+        if left_hand_pose is None:
+            left_hand_pose = ident.expand(batch_size, self.NUM_HAND_JOINTS, -1, -1)
+        if right_hand_pose is None:
+            right_hand_pose = ident.expand(batch_size, self.NUM_HAND_JOINTS, -1, -1)
+
+        full_pose = torch.cat(
+            [global_orient.reshape(-1, 1, 3, 3),
+             body_pose.reshape(-1, self.NUM_BODY_JOINTS, 3, 3),
+             left_hand_pose.reshape(-1, self.NUM_HAND_JOINTS, 3, 3),
+             right_hand_pose.reshape(-1, self.NUM_HAND_JOINTS, 3, 3)],
+            dim=1)
+        joints = pose_joints(self, full_pose, betas, n_joints)
+        if transl is not None:
+            joints = joints + transl.unsqueeze(dim=1)
+        return joints
+
+
+def pose_joints(self, full_pose: Tensor, betas: Optional[Tensor] = None,
+                n_joints: Optional[int] = None) -> Tensor:
+    ''' Posed joints (without translation) for a BxJx3x3 full pose '''
+    J = rest_joints(self, betas)
+    num_joints = J.shape[-2] if n_joints is None else n_joints
+    device = full_pose.device
+    levels_cache = self.__dict__.setdefault('_kinematic_levels_cache', {})
+    if (num_joints, device) not in levels_cache:
+        # parents of the first joints are always among the first joints
+        levels_cache[(num_joints, device)] = [
+            lvl.to(device) for lvl in
+            kinematic_levels(self.parents[:num_joints])]
+    return batch_rigid_joints(full_pose[:, :num_joints],
+                              J[..., :num_joints, :],
+                              self.parents[:num_joints],
+                              levels_cache[(num_joints, device)])
+
+
 def smpl_forward_fast(
     self,
     betas: Optional[Tensor] = None,
@@ -338,10 +487,8 @@ def smpl_forward_fast(
              right_hand_pose.reshape(-1, self.NUM_HAND_JOINTS, 3, 3)],
             dim=1)
 
-        joints = fast_lbs(betas, full_pose, self.v_template,
-                          self.shapedirs, self.posedirs,
-                          self.J_regressor, self.parents,
-                          self.lbs_weights, pose2rot=False)
+        # only the joints are returned, no need for pose blend shapes
+        joints = pose_joints(self, full_pose, betas)
 
         # # Add any extra joints that might be needed
         # joints = self.vertex_joint_selector(vertices, joints)
@@ -0,0 +1,221 @@
+"""
+Pool of rendering worker processes.
+
+`render_motion` renders on the training process, one sequence after the other,
+and every caption or stack re-encodes the video. The workers of the pool each
+keep a warm aitviewer `HeadlessRenderer` and SMPL-H layer, render the frames of
+a job and write the final (stacked, captioned) video with a single ffmpeg
+encode, while the caller keeps training and collects the videos later.
+
+    pool = RenderPool('data/body_models', num_workers=2)
+    pool.submit(motion, 'visuals/epoch_010/000123_text', text='walk faster',
+                stack_with=[src_vid, tgt_vid], tag='text_cond/000123')
+    ...
+    for tag, path in pool.collect():
+        ...
+"""
+import glob
+import logging
+import multiprocessing
+import os
+import shutil
+import tempfile
+from typing import List, Tuple
+
+import numpy as np
+
+log = logging.getLogger(__name__)
+
+# the kinds of motions a job can hold
+JOB_KINDS = ('smpl', 'joints', 'vertices')
+
+# state of a worker process, built once by _init_worker
+_WORKER = {}
+
+
+def _to_numpy(x):
+    if hasattr(x, 'detach'):
+        return x.detach().cpu().float().numpy()
+    return np.asarray(x, dtype=np.float32)
+
+
+def _init_worker(body_models_path: str):
+    # aitviewer prints on every render, silence the worker once instead of
+    # redirecting stdout around each sequence
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, 1)
+    os.close(devnull)
+
+    from aitviewer.models.smpl import SMPLLayer
+    from src.render.video import get_offscreen_renderer
+
+    _WORKER['renderer'] = get_offscreen_renderer(body_models_path)
+    _WORKER['smpl_layer'] = SMPLLayer(model_type='smplh', ext='npz',
+                                      gender='neutral')
+
+
+def _build_nodes(job: dict):
+    """aitviewer renderables of a job and the position of its camera"""
+    smpl_layer = _WORKER['smpl_layer']
+    motion = job['motion']
+    if job['kind'] == 'smpl':
+        import torch
+        from aitviewer.renderables.smpl import SMPLSequence
+        from src.tools.transforms3d import get_z_rot, transform_body_pose
+
+        body_orient = torch.from_numpy(motion['body_orient'])
+        body_pose = torch.from_numpy(motion['body_pose'])
+        body_transl = torch.from_numpy(motion['body_transl'])
+        if job['pose_repr'] != 'aa':
+            body_orient = transform_body_pose(body_orient,
+                                              f"{job['pose_repr']}->aa")
+            body_pose = transform_body_pose(body_pose,
+                                            f"{job['pose_repr']}->aa")
+        node = SMPLSequence(body_pose, smpl_layer,
+                            poses_root=body_orient,
+                            trans=body_transl,
+                            color=job['color'],
+                            z_up=True)
+        # same camera as render_motion, in front of the first pose
+        R_z = get_z_rot(body_orient[0], in_format='aa')
+        heading = -R_z[:, 1]
+        xy_facing = body_transl[0] + heading*2.5
+        cam_position = (xy_facing[0], xy_facing[1], 1.5)
+    elif job['kind'] == 'joints':
+        from aitviewer.renderables.skeletons import Skeletons
+        from src.utils.smpl_body_utils import get_smpl_skeleton
+
+        node = Skeletons(joint_positions=motion,
+                         joint_connections=get_smpl_skeleton(),
+                         color=job['color'],
+                         radius=0.03)
+        cam_position = (2, 2, 2)
+    else:
+        from aitviewer.renderables.meshes import Meshes
+
+        node = Meshes(motion, smpl_layer.faces, color=job['color'])
+        cam_position = (2, 2, 2)
+    return node, cam_position
+
+
+def _render_job(job: dict) -> str:
+    renderer = _WORKER['renderer']
+    out_path = job['out_path']
+    frame_dir = tempfile.mkdtemp(prefix='frames_',
+                                 dir=os.path.dirname(out_path) or '.')
+    node, cam_position = _build_nodes(job)
+    renderer.scene.add(node)
+    camera = renderer.lock_to_node(node, cam_position, smooth_sigma=5.0)
+    try:
+        renderer.save_video(frame_dir=frame_dir, output_fps=job['fps'])
+        # aitviewer may nest the frames in a counter folder, flatten them into
+        # one sequence for ffmpeg
+        frames = sorted(glob.glob(f'{frame_dir}/**/*.png', recursive=True))
+        if not frames:
+            raise RuntimeError(f'No frames were rendered for {out_path}.')
+        for i, frame in enumerate(frames):
+            os.replace(frame, os.path.join(frame_dir, f'seq_{i:06d}.png'))
+
+        from src.render.video import encode_frames
+        encode_frames(os.path.join(frame_dir, 'seq_%06d.png'), out_path,
+                      fps=job['fps'], text=job['text'],
+                      stack_with=job['stack_with'])
+    finally:
+        # empty scene for the next job
+        renderer.scene.remove(node)
+        renderer.scene.remove(camera)
+        shutil.rmtree(frame_dir, ignore_errors=True)
+    return out_path
+
+
+class RenderPool:
+    """
+    Renders motions into videos on worker processes. Workers are started with
+    'spawn', OpenGL contexts do not survive a fork.
+
+    Args:
+        body_models_path: folder of the SMPL-H body models
+        num_workers: number of worker processes, each holding a renderer
+        fps: frame rate of the videos
+    """
+    def __init__(self, body_models_path: str, num_workers: int = 2,
+                 fps: float = 30):
+        self.fps = fps
+        ctx = multiprocessing.get_context('spawn')
+        self._pool = ctx.Pool(processes=num_workers,
+                              initializer=_init_worker,
+                              initargs=(str(body_models_path),))
+        self._pending = []
+
+    def __len__(self):
+        return len(self._pending)
+
+    def submit(self, motion, out_path: str, kind: str = 'smpl',
+               text: str = None, stack_with: List[str] = None,
+               color=(160 / 255, 160 / 255, 160 / 255, 1.0),
+               pose_repr: str = 'aa', tag=None):
+        """
+        Queue the rendering of a motion, returns without waiting for it.
+
+        Args:
+            motion: for 'smpl' a dict with body_orient, body_pose and
+                body_transl, for 'joints' [F, J, 3] and for 'vertices' [F, V, 3]
+            out_path: path of the video, '.mp4' is appended if missing
+            kind: one of JOB_KINDS
+            text: caption of the video
+            stack_with: videos to place left of the render, they must exist
+                when the job runs
+            color: RGBA color of the body
+            pose_repr: rotation representation of the 'smpl' poses
+            tag: returned along with the path by collect, e.g. a log name;
+                untagged jobs are not collected, wait on their result instead
+        returns:
+            the multiprocessing.AsyncResult of the job
+        """
+        if kind not in JOB_KINDS:
+            raise ValueError(f'Unknown job kind {kind}, expected one of '
+                             f'{JOB_KINDS}.')
+        if kind == 'smpl':
+            motion = {k: _to_numpy(motion[k])
+                      for k in ('body_orient', 'body_pose', 'body_transl')}
+        else:
+            motion = _to_numpy(motion)
+        out_path = str(out_path)
+        if not out_path.endswith('.mp4'):
+            out_path = f'{out_path}.mp4'
+        job = {'motion': motion, 'out_path': out_path, 'kind': kind,
+               'text': text, 'color': tuple(color),
+               'stack_with': [str(v) for v in stack_with or []],
+               'pose_repr': pose_repr, 'fps': self.fps}
+        result = self._pool.apply_async(_render_job, (job,))
+        if tag is not None:
+            self._pending.append((tag, out_path, result))
+        return result
+
+    def render(self, motion, out_path: str, **kwargs) -> str:
+        """submit a job and wait for its video"""
+        return self.submit(motion, out_path, **kwargs).get()
+
+    def collect(self, wait: bool = False) -> List[Tuple[object, str]]:
+        """
+        (tag, path) of the finished tagged jobs since the last call. Failed
+        jobs are logged and dropped.
+
+        Args:
+            wait: block until all the submitted jobs are finished
+        """
+        finished, pending = [], []
+        for tag, out_path, result in self._pending:
+            if not wait and not result.ready():
+                pending.append((tag, out_path, result))
+                continue
+            try:
+                finished.append((tag, result.get()))
+            except Exception as err:
+                log.warning(f'Rendering of {out_path} failed: {err}')
+        self._pending = pending
+        return finished
+
+    def close(self):
+        self._pool.close()
+        self._pool.join()
@@ -163,14 +163,8 @@ def stack_vids(vids_to_stack: List[str], fname: str, orient='v', v=False):
     x = subprocess.call(cmd_m)
     return fname
 
-def put_text(text: str, fname: str, outf: str,
-             position='bottom_center', 
-             v=False):
-    import subprocess
-    cmd_m = ['ffmpeg']
-    # -i inputClip.mp4 -vf f"drawtext=text='{method}':x=200:y=0:fontsize=22:fontcolor=white" -c:a copy {temp_path}.mp4
-
-    diff_pos = {
+# positions of the caption, as ffmpeg drawtext coordinates
+DRAWTEXT_POSITIONS = {
     'top_left'		: 'x=10:y=10',
     'top_center'	: 'x=(w-text_w)/2:y=10',
     'top_right'		: 'x=w-tw-10:y=10',
@@ -178,10 +172,28 @@ def put_text(text: str, fname: str, outf: str,
     'bottom_left'	: 'x=10:y=h-th-10',
     'bottom_center'	: 'x=(w-text_w)/2:y=h-th-10',
     'bottom_right'	: 'x=w-tw-10:y=h-th-10'
-    }
-    
+}
+
+
+def drawtext_filter(position='bottom_center', text=None, textfile=None):
+    # textfile avoids escaping the quotes and colons of the caption
+    if textfile is not None:
+        source = f"textfile='{textfile}'"
+    else:
+        source = f"text='{text}'"
+    return (f"drawtext={source}:{DRAWTEXT_POSITIONS[position]}:fontsize=45::"
+            "box=1:boxcolor=black@0.6:boxborderw=5:fontcolor=white")
+
+
+def put_text(text: str, fname: str, outf: str,
+             position='bottom_center', 
+             v=False):
+    import subprocess
+    cmd_m = ['ffmpeg']
+    # -i inputClip.mp4 -vf f"drawtext=text='{method}':x=200:y=0:fontsize=22:fontcolor=white" -c:a copy {temp_path}.mp4
+
     cmd_m.extend(['-i',fname, '-y', '-vf', 
-    f"drawtext=text='{text}':{diff_pos[position]}:fontsize=45::box=1:boxcolor=black@0.6:boxborderw=5:fontcolor=white",
+                  drawtext_filter(position, text=text),
                   '-loglevel', 'quiet', '-c:a', 'copy',
                   f'{outf}'])
     
@@ -193,6 +205,55 @@ def put_text(text: str, fname: str, outf: str,
     return outf
 
 
+def encode_frames(frames_pattern: str, outf: str, fps: float = 30,
+                  text: str = None, stack_with: List[str] = None,
+                  position='bottom_center', v=False):
+    """
+    Encode rendered frames into the final video with a single ffmpeg call,
+    instead of encoding them, stacking the result with other videos and
+    captioning it, each of which re-encodes the whole video.
+
+    Args:
+        frames_pattern: printf pattern of the frames, e.g. 'dir/frame_%06d.png'
+        outf: path of the output video
+        fps: frame rate of the frames
+        text: caption drawn over the final video, None for no caption
+        stack_with: videos of the same height placed left of the frames,
+            e.g. the renders of the source and target motions
+        position: position of the caption, a key of DRAWTEXT_POSITIONS
+    """
+    stack_with = list(stack_with or [])
+    cmd_m = ['ffmpeg', '-y', '-loglevel', 'quiet']
+    for vid in stack_with:
+        cmd_m.extend(['-i', str(vid)])
+    cmd_m.extend(['-framerate', str(fps), '-i', frames_pattern])
+
+    n_inputs = len(stack_with) + 1
+    if n_inputs > 1:
+        graph = ''.join(f'[{i}:v]' for i in range(n_inputs))
+        graph += f'hstack=inputs={n_inputs}'
+    else:
+        graph = '[0:v]null'
+    textfile = None
+    if text is not None:
+        textfile = f'{outf}.txt'
+        with open(textfile, 'w') as f:
+            f.write(text)
+        graph += ',' + drawtext_filter(position, textfile=textfile)
+    cmd_m.extend(['-filter_complex', f'{graph}[out]', '-map', '[out]',
+                  '-c:v', 'libx264', '-pix_fmt', 'yuv420p',
+                  '-r', str(fps), str(outf)])
+
+    if v:
+        print('Executing', ' '.join(cmd_m))
+    retcode = subprocess.call(cmd_m)
+    if textfile is not None:
+        os.remove(textfile)
+    if retcode != 0:
+        raise RuntimeError(f"Command {' '.join(cmd_m)} failed with code {retcode}.")
+    return str(outf)
+
+
 def save_video_samples(vid_array, video_path, text, fps=30):
     import cv2
     vid_path = f'{video_path}'
@@ -99,17 +99,17 @@ def contrastive_metrics(
     return_cols=False,
     rounding=2,
     break_ties="averaging",
+    chunk_size=1024,
 ):
     n, m = sims.shape
     assert n == m
     num_queries = n
 
-    dists = -sims
-    sorted_dists = np.sort(dists, axis=1)
     # GT is in the diagonal
-    gt_dists = np.diag(dists)[:, None]
+    gt_dists = -np.diag(sims)[:, None]
 
     if text_selfsim is not None and threshold is not None:
+        dists = -sims
         real_threshold = 2 * threshold - 1
         idx = np.argwhere(text_selfsim > real_threshold)
         partition = np.unique(idx[:, 0], return_index=True)[1]
@@ -117,17 +117,20 @@ def contrastive_metrics(
         gt_dists = np.minimum.reduceat(dists[tuple(idx.T)], partition)
         gt_dists = gt_dists[:, None]
 
-    rows, cols = np.where((sorted_dists - gt_dists) == 0)  # find column position of GT
+    # the GT occupies the columns [n_less, n_less + n_equal) of the sorted row
+    n_less, n_equal = gt_rank_counts(sims, gt_dists, chunk_size=chunk_size)
+    assert (n_equal > 0).all(), "issue in metric evaluation"
+    cols = n_less
 
     # if there are ties
-    if rows.size > num_queries:
-        assert np.unique(rows).size == num_queries, "issue in metric evaluation"
+    if (n_equal > 1).any():
         if break_ties == "optimistically":
-            opti_cols = break_ties_optimistically(sorted_dists, gt_dists)
-            cols = opti_cols
+            cols = n_less
         elif break_ties == "averaging":
-            avg_cols = break_ties_average(sorted_dists, gt_dists)
-            cols = avg_cols
+            # same as break_ties_average
+            cols = n_less + (n_equal - 1) / 2
+        else:
+            raise ValueError(f"unknown break_ties: {break_ties}")
 
     msg = "expected ranks to match queries ({} vs {}) "
     assert cols.size == num_queries, msg
@@ -137,6 +140,24 @@ def contrastive_metrics(
     return cols2metrics(cols, num_queries, rounding=rounding)
 
 
+def gt_rank_counts(sims, gt_dists, chunk_size=1024):
+    """
+    Number of entries of each row of the distances (-sims) that are smaller
+    than / equal to the GT distance of the row, i.e. the rank of the GT without
+    sorting. Rows are processed chunk_size at a time to bound the memory.
+    """
+    num_queries = len(sims)
+    n_less = np.empty(num_queries, dtype=np.int64)
+    n_equal = np.empty(num_queries, dtype=np.int64)
+    for start in range(0, num_queries, chunk_size):
+        end = min(start + chunk_size, num_queries)
+        dists = -sims[start:end]
+        gt = gt_dists[start:end]
+        n_less[start:end] = np.count_nonzero(dists < gt, axis=1)
+        n_equal[start:end] = np.count_nonzero(dists == gt, axis=1)
+    return n_less, n_equal
+
+
 def break_ties_average(sorted_dists, gt_dists):
     # fast implementation, based on this code:
     # https://stackoverflow.com/a/49239335
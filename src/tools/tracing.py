@@ -0,0 +1,158 @@
+"""
+Per-stage latency tracing.
+
+Stages are wrapped in named spans, nested spans are recorded under the path of
+their parents (e.g. 'generate_motion/diffusion_reverse/denoiser_step'). The
+tracer is off by default and a disabled span is a shared no-op object, so the
+instrumentation costs one flag check. Enable it with MOTIONFIX_TRACE=1 or
+`TRACER.enable()`.
+
+    from src.tools.tracing import TRACER, traced
+
+    @traced('diffout2motion')
+    def diffout2motion(self, diffout): ...
+
+    with TRACER.span('text_encoding'):
+        text_emb, text_mask = self.text_encoder(texts)
+
+    TRACER.as_metrics()  # {'latency/generate_motion_ms': ..., ...}
+"""
+import functools
+import json
+import logging
+import os
+import time
+from typing import Dict
+
+import torch
+
+log = logging.getLogger(__name__)
+
+TRACE_ENV = 'MOTIONFIX_TRACE'
+
+
+class _NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span:
+    def __init__(self, tracer: 'Tracer', name: str):
+        self.tracer = tracer
+        self.name = name
+
+    def __enter__(self):
+        self.tracer._stack.append(self.name)
+        self.path = '/'.join(self.tracer._stack)
+        self.tracer._sync()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.tracer._sync()
+        self.tracer.add(self.path, time.perf_counter() - self.start)
+        self.tracer._stack.pop()
+        return False
+
+
+class Tracer:
+    """
+    Collects count, total, max and last duration per span path.
+
+    Args:
+        enabled: record spans, defaults to the MOTIONFIX_TRACE env variable
+        sync_cuda: synchronize CUDA around spans so that they measure the
+            kernels they launch and not only their launch
+    """
+    def __init__(self, enabled: bool = None, sync_cuda: bool = True):
+        if enabled is None:
+            enabled = os.environ.get(TRACE_ENV, '0') not in ('', '0', 'false')
+        self.enabled = enabled
+        self.sync_cuda = sync_cuda
+        self._stack = []
+        self._stats = {}
+
+    def enable(self):
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def reset(self):
+        self._stats = {}
+
+    def _sync(self):
+        if self.sync_cuda and torch.cuda.is_available() and torch.cuda.is_initialized():
+            torch.cuda.synchronize()
+
+    def span(self, name: str):
+        if not self.enabled:
+            return _NULL_SPAN
+        return _Span(self, name)
+
+    def add(self, path: str, seconds: float):
+        stat = self._stats.setdefault(path, {'count': 0, 'total_ms': 0.0,
+                                             'max_ms': 0.0, 'last_ms': 0.0})
+        ms = seconds * 1e3
+        stat['count'] += 1
+        stat['total_ms'] += ms
+        stat['max_ms'] = max(stat['max_ms'], ms)
+        stat['last_ms'] = ms
+
+    def wrap(self, name: str, fn):
+        """fn recorded as a span on every call, e.g. the model of a sampling loop"""
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with self.span(name):
+                return fn(*args, **kwargs)
+        return wrapper
+
+    def stats(self) -> Dict[str, dict]:
+        return {path: {**stat, 'mean_ms': stat['total_ms'] / stat['count']}
+                for path, stat in self._stats.items()}
+
+    def as_metrics(self, prefix: str = 'latency/') -> Dict[str, float]:
+        """mean duration and count per span, flat for a Lightning logger"""
+        metrics = {}
+        for path, stat in self.stats().items():
+            metrics[f'{prefix}{path}_ms'] = stat['mean_ms']
+            metrics[f'{prefix}{path}_count'] = float(stat['count'])
+        return metrics
+
+    def over_budget(self, budgets: Dict[str, float]) -> Dict[str, float]:
+        """
+        Args:
+            budgets: span path -> maximum mean duration in ms
+        returns:
+            the mean duration of the spans over their budget
+        """
+        stats = self.stats()
+        return {path: stats[path]['mean_ms'] for path, budget in budgets.items()
+                if path in stats and stats[path]['mean_ms'] > budget}
+
+    def log_summary(self, logger: logging.Logger = None):
+        """one structured (JSON) log record with the stats of all spans"""
+        (logger or log).info(json.dumps({'latency': self.stats()}))
+
+
+# the tracer of the process, instrumented code records into it
+TRACER = Tracer()
+
+
+def traced(name: str):
+    """decorator recording every call of a function as a span of TRACER"""
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not TRACER.enabled:
+                return fn(*args, **kwargs)
+            with _Span(TRACER, name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -161,6 +161,36 @@ def apply_rot_delta(rots, deltas, in_format="6d", out_format="6d"):
         new_rots = rearrange(new_rots, '... j d -> ... (j d)')
     return new_rots
 
+def integrate_rot_deltas(deltas, first=None, in_format="6d", out_format="6d"):
+    """
+    Loop-free integration of rotation deltas over time, the inverse of rot_diff
+    R_0 = first, R_i = R_{i-1} @ delta_i
+    input:
+        - deltas: [..., frames, d] deltas, the one of the first frame is ignored
+        - first: [..., d] rotation of the first frame, identity if None
+    The cumulative products are a parallel prefix scan: log2(frames) batched
+    matmuls instead of one apply_rot_delta per frame.
+    """
+    rots = transform_body_pose(deltas, f"{in_format}->rot")
+    if first is None:
+        first = torch.eye(3, dtype=rots.dtype,
+                          device=rots.device).expand_as(rots[..., 0, :, :])
+    else:
+        first = transform_body_pose(first, f"{in_format}->rot")
+    rots = torch.cat([first[..., None, :, :], rots[..., 1:, :, :]], dim=-3)
+    # Hillis-Steele scan, after each pass frame i holds the product of the
+    # last 2*offset deltas up to i
+    nframes = rots.shape[-3]
+    offset = 1
+    while offset < nframes:
+        rots = torch.cat([rots[..., :offset, :, :],
+                          rots[..., :-offset, :, :] @ rots[..., offset:, :, :]],
+                         dim=-3)
+        offset *= 2
+    if out_format == "rot":
+        return rots
+    return transform_body_pose(rots, f"rot->{out_format}")
+
 def rot_diff(rots1, rots2=None, in_format="6d", out_format="6d"):
     """
     dim 0 is considered to be the time dimention, this is where the shift will happen
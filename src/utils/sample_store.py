@@ -0,0 +1,137 @@
+"""
+Single-file store of generated samples.
+
+`motionfix_evaluate.py` generates one motion per sample id and guidance
+setting. Instead of one small pickled `.npy` per motion, all the motions of a
+guidance setting are appended to one file, which the metric scripts open with
+a memory map and index by key id.
+
+Layout of a store file:
+    MAGIC                      8 bytes
+    array data                 raw arrays, each aligned to ALIGN bytes
+    index                      utf-8 JSON {key: [offset, shape, dtype]}
+    index offset               uint64, little-endian
+    MAGIC                      8 bytes
+"""
+import glob
+import json
+import os
+import struct
+from pathlib import Path
+from typing import Dict, Iterator, Tuple
+
+import numpy as np
+
+MAGIC = b'MFXSMPL1'
+ALIGN = 64
+# name of the store inside a guidance setting folder
+SAMPLE_STORE_FILE = 'samples.mfs'
+
+
+def is_sample_store(folder) -> bool:
+    return folder is not None and os.path.isfile(os.path.join(folder,
+                                                              SAMPLE_STORE_FILE))
+
+
+class SampleStoreWriter:
+    """
+    Appends arrays to a store file. The file is written next to its final path
+    and moved there on close, so readers never see a partial store.
+
+    Args:
+        path: path of the store file
+    """
+    def __init__(self, path):
+        self.path = str(path)
+        self._tmp_path = f'{self.path}.{os.getpid()}.tmp'
+        self._f = open(self._tmp_path, 'wb')
+        self._f.write(MAGIC)
+        self._index = {}
+
+    def put(self, key: str, array: np.ndarray):
+        array = np.ascontiguousarray(array)
+        pad = -self._f.tell() % ALIGN
+        self._f.write(b'\0' * pad)
+        self._index[key] = [self._f.tell(), list(array.shape), array.dtype.str]
+        self._f.write(array.tobytes())
+
+    def close(self):
+        if self._f is None:
+            return
+        index_offset = self._f.tell()
+        self._f.write(json.dumps(self._index).encode())
+        self._f.write(struct.pack('<Q', index_offset))
+        self._f.write(MAGIC)
+        self._f.close()
+        self._f = None
+        os.replace(self._tmp_path, self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class SampleStore:
+    """
+    Read-only, dict-like view of a store file. Arrays are read-only views of
+    a memory map of the file, copy them to modify them.
+
+    Args:
+        path: path of the store file or of the folder containing it
+    """
+    def __init__(self, path):
+        path = str(path)
+        if os.path.isdir(path):
+            path = os.path.join(path, SAMPLE_STORE_FILE)
+        self.path = path
+        self._data = np.memmap(path, dtype=np.uint8, mode='r')
+        footer = self._data[-16:].tobytes()
+        if self._data[:8].tobytes() != MAGIC or footer[8:] != MAGIC:
+            raise ValueError(f'{path} is not a complete sample store.')
+        index_offset = struct.unpack('<Q', footer[:8])[0]
+        self.index = json.loads(self._data[index_offset:-16].tobytes())
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def keys(self):
+        return self.index.keys()
+
+    def __getitem__(self, key) -> np.ndarray:
+        offset, shape, dtype = self.index[key]
+        dtype = np.dtype(dtype)
+        nbytes = int(np.prod(shape)) * dtype.itemsize
+        return self._data[offset:offset + nbytes].view(dtype).reshape(shape)
+
+    def items(self) -> Iterator[Tuple[str, np.ndarray]]:
+        for key in self.index:
+            yield key, self[key]
+
+
+def iter_samples(folder) -> Iterator[Tuple[str, np.ndarray]]:
+    """
+    (key id, pose) of the samples of a folder, read from its sample store or
+    from the `.npy` files of the older per-sample format
+    """
+    if is_sample_store(folder):
+        yield from SampleStore(folder).items()
+        return
+    for fname in glob.glob(f'{folder}/*.npy'):
+        keyid = str(Path(fname).name).replace('.npy', '')
+        yield keyid, np.load(fname, allow_pickle=True).item()['pose']
+
+
+def load_sample(path) -> np.ndarray:
+    """
+    pose of one sample given its `.npy` path, which is read from the sample
+    store of its folder when the file does not exist
+    """
+    path = Path(path)
+    if path.exists():
+        return np.load(path, allow_pickle=True).item()['pose']
+    return np.array(SampleStore(path.parent)[path.stem])
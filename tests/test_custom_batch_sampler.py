@@ -0,0 +1,57 @@
+import numpy as np
+import pytest
+from torch.utils.data import DistributedSampler, SequentialSampler
+
+from src.data.sampling.custom_batch_sampler import LengthBucketBatchSampler
+
+
+def _rank_batches(lengths, batch_size, num_replicas, epoch=0, **kwargs):
+    batches = []
+    for rank in range(num_replicas):
+        sampler = DistributedSampler(range(len(lengths)),
+                                     num_replicas=num_replicas, rank=rank)
+        batch_sampler = LengthBucketBatchSampler(sampler, lengths, batch_size,
+                                                 **kwargs)
+        batch_sampler.set_epoch(epoch)
+        batches.append(list(batch_sampler))
+        assert len(batches[-1]) == len(batch_sampler)
+    return batches
+
+
+@pytest.mark.parametrize('n_samples', [1, 7, 64, 101])
+@pytest.mark.parametrize('num_replicas', [1, 2, 3])
+@pytest.mark.parametrize('drop_last', [False, True])
+def test_same_number_of_batches_per_rank(n_samples, num_replicas, drop_last):
+    lengths = np.random.default_rng(0).integers(10, 300, size=n_samples)
+    batches = _rank_batches(lengths, 8, num_replicas, drop_last=drop_last)
+    assert len({len(b) for b in batches}) == 1
+    seen = {i for rank in batches for batch in rank for i in batch}
+    if drop_last:
+        assert all(len(batch) == 8 for rank in batches for batch in rank)
+    else:
+        assert seen == set(range(n_samples))
+
+
+def test_ranks_split_the_same_batches():
+    lengths = np.random.default_rng(0).integers(10, 300, size=48)
+    single, = _rank_batches(lengths, 4, 1, epoch=3)
+    ranks = _rank_batches(lengths, 4, 2, epoch=3)
+    assert ranks[0] == single[0::2]
+    assert ranks[1] == single[1::2]
+
+
+def test_batches_change_with_the_epoch():
+    lengths = np.random.default_rng(0).integers(10, 300, size=50)
+    sampler = LengthBucketBatchSampler(SequentialSampler(range(50)), lengths, 4)
+    first = list(sampler)
+    assert list(sampler) == first
+    sampler.set_epoch(1)
+    assert list(sampler) != first
+
+
+def test_less_padding_than_random_batches():
+    lengths = np.random.default_rng(0).integers(10, 300, size=256)
+    sampler = LengthBucketBatchSampler(SequentialSampler(range(256)), lengths,
+                                       16)
+    bucketed, unbucketed = sampler.log_padding_efficiency()
+    assert bucketed > unbucketed
@@ -0,0 +1,49 @@
+import pytest
+import torch
+
+from src.model.denoiser_export import (ExportedDenoiser, check_parity,
+                                       export_onnx, export_torchscript)
+from src.model.tmed_denoiser import TMED_denoiser
+
+TOLERANCE = 1e-4
+
+
+@pytest.fixture(scope='module')
+def denoiser():
+    # configs/model/denoiser/tmed_denoiser.yaml, scaled down
+    torch.manual_seed(0)
+    return TMED_denoiser(nfeats=24, condition='text',
+                         motion_condition='source', latent_dim=32,
+                         ff_size=64, num_layers=2, num_heads=2,
+                         text_encoded_dim=48, use_sep=True).eval()
+
+
+@pytest.fixture(scope='module')
+def torchscript_path(denoiser, tmp_path_factory):
+    path = tmp_path_factory.mktemp('export') / 'denoiser.pt'
+    return export_torchscript(denoiser, str(path), length=40, text_tokens=16)
+
+
+def test_torchscript_parity_3way(denoiser, torchscript_path):
+    exported = ExportedDenoiser(torchscript_path, eager=denoiser)
+    assert check_parity(denoiser, exported, lengths=(25, 40, 90)) < TOLERANCE
+
+
+def test_torchscript_parity_text_only(denoiser, torchscript_path):
+    exported = ExportedDenoiser(torchscript_path, eager=denoiser)
+    assert check_parity(denoiser, exported, text_only=True) < TOLERANCE
+
+
+def test_text_only_needs_the_eager_denoiser(denoiser, torchscript_path):
+    with pytest.raises(ValueError):
+        check_parity(denoiser, ExportedDenoiser(torchscript_path),
+                     text_only=True)
+
+
+def test_onnx_parity_3way(denoiser, tmp_path):
+    pytest.importorskip('onnx')
+    pytest.importorskip('onnxruntime')
+    path = export_onnx(denoiser, str(tmp_path / 'denoiser.onnx'), length=40,
+                       text_tokens=16)
+    exported = ExportedDenoiser(path, eager=denoiser)
+    assert check_parity(denoiser, exported) < TOLERANCE
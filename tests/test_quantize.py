@@ -0,0 +1,42 @@
+import pytest
+import torch
+from torch import nn
+
+from src.model.textencoder.quantize import (check_cpu_only, is_quantized,
+                                            quantize_dynamic_int8)
+
+
+def _model():
+    torch.manual_seed(0)
+    return nn.Sequential(nn.Embedding(100, 32), nn.Linear(32, 64), nn.GELU(),
+                         nn.Linear(64, 32)).eval()
+
+
+def test_quantized_outputs_close_to_fp32():
+    reference = _model()
+    quantized = quantize_dynamic_int8(_model())
+    assert is_quantized(quantized) and not is_quantized(reference)
+    tokens = torch.randint(0, 100, (4, 12))
+    with torch.no_grad():
+        cos = nn.functional.cosine_similarity(reference(tokens),
+                                              quantized(tokens), dim=-1)
+    assert cos.min() > 0.99
+
+
+def test_cpu_only():
+    quantized = quantize_dynamic_int8(_model())
+    check_cpu_only(quantized)
+    # a parameter off the CPU, as after moving the module to a GPU
+    quantized.register_parameter(
+        'moved', nn.Parameter(torch.empty(1, device='meta')))
+    with pytest.raises(RuntimeError, match='CPU only'):
+        check_cpu_only(quantized)
+    # fp32 models may live anywhere
+    check_cpu_only(_model().to('meta'))
+
+
+@pytest.mark.skipif(not torch.cuda.is_available(), reason='needs a GPU')
+def test_moving_to_cuda_raises():
+    quantized = quantize_dynamic_int8(_model())
+    with pytest.raises(RuntimeError, match='CPU only'):
+        check_cpu_only(quantized.cuda())
@@ -0,0 +1,53 @@
+import pytest
+import torch
+
+from src.tools.transforms3d import (apply_rot_delta, integrate_rot_deltas,
+                                    transform_body_pose)
+
+
+def _random_6d(*shape, scale=1.0, generator=None):
+    aa = scale * torch.randn(*shape, 3, generator=generator, dtype=torch.float64)
+    return transform_body_pose(aa, 'aa->6d')
+
+
+def _integrate_loop(deltas, first=None):
+    # the per-frame loop of MD.diffout2motion that integrate_rot_deltas replaced
+    if first is None:
+        first = transform_body_pose(torch.eye(3, dtype=deltas.dtype).repeat(
+            deltas.shape[0], 1, 1), 'rot->6d')
+    prev = first
+    rots = [prev[:, None]]
+    for i in range(1, deltas.shape[1]):
+        prev = apply_rot_delta(prev, deltas[:, i])
+        rots.append(prev[:, None])
+    return torch.cat(rots, dim=1)
+
+
+@pytest.mark.parametrize('nframes', [1, 2, 3, 7, 64, 100, 300])
+@pytest.mark.parametrize('with_first', [False, True])
+def test_integrate_rot_deltas_matches_loop(nframes, with_first):
+    g = torch.Generator().manual_seed(nframes)
+    deltas = _random_6d(4, nframes, scale=0.05, generator=g)
+    first = _random_6d(4, generator=g) if with_first else None
+    loop = _integrate_loop(deltas, first)
+    scan = integrate_rot_deltas(deltas, first)
+    assert scan.shape == loop.shape
+    torch.testing.assert_close(scan, loop, atol=1e-8, rtol=0)
+
+
+def test_integrate_rot_deltas_ignores_first_delta():
+    g = torch.Generator().manual_seed(0)
+    deltas = _random_6d(2, 10, generator=g)
+    other = deltas.clone()
+    other[:, 0] = _random_6d(2, generator=g)
+    torch.testing.assert_close(integrate_rot_deltas(deltas),
+                               integrate_rot_deltas(other))
+
+
+def test_integrate_rot_deltas_rotation_matrices():
+    g = torch.Generator().manual_seed(0)
+    deltas = _random_6d(3, 17, scale=0.1, generator=g)
+    rots = integrate_rot_deltas(deltas, out_format='rot')
+    assert rots.shape == (3, 17, 3, 3)
+    torch.testing.assert_close(transform_body_pose(rots, 'rot->6d'),
+                               integrate_rot_deltas(deltas))
@@ -96,13 +96,9 @@ def collect_gen_samples(gener_motions, normalizer, device):
 
     if isinstance(gener_motions, str):
         # you have a path and not the motions themselves
-        import glob
-        sample_files = glob.glob(f'{gener_motions}/*.npy')
-        for fname in tqdm(sample_files):
-            keyid = str(Path(fname).name).replace('.npy', '')
-            gen_motion_b = np.load(fname,
-                                allow_pickle=True).item()['pose']
-            gen_motion_b = torch.from_numpy(gen_motion_b)
+        from src.utils.sample_store import iter_samples
+        for keyid, gen_motion_b in tqdm(iter_samples(gener_motions)):
+            gen_motion_b = torch.from_numpy(np.array(gen_motion_b))
             trans = gen_motion_b[..., :3]
             global_orient_6d = gen_motion_b[..., 3:9]
             body_pose_6d = gen_motion_b[..., 9:]
@@ -130,102 +126,77 @@ def collect_gen_samples(gener_motions, normalizer, device):
 
     return cur_samples, cur_samples_raw
 
-def compute_sim_matrix(model, dataset, keyids, gen_samples,
-                       batch_size=256, progress=True):
-    import torch
-    import numpy as np
-    from src.data.tools.collate import collate_text_motion
-    from src.tmr.tmr import get_sim_matrix
-    import numpy as np
-    device = model.device
-    if batch_size > len(dataset):
-        batch_size = len(dataset)
-    nsplit = int(np.ceil(len(dataset) / batch_size))
-    returned = {}
-    keyids_ordered = {}
+def compute_latents(model, dataset, keyids, gen_samples,
+                    batch_size=256, progress=True):
+    """
+    Encode the source, target and generated motion of every keyid once.
+    Generations are cut to the length of their target.
+
+    Returns a dict with the 'source', 'target' and 'generated' latents, rows
+    in the order of keyids. Without gen_samples 'generated' is the target.
+    """
+    from src.data.tools.collate import collate_tensor_with_padding
+
+    def encode(motions):
+        lengths = [len(x) for x in motions]
+        motion = collate_tensor_with_padding(motions).to(model.device)
+        masks = length_to_mask(lengths, device=motion.device)
+        return model.encode({'length': lengths, 'mask': masks, 'x': motion},
+                            sample_mean=True)
+
+    latents = {'source': [], 'target': [], 'generated': []}
+    batches = [keyids[i:i + batch_size]
+               for i in range(0, len(keyids), batch_size)]
+    if progress:
+        batches = tqdm(batches, leave=False)
     with torch.no_grad():
+        for cur_batch_keys in batches:
+            data = [dataset.load_keyid(keyid) for keyid in cur_batch_keys]
+            latents['source'].append(encode([x['motion_source'] for x in data]))
+            latents['target'].append(encode([x['motion_target'] for x in data]))
+            if gen_samples:
+                cur_samples = [gen_samples[x['keyid']][:len(x['motion_target'])]
+                               for x in data]
+                latents['generated'].append(encode(cur_samples))
+    latents = {k: torch.cat(v) for k, v in latents.items() if v}
+    if 'generated' not in latents:
+        latents['generated'] = latents['target']
+    return latents
+
+
+def sim_matrices_from_latents(latents):
+    """
+    Similarity matrices of all the settings, over all the encoded keyids.
+    s_t: source vs generated, t_t: target vs generated
+    """
+    from src.tmr.tmr import get_sim_matrix
+    return {
+        'sim_matrix_s_t': get_sim_matrix(latents['source'],
+                                         latents['generated']).cpu().numpy(),
+        'sim_matrix_t_t': get_sim_matrix(latents['target'],
+                                         latents['generated']).cpu().numpy()
+            }
 
-        all_data = [dataset.load_keyid(keyid) for keyid in keyids]
-        if nsplit > len(all_data):
-            nsplit = len(all_data)
-        all_data_splitted = np.array_split(all_data, nsplit)
-        # by batch (can be too costly on cuda device otherwise)
-        for sett in ['s_t', 't_t']:
-            cur_samples = []
-            latent_motions_A = []
-            latent_motions_B = []
-            keys_ordered_for_run = []
-
-            if progress:
-                data_iter = tqdm(all_data_splitted, leave=False)
-            else:
-                data_iter = all_data_splitted
-            for data in data_iter:
-                # batch = collate_text_motion(data, device=device)
-                from src.data.tools.collate import collate_tensor_with_padding
-                cur_batch_keys = [x['keyid'] for x in data]
-                keys_ordered_for_run.extend(cur_batch_keys)
-                # TODO load the motions for the generations
-                # Text is already encoded
-                if sett == 's_t':
-                    motion_a = collate_tensor_with_padding(
-                        [x['motion_source'] for x in data]).to(model.device)
-                    lengths_a = [len(x['motion_source']) for x in data]
-                    lengths_tgt = [len(x['motion_target']) for x in data]
-                    if gen_samples:
-                        cur_samples = [gen_samples[key_in_batch][:lengths_tgt[ix]] for ix, key_in_batch in enumerate(cur_batch_keys)]
-                        lengths_b = [len(x) for x in cur_samples]
-                        motion_b = collate_tensor_with_padding(
-                            cur_samples).to(model.device)
-                    else:
-                        motion_b = collate_tensor_with_padding(
-                           [x['motion_target'] for x in data]).to(model.device)
-                        lengths_b = [len(x['motion_target']) for x in data]
 
-                    masks_a = length_to_mask(lengths_a, device=motion_a.device)
-                    masks_b = length_to_mask(lengths_b, device=motion_b.device)
-                    motion_a_dict = {'length': lengths_a, 'mask': masks_a,
-                                    'x': motion_a}
-                    motion_b_dict = {'length': lengths_b, 'mask': masks_b, 
-                                    'x': motion_b}
-                elif sett == 't_t':
-                    motion_a = collate_tensor_with_padding(
-                        [x['motion_target'] for x in data]).to(model.device)
-                    lengths_a = [len(x['motion_target']) for x in data]
-                    lengths_tgt = [len(x['motion_target']) for x in data]
+def slice_sim_matrices(sim_matrices, rows):
+    """
+    Similarity matrices of a subset of the keyids, given by their rows.
+    The similarity is computed per pair, so this is the same as encoding the
+    subset on its own.
+    """
+    return {key: sim_matrix[np.ix_(rows, rows)]
+            for key, sim_matrix in sim_matrices.items()}
 
-                    if gen_samples:
-                        cur_samples = [gen_samples[key_in_batch][:lengths_tgt[ix]] for ix, key_in_batch in enumerate(cur_batch_keys)]
-                        lengths_b = [len(x) for x in cur_samples]
-                        motion_b = collate_tensor_with_padding(cur_samples
-                                                               ).to(model.device)
-                    else:
-                        motion_b = collate_tensor_with_padding([
-                            x['motion_target'] for x in data]).to(
-                                model.device)
-                        lengths_b = [len(x['motion_target']) for x in data]
 
-                    masks_a = length_to_mask(lengths_a, device=motion_a.device)
-                    masks_b = length_to_mask(lengths_b, device=motion_b.device)
-                    motion_a_dict = {'length': lengths_a, 'mask': masks_a,
-                                    'x': motion_a}
-                    motion_b_dict = {'length': lengths_b, 'mask': masks_b, 
-                                    'x': motion_b}
-
-                # Encode both motion and text
-                latent_motion_A = model.encode(motion_a_dict, 
-                                            sample_mean=True)
-                latent_motion_B = model.encode(motion_b_dict,
-                                            sample_mean=True)
-                latent_motions_A.append(latent_motion_A)
-                latent_motions_B.append(latent_motion_B)
-
-            latent_motions_A = torch.cat(latent_motions_A)
-            latent_motions_B = torch.cat(latent_motions_B)
-            sim_matrix = get_sim_matrix(latent_motions_A, latent_motions_B)
-            returned[f'sim_matrix_{sett}'] = sim_matrix.cpu().numpy()
-            keyids_ordered[sett] = keys_ordered_for_run
-    return returned, keyids_ordered
+def compute_sim_matrix(model, dataset, keyids, gen_samples,
+                       batch_size=256, progress=True):
+    if batch_size > len(dataset):
+        batch_size = len(dataset)
+    latents = compute_latents(model, dataset, keyids, gen_samples,
+                              batch_size=batch_size, progress=progress)
+    keys_ordered_for_run = list(keyids)
+    keyids_ordered = {sett: keys_ordered_for_run for sett in ['s_t', 't_t']}
+    return sim_matrices_from_latents(latents), keyids_ordered
 
 def get_motion_distances(model, dataset, keyids, gen_samples,
                          batch_size=256):
@@ -399,120 +370,49 @@ def shorten_metric_line(line_to_shorten):
     # Join the list back into a string
     return '&'.join(numbers)
 
-def retrieval(samples_to_eval) -> None:
-    protocol = ['normal', 'batches']
-    device = 'cuda'
-    run_dir = 'eval-deps'
-    ckpt_name = 'last'
-    batch_size = 256
- 
-    protocols = protocol
-    dataset = 'motionfix' # motionfix
-    sets = 'test' # val all
-    # save_dir = os.path.join(run_dir, "motionfix/contrastive_metrics")
-    # os.makedirs(save_dir, exist_ok=True)
-
-    # Load last config
-    curdir = Path(hydra.utils.get_original_cwd())
-
-    cfg = read_config(curdir / run_dir)
-
-    import pytorch_lightning as pl
-    import numpy as np
-    from hydra.utils import instantiate
-    from src.tmr.load_model import load_model_from_cfg
+def retrieval_metrics(sim_matrices_all, keyids,
+                      protocols=('normal', 'batches')):
+    """
+    Retrieval metrics of the similarity matrices of all the keyids for the
+    "normal" (full gallery) and "batches" (galleries of 32) protocols.
+    The batches are blocks of the full matrices.
+    """
     from src.tmr.metrics import all_contrastive_metrics_mot2mot, print_latex_metrics_m2m
 
-    pl.seed_everything(cfg.seed)
-
-    logger.info("Loading the evaluation TMR model")
-    model = load_model_from_cfg(cfg, ckpt_name, eval_mode=True, device=device)
-
-    datasets = {}
     results = {}
-    keyids_ord = {}
+    keyids = list(keyids)
+    keyids_ord = {'all': {'s_t': keyids, 't_t': keyids}}
     bs_m2m = 32 # for the batch size metric
-    # calculate splits
-    from src.tmr.data.motionfix_loader import Normalizer
-    normalizer = Normalizer(curdir/run_dir/'stats/humanml3d/amass_feats')
-    gen_samples, gen_samples_raw = collect_gen_samples(samples_to_eval,
-                                        normalizer, 
-                                        model.device)
-    exist_gen_keys = list(gen_samples.keys())
-    if sets == 'all':
-        sets_to_load = ['val', 'test']
-        extra_str = '_val_test'
-    elif sets == 'val':
-        sets_to_load = ['val']
-        extra_str = '_val'
-    else:
-        sets_to_load = ['test']
-        extra_str = ''
-
     for protocol in protocols:
-        # logger.info(f"|------Protocol {protocol.upper()}-----|")
-        # Load the dataset if not already
-        if protocol not in datasets:
-            from src.tmr.data.motionfix_loader import MotionFixLoader
-            dataset = MotionFixLoader(sets=sets_to_load, 
-                                      keys_to_load=exist_gen_keys)
-
-            datasets.update(
-                {key: dataset for key in ["normal", "batches"]}
-            )
-        gen_samples = {k:v for k, v in gen_samples.items() if k in dataset.motions.keys()}
-        dataset = datasets[protocol]
-
-        # Compute sim_matrix for each protocol
         if protocol not in results:
             if protocol=="normal":
-                res, keyids_ord_for_all = compute_sim_matrix(
-                    model, dataset, dataset.keyids, 
-                    gen_samples=gen_samples,
-                    batch_size=batch_size,
-                )
-                keyids_ord['all'] = keyids_ord_for_all
-                results.update({key: res for key in ["normal"]})
-                # dists = get_motion_distances(
-                #     model, dataset, dataset.keyids, 
-                #     gen_samples=gen_samples_raw,
-                #     batch_size=batch_size,
-                # )
+                results.update({key: sim_matrices_all for key in ["normal"]})
 
             elif protocol == "batches":
-                keyids = sorted(dataset.keyids)
-                N = len(keyids)
+                keyids_sorted = sorted(keyids)
+                N = len(keyids_sorted)
+                row_of_keyid = {keyid: row for row, keyid in
+                                enumerate(keyids)}
 
                 # make batches of 32
                 idx = np.arange(N)
                 np.random.seed(0)
                 np.random.shuffle(idx)
                 idx_batches = [
-                    idx[bs_m2m * i : bs_m2m * (i + 1)] for i in range(len(keyids) // bs_m2m)
+                    idx[bs_m2m * i : bs_m2m * (i + 1)] for i in range(N // bs_m2m)
                 ]
 
                 # split into batches of 32
                 # batched_keyids = [ [32], [32], [...]]
                 results["batches"] = []
                 keyids_ord["batches"] = []
-                for idx_batch in tqdm(idx_batches):
-                    res_matrs, res_keys = compute_sim_matrix(model, dataset,
-                                                             np.array(keyids)[idx_batch],
-                                                             gen_samples=gen_samples,
-                                                             batch_size=batch_size,
-                                                             progress=False)
-                    results["batches"].append(res_matrs)
-                    keyids_ord["batches"].append(res_keys)
-                # results_v2v["guo"] = [
-                #     get_motion_distances(
-                #         model,
-                #         dataset,
-                #         np.array(keyids)[idx_batch],
-                #         gen_samples=gen_samples_raw,
-                #         batch_size=batch_size,
-                #     )
-                #     for idx_batch in idx_batches
-                # ]
+                for idx_batch in idx_batches:
+                    batch_keyids = list(np.array(keyids_sorted)[idx_batch])
+                    rows = [row_of_keyid[keyid] for keyid in batch_keyids]
+                    results["batches"].append(
+                        slice_sim_matrices(sim_matrices_all, rows))
+                    keyids_ord["batches"].append({'s_t': batch_keyids,
+                                                  't_t': batch_keyids})
 
         result = results[protocol]
 
@@ -599,5 +499,112 @@ def retrieval(samples_to_eval) -> None:
 
     return metrs_batches, metrs_full
 
+
+class TMRRetrievalEvaluator:
+    """
+    Motion-to-motion retrieval with the TMR model. The model, the normalizer,
+    the test set and the latents of its source and target motions are loaded
+    once and kept, so that evaluating a new set of generations only encodes the
+    generations. Build it once and call it on each set of generations.
+
+    Args:
+        run_dir: directory of the TMR model, relative to the original cwd
+        ckpt_name: checkpoint of the TMR model
+        device: device of the TMR model
+        batch_size: batch size of the encoding
+        sets: split(s) of the evaluation set ('test', 'val' or 'all')
+    """
+    def __init__(self, run_dir='eval-deps', ckpt_name='last', device='cuda',
+                 batch_size=256, sets='test'):
+        import pytorch_lightning as pl
+        from src.tmr.load_model import load_model_from_cfg
+        from src.tmr.data.motionfix_loader import MotionFixLoader, Normalizer
+
+        # Load last config
+        curdir = Path(hydra.utils.get_original_cwd())
+        cfg = read_config(curdir / run_dir)
+        pl.seed_everything(cfg.seed)
+
+        logger.info("Loading the evaluation TMR model")
+        self.model = load_model_from_cfg(cfg, ckpt_name, eval_mode=True,
+                                         device=device)
+        self.normalizer = Normalizer(curdir/run_dir/'stats/humanml3d/amass_feats')
+        self.batch_size = batch_size
+        if sets == 'all':
+            sets_to_load = ['val', 'test']
+        elif sets == 'val':
+            sets_to_load = ['val']
+        else:
+            sets_to_load = ['test']
+        self.dataset = MotionFixLoader(sets=sets_to_load)
+        self.row_of_keyid = {keyid: row for row, keyid in
+                             enumerate(self.dataset.keyids)}
+        self._gt_latents = None
+
+    @property
+    def gt_latents(self):
+        """latents of the source and target motions of the whole dataset"""
+        if self._gt_latents is None:
+            logger.info("Encoding the ground truth motions")
+            latents = compute_latents(self.model, self.dataset,
+                                      self.dataset.keyids, None,
+                                      batch_size=self.batch_size)
+            self._gt_latents = {'source': latents['source'],
+                                'target': latents['target']}
+        return self._gt_latents
+
+    def encode_generations(self, gen_samples, keyids):
+        """latents of the generations, cut to the length of their targets"""
+        from src.data.tools.collate import collate_tensor_with_padding
+        if not keyids:
+            raise ValueError('No generations to encode.')
+        latents = []
+        with torch.no_grad():
+            for i in range(0, len(keyids), self.batch_size):
+                cur_batch_keys = keyids[i:i + self.batch_size]
+                motions = [
+                    gen_samples[keyid][:len(self.dataset.motions[keyid]['motion_target']['trans'])]
+                    for keyid in cur_batch_keys
+                    ]
+                lengths = [len(x) for x in motions]
+                motion = collate_tensor_with_padding(motions).to(self.model.device)
+                masks = length_to_mask(lengths, device=motion.device)
+                latents.append(self.model.encode({'length': lengths,
+                                                  'mask': masks,
+                                                  'x': motion},
+                                                 sample_mean=True))
+        return torch.cat(latents)
+
+    def __call__(self, samples_to_eval):
+        """
+        Args:
+            samples_to_eval: {keyid: generated motion} or a directory of
+                generated samples
+        returns:
+            the metrics of the batches and of the full protocols
+        """
+        gen_samples, _ = collect_gen_samples(samples_to_eval,
+                                             self.normalizer,
+                                             self.model.device)
+        # in the order of the dataset
+        keyids = [keyid for keyid in self.dataset.keyids
+                  if keyid in gen_samples]
+        if not keyids:
+            unknown = sorted(gen_samples)
+            raise ValueError(
+                f'None of the {len(unknown)} generated keyids is in the '
+                f'evaluation set, e.g. {unknown[:5]}; expected keyids like '
+                f'{list(self.dataset.keyids)[:5]}.')
+        rows = torch.tensor([self.row_of_keyid[keyid] for keyid in keyids],
+                            device=self.gt_latents['source'].device)
+        latents = {'source': self.gt_latents['source'][rows],
+                   'target': self.gt_latents['target'][rows],
+                   'generated': self.encode_generations(gen_samples, keyids)}
+        return retrieval_metrics(sim_matrices_from_latents(latents), keyids)
+
+
+def retrieval(samples_to_eval):
+    return TMRRetrievalEvaluator()(samples_to_eval)
+
 if __name__ == "__main__":
     retrieval()
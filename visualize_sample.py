@@ -1,6 +1,7 @@
 from src.render.mesh_viz import render_motion
 from src.model.utils.tools import pack_to_render
 from src.render.video import get_offscreen_renderer
+from src.utils.sample_store import load_sample
 import os 
 import argparse
 import numpy as np
@@ -8,7 +9,8 @@ import torch
 def main(path_to_motion):
     # GET A RENDERER
     r = get_offscreen_renderer('./data/body_models') # this path if you followed my setup should be data/body_models
-    gen_motion = np.load(path_to_motion, allow_pickle=True).item()['pose']
+    # the .npy file or the sample of that id in the sample store of the folder
+    gen_motion = load_sample(path_to_motion)
     # Load the npy and get the translation aka trans_can and the rotations aka rots_can
     # CREATE A DICT TO GIVE TO RENDERING FUNCTION
     smpl_params = pack_to_render(trans=torch.from_numpy(gen_motion[..., :3]), 